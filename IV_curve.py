@@ -8,8 +8,7 @@ import datetime
 from utils import DataFrameDumper
 from grafica.plotly_utils.utils import line
 import tct_scripts_config
-from progressreporting.TelegramProgressReporter import TelegramReporter # https://github.com/SengerM/progressreporting
-import my_telegram_bots
+from contextlib import ExitStack # https://stackoverflow.com/a/34798330/8849755
 
 def script_core(
 		directory, # Where to store the measured data. A new directory will be created.
@@ -19,6 +18,7 @@ def script_core(
 		time_between_each_measurement: float, #Number of seconds between two consecutive readings.
 		time_after_changing_voltage: float, # Time to wait after voltage has been changed. To reduce self-heating effects, make this time bigger.
 		the_setup,
+		telegram_reporter_data_dict: dict = None, # A dictionary of the form `{'token': str, 'chat_id': str}` to report the progress, if `None` it is not reported.
 	):
 	bureaucrat = Bureaucrat(
 		directory,
@@ -26,18 +26,21 @@ def script_core(
 		variables = locals(),
 	)
 	
-	reporter = TelegramReporter(
-		telegram_token = my_telegram_bots.robobot.token, 
-		telegram_chat_id = my_telegram_bots.chat_ids['Robobot TCT setup'],
-	)
+	if telegram_reporter_data_dict is not None:
+		from progressreporting.TelegramProgressReporter import TelegramReporter # https://github.com/SengerM/progressreporting
+		reporter = TelegramReporter(
+			telegram_token = telegram_reporter_data_dict['token'], 
+			telegram_chat_id = telegram_reporter_data_dict['chat_id'],
+		)
 	
 	with bureaucrat.verify_no_errors_context():
-		with reporter.report_for_loop(len(voltages)*n_triggers, f'{bureaucrat.measurement_name}') as reporter:
+		with reporter.report_for_loop(len(voltages)*n_triggers, f'{bureaucrat.measurement_name}') if telegram_reporter_data_dict is not None else ExitStack() as reporter:
 			the_setup.laser_status = 'off' # Just in case, make sure the laser is off.
 			current_current_compliance = the_setup.current_compliance
 			try:
 				the_setup.current_compliance = current_compliance_amperes
 				the_setup.bias_output_status = 'on'
+				the_setup.start_slow_readback_sampler(quantities=['temperature','humidity']) # Bias voltage and current are measured in the loop, because that is the measurement.
 				measured_data_df = pandas.DataFrame(columns = {'n_voltage','n_trigger','When','Bias voltage (V)','Bias current (A)','Temperature (°C)','Humidity (%RH)'})
 				measured_data_df_dumper = DataFrameDumper(
 					bureaucrat.processed_data_dir_path/Path('measured_data.fd'),
@@ -56,12 +59,13 @@ def script_core(
 								'When': datetime.datetime.now(),
 								'Bias voltage (V)': the_setup.bias_voltage,
 								'Bias current (A)': the_setup.bias_current,
-								'Temperature (°C)': the_setup.temperature,
-								'Humidity (%RH)': the_setup.humidity,
+								'Temperature (°C)': the_setup.slow_readback('temperature'),
+								'Humidity (%RH)': the_setup.slow_readback('humidity'),
 							},
 							ignore_index = True,
 						)
-						reporter.update(1)
+						if telegram_reporter_data_dict is not None:
+							reporter.update(1)
 					measured_data_df = measured_data_df_dumper.dump_to_disk(measured_data_df)
 				measured_data_df_dumper.end(measured_data_df)
 				measured_data_df = pandas.read_feather(measured_data_df_dumper.file_path)
@@ -86,9 +90,28 @@ def script_core(
 				raise e
 			finally:
 				the_setup.current_compliance = current_current_compliance
+				the_setup.stop_slow_readback_sampler() # Otherwise the instruments keep being polled after the measurement.
 	
 if __name__ == '__main__':
 	import numpy as np
+	import argparse
+	
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--simulate',
+		help = 'Use this option to run with simulated instruments instead of the real ones, see `simulated_setup.py`.',
+		dest = 'simulate',
+		action = 'store_true',
+	)
+	args = parser.parse_args()
+	
+	if args.simulate:
+		from simulated_setup import SimulatedTheSetup
+		the_setup = SimulatedTheSetup()
+		telegram_reporter_data_dict = None
+	else:
+		import my_telegram_bots
+		the_setup = TheSetup()
+		telegram_reporter_data_dict = {'token': my_telegram_bots.robobot.token, 'chat_id': my_telegram_bots.chat_ids['Robobot TCT setup']}
 	
 	VOLTAGES = np.linspace(0,400,400)
 	
@@ -101,5 +124,6 @@ if __name__ == '__main__':
 		n_triggers = 2,
 		time_between_each_measurement = .1,
 		time_after_changing_voltage = 2,
-		the_setup = TheSetup(),
+		the_setup = the_setup,
+		telegram_reporter_data_dict = telegram_reporter_data_dict,
 	)
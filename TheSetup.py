@@ -1,62 +1,223 @@
-import PyticularsTCT # https://github.com/SengerM/PyticularsTCT
-from PyticularsTCT.find_ximc_stages import map_coordinates_to_serial_ports # https://github.com/SengerM/PyticularsTCT
-import pyvisa
-import TeledyneLeCroyPy # https://github.com/SengerM/TeledyneLeCroyPy
-from keithley.Keithley2470 import Keithley2470SafeForLGADs # https://github.com/SengerM/keithley
-from Pyro5.api import Proxy
 import atexit
 from time import sleep
 import threading
 import tct_scripts_config
-# ~ import pydrs # https://github.com/SengerM/pydrs
-from temperature_controller import SERVER_NAME
 import warnings
+import numpy as np
+import collections
+import time
+import functools
+from setup_profiler import SetupProfiler, LatencyHistogram
+
+SLOW_READBACK_QUANTITIES = { # Name of the property in `TheSetup`: name of the column in the data.
+	'bias_voltage': 'Bias voltage (V)',
+	'bias_current': 'Bias current (A)',
+	'temperature': 'Temperature (°C)',
+	'humidity': 'Humidity (%RH)',
+}
+
+def _timed(name: str):
+	"""Decorator for the methods of `TheSetup` so the time they take is
+	measured by `TheSetup.profiler` when profiling is enabled."""
+	def decorator(method):
+		@functools.wraps(method)
+		def wrapper(self, *args, **kwargs):
+			if self.profiler is None:
+				return method(self, *args, **kwargs)
+			with self.profiler.measure(name):
+				return method(self, *args, **kwargs)
+		return wrapper
+	return decorator
+
+STAGES_SETTLING = { # Default value of `TheSetup.stages_settling`, see `TheSetup.move_to`.
+	'tolerance (m)': {'x': .5e-6, 'y': .5e-6, 'z': 1e-6}, # How far from the target the position read back can be, for each axis.
+	'stillness tolerance (m)': 10e-9, # An axis whose position read back changes less than this between two readings is not moving anymore, even if it is not within `tolerance (m)` of the target (e.g. the resolution of its readback is coarser, or it has an offset).
+	'consecutive readings': 2, # Number of consecutive readings with every axis within tolerance or not moving to consider that the stages have settled.
+	'minimum time (s)': 5e-3, # Time to wait after any movement before reading the position.
+	'time per distance (s/m)': 20, # Extra time to wait before reading the position, proportional to the distance moved, e.g. 20 ms per mm.
+	'poll period (s)': 5e-3, # Time between readings of the position.
+	'timeout (s)': 1, # If not settled after this time a warning is issued and the acquisition continues.
+}
 
 class TheSetup:
 	"""This class wraps all the hardware so if there are changes it is easy to adapt."""
-	def __init__(self, safe_mode=True):
+	def __init__(self, safe_mode=True, verify_setpoints_on_read=False, profile=False):
 		"""
 		- safe_mode: Turns laser and high voltage off when your Python instance is finished using `atexit`. Temperature is not touched.
+		- verify_setpoints_on_read: Values that are set by this class (laser DAC and status, current compliance and bias output status) are cached when written, so reading them does not require to talk to the instruments. If `verify_setpoints_on_read` is `True` they are always read from the instruments and a warning is issued if they differ from the cache.
+		- profile: If `True` the time spent in each method and waiting for the lock of each instrument is measured, see `setup_profiler.SetupProfiler`. The results are in `self.profiler`, which is `None` if `profile` is `False`.
 		"""
-		self._LeCroy = TeledyneLeCroyPy.LeCroyWaveRunner(pyvisa.ResourceManager().open_resource('USB0::1535::4131::2810N60091::0::INSTR'))
-		# ~ self._drs4_evaluation_board = pydrs.get_board(0)
+		self.profiler = SetupProfiler() if profile else None
 		
-		stages_coordinates = {
-			'00003A48': 'x',
-			'00003A57': 'y',
-			'000038CE': 'z',
-		}
-		ports_dict = map_coordinates_to_serial_ports(stages_coordinates)
-		self._tct = PyticularsTCT.TCT(x_stage_port=ports_dict['x'], y_stage_port=ports_dict['y'], z_stage_port=ports_dict['z'])
+		self._connect_instruments()
 		
-		self._keithley = Keithley2470SafeForLGADs('USB0::1510::9328::04481179::0::INSTR', polarity = 'negative')
-		self._temperature_controller = Proxy(f'PYRONAME:{SERVER_NAME}')
+		self._setpoints_cache = {}
+		self.verify_setpoints_on_read = verify_setpoints_on_read
+		
+		self.stages_settling = {key: (dict(value) if isinstance(value, dict) else value) for key,value in STAGES_SETTLING.items()} # Can be modified by the user, see `move_to`.
+		self._stages_last_position = None
+		self._stages_settling_histogram = LatencyHistogram()
+		self._stages_settling_counts = {'Number of timeouts': 0, 'Number of position readings': 0, 'Number of times settled away from the target': 0}
+		self._stages_settling_warned_axes = set() # Each problem is reported once per stage, not on every movement.
 		
 		# Threading locks ---
-		self._oscilloscope_Lock = threading.RLock()
-		self._tct_Lock = threading.RLock()
-		self._keithley_Lock = threading.RLock()
-		self._temperature_humidity_sensor_Lock = threading.RLock()
-		self._peltier_DC_power_supply_Lock = threading.RLock()
+		self._oscilloscope_Lock = self._new_lock('oscilloscope')
+		self._tct_Lock = self._new_lock('tct')
+		self._keithley_Lock = self._new_lock('keithley')
+		self._temperature_humidity_sensor_Lock = self._new_lock('temperature_humidity_sensor')
+		self._peltier_DC_power_supply_Lock = self._new_lock('peltier_DC_power_supply')
 		
 		def at_exit():
 			print('Turning bias voltage off...')
 			self.bias_output_status = 'off'
+			self.invalidate_setpoints_cache('bias_output_status') # Report what the instrument really says.
 			print(f'Bias voltage is: {self.bias_output_status}.')
 			print('Turning laser off...')
 			self.laser_status = 'off'
+			self.invalidate_setpoints_cache('laser_status') # Report what the instrument really says.
 			print(f'Laser is: {self.laser_status}.')
 		if safe_mode == True:
 			atexit.register(at_exit)
 	
+	def _new_lock(self, name: str):
+		"""Returns a `threading.RLock`, or a `setup_profiler.TimedRLock`
+		reported as `name` if profiling is enabled."""
+		if self.profiler is None:
+			return threading.RLock()
+		return self.profiler.timed_lock(name)
+	
+	def dump_profile(self, directory):
+		"""If profiling is enabled, prints the statistics and writes them
+		in `directory` (see `SetupProfiler.dump`), otherwise does nothing."""
+		if self.profiler is None:
+			return
+		print(f'Time spent in each operation of the setup:\n{self.profiler.statistics_dataframe().to_string(index=False)}')
+		self.profiler.dump(directory)
+	
+	# Setpoints cache -------------------------------------------------
+	
+	def invalidate_setpoints_cache(self, name: str=None):
+		"""Forget the cached value of the setpoint `name` (e.g. `'laser_DAC'`)
+		so the next time it is read from the instrument. If `name` is `None`
+		all the setpoints are forgotten. Use this if something other than
+		this class may have changed the instruments, e.g. the output of
+		the Keithley turning off because of the compliance."""
+		if name is None:
+			self._setpoints_cache.clear()
+		else:
+			self._setpoints_cache.pop(name, None)
+	
+	def _read_setpoint(self, name: str, read_from_instrument):
+		"""Returns the cached value of the setpoint `name`, or reads it
+		calling `read_from_instrument()` if it is not cached or if
+		`verify_setpoints_on_read` is `True`."""
+		if name in self._setpoints_cache and not self.verify_setpoints_on_read:
+			return self._setpoints_cache[name]
+		value = read_from_instrument()
+		if name in self._setpoints_cache and value != self._setpoints_cache[name]:
+			warnings.warn(f'{repr(name)} was set to {repr(self._setpoints_cache[name])} but the instrument says it is {repr(value)}.')
+		self._setpoints_cache[name] = value
+		return value
+	
+	def _connect_instruments(self):
+		"""Creates the objects that talk to each instrument. Subclasses can
+		override this method to replace the hardware, e.g. by simulated
+		instruments (see `simulated_setup.py`)."""
+		# The imports are here so this module can be imported in a computer without the hardware packages installed.
+		import PyticularsTCT # https://github.com/SengerM/PyticularsTCT
+		from PyticularsTCT.find_ximc_stages import map_coordinates_to_serial_ports # https://github.com/SengerM/PyticularsTCT
+		import pyvisa
+		import TeledyneLeCroyPy # https://github.com/SengerM/TeledyneLeCroyPy
+		from keithley.Keithley2470 import Keithley2470SafeForLGADs # https://github.com/SengerM/keithley
+		from Pyro5.api import Proxy
+		# ~ import pydrs # https://github.com/SengerM/pydrs
+		from temperature_controller import SERVER_NAME
+		
+		self._LeCroy = TeledyneLeCroyPy.LeCroyWaveRunner(pyvisa.ResourceManager().open_resource('USB0::1535::4131::2810N60091::0::INSTR'))
+		# ~ self._drs4_evaluation_board = pydrs.get_board(0)
+		
+		stages_coordinates = {
+			'00003A48': 'x',
+			'00003A57': 'y',
+			'000038CE': 'z',
+		}
+		ports_dict = map_coordinates_to_serial_ports(stages_coordinates)
+		self._tct = PyticularsTCT.TCT(x_stage_port=ports_dict['x'], y_stage_port=ports_dict['y'], z_stage_port=ports_dict['z'])
+		
+		self._keithley = Keithley2470SafeForLGADs('USB0::1510::9328::04481179::0::INSTR', polarity = 'negative')
+		self._temperature_controller = Proxy(f'PYRONAME:{SERVER_NAME}')
+	
 	# Motorized xyz stages ---------------------------------------------
 	
+	@_timed('move_to')
 	def move_to(self, x=None, y=None, z=None):
-		"""Move the TCT stages to the specified position."""
+		"""Move the TCT stages to the specified position and wait until
+		they settle. Instead of waiting a fixed time, it waits for a time
+		proportional to the distance moved and then reads the position
+		until it is within tolerance of the target in each axis for some
+		consecutive readings, or until it stops changing for stages whose
+		readback does not agree with the target that well. The parameters are in `self.stages_settling`,
+		see `STAGES_SETTLING`, and the time it took is in `stages_settling_statistics`.
+		Returns the last position read, so there is no need to read it again."""
+		target = (x,y,z)
 		with self._tct_Lock:
 			self._tct.stages.move_to(x=x,y=y,z=z)
+			if self.profiler is None:
+				return self._wait_for_stages_to_settle(target)
+			with self.profiler.measure('stages settling'):
+				return self._wait_for_stages_to_settle(target)
+	
+	def _wait_for_stages_to_settle(self, target):
+		settling = self.stages_settling
+		tolerances = [settling['tolerance (m)'][axis] for axis in ['x','y','z']]
+		start = time.monotonic()
+		if self._stages_last_position is None: # Don't know where it was, only the readings will tell.
+			distance = 0
+		else:
+			distance = max([abs(t-p) for t,p in zip(target, self._stages_last_position) if t is not None] + [0])
+		sleep(min(settling['minimum time (s)'] + distance*settling['time per distance (s/m)'], settling['timeout (s)']))
+		n_readings_settled = 0
+		previous_position = None
+		while True:
+			position = self._tct.stages.position
+			self._stages_settling_counts['Number of position readings'] += 1
+			on_target = [t is None or abs(t-p) <= tolerance for t,p,tolerance in zip(target, position, tolerances)]
+			still = [previous_position is not None and abs(p-previous_p) <= settling['stillness tolerance (m)'] for p,previous_p in zip(position, previous_position or position)]
+			previous_position = position
+			if all(o or s for o,s in zip(on_target, still)):
+				n_readings_settled += 1
+			else:
+				n_readings_settled = 0
+			if n_readings_settled >= settling['consecutive readings']:
+				if not all(on_target):
+					self._stages_settling_counts['Number of times settled away from the target'] += 1
+					for axis, t, p, o in zip(['x','y','z'], target, position, on_target):
+						if not o:
+							self._warn_once_per_stage(axis, 'away from the target', f'The {axis} stage stopped at {p} m, {abs(t-p)*1e6:.3g} µm away from the target {t} m, which is more than its tolerance of {settling["tolerance (m)"][axis]*1e6:.3g} µm. Maybe the resolution of its readback is coarser, consider increasing `stages_settling["tolerance (m)"]["{axis}"]`. This is reported only once.')
+				break
+			if time.monotonic() - start > settling['timeout (s)']:
+				self._stages_settling_counts['Number of timeouts'] += 1
+				for axis, t, p, o, s in zip(['x','y','z'], target, position, on_target, still):
+					if not (o or s):
+						self._warn_once_per_stage(axis, 'timeout', f'The {axis} stage did not settle within {settling["timeout (s)"]} s, target position is {t} m and the position is {p} m. This is reported only once, see `stages_settling_statistics` for the number of timeouts.')
+				break
+			sleep(settling['poll period (s)'])
+		self._stages_settling_histogram.add(time.monotonic() - start)
+		self._stages_last_position = tuple(position)
+		return position
+	
+	def _warn_once_per_stage(self, axis: str, problem: str, message: str):
+		if (axis, problem) not in self._stages_settling_warned_axes:
+			self._stages_settling_warned_axes.add((axis, problem))
+			warnings.warn(message)
+	
+	def stages_settling_statistics(self):
+		"""Returns a dictionary with the statistics of the time waited
+		for the stages to settle after each movement, see `move_to`."""
+		return {**self._stages_settling_histogram.summary(), **self._stages_settling_counts}
 	
 	@property
+	@_timed('position')
 	def position(self):
 		"""Returns the position of the stages."""
 		with self._tct_Lock:
@@ -65,70 +226,90 @@ class TheSetup:
 	# Laser ------------------------------------------------------------
 	
 	@property
+	@_timed('laser_status')
 	def laser_status(self):
 		"""Return the laser status "on" or "off"."""
 		with self._tct_Lock:
-			return self._tct.laser.status
+			return self._read_setpoint('laser_status', lambda: self._tct.laser.status)
 	@laser_status.setter
+	@_timed('set laser_status')
 	def laser_status(self, status):
 		"""Set the laser status "on" or "off"."""
 		with self._tct_Lock:
+			self._setpoints_cache.pop('laser_status', None) # In case it fails.
 			self._tct.laser.status = status
+			self._setpoints_cache['laser_status'] = status
 	
 	@property
+	@_timed('laser_DAC')
 	def laser_DAC(self):
 		"""Returns the laser DAC value."""
 		with self._tct_Lock:
-			return self._tct.laser.DAC
+			return self._read_setpoint('laser_DAC', lambda: self._tct.laser.DAC)
 	@laser_DAC.setter
+	@_timed('set laser_DAC')
 	def laser_DAC(self, value):
 		"""Set the value of the DAC for the laser."""
 		with self._tct_Lock:
+			self._setpoints_cache.pop('laser_DAC', None) # In case it fails.
 			self._tct.laser.DAC = value
+			self._setpoints_cache['laser_DAC'] = value
 	
 	# Bias voltage power supply ----------------------------------------
 	
 	@property
+	@_timed('bias_voltage')
 	def bias_voltage(self):
 		"""Returns the measured bias voltage."""
 		with self._keithley_Lock:
 			return self._keithley.measure_voltage()
 	@bias_voltage.setter
+	@_timed('set bias_voltage')
 	def bias_voltage(self, volts):
 		"""Sets the bias voltage."""
 		with self._keithley_Lock:
 			self._keithley.set_source_voltage(volts)
 	
 	@property
+	@_timed('bias_current')
 	def bias_current(self):
 		"""Returns the measured bias current."""
 		with self._keithley_Lock:
 			return self._keithley.measure_current()
 	
 	@property
+	@_timed('current_compliance')
 	def current_compliance(self):
 		"""Returns the current limit of the voltage source."""
 		with self._keithley_Lock:
-			return self._keithley.current_limit
+			return self._read_setpoint('current_compliance', lambda: self._keithley.current_limit)
 	@current_compliance.setter
+	@_timed('set current_compliance')
 	def current_compliance(self, amperes):
 		"""Sets the current compliance."""
 		with self._keithley_Lock:
+			self._setpoints_cache.pop('current_compliance', None) # In case it fails.
 			self._keithley.current_limit = amperes
+			self._setpoints_cache['current_compliance'] = amperes
 	
 	@property
+	@_timed('bias_output_status')
 	def bias_output_status(self):
 		"""Returns either 'on' or 'off'."""
 		with self._keithley_Lock:
-			return self._keithley.output
+			return self._read_setpoint('bias_output_status', lambda: self._keithley.output)
 	@bias_output_status.setter
+	@_timed('set bias_output_status')
 	def bias_output_status(self, status: str):
 		"""Set the bias output either 'on' or 'off'."""
 		with self._keithley_Lock:
+			self._setpoints_cache.pop('bias_output_status', None) # In case it fails.
 			self._keithley.output = status
+			self._setpoints_cache['bias_output_status'] = status
 	
 	# Oscilloscope -----------------------------------------------------
 	
+	@_timed('configure_oscilloscope_for_two_pulses')
 	def configure_oscilloscope_for_two_pulses(self):
 		"""Configures the horizontal scale and trigger of the oscilloscope to properly acquire two pulses."""
 		with self._oscilloscope_Lock:
@@ -149,6 +330,7 @@ class TheSetup:
 			else:
 				raise RuntimeError('No oscilloscope found in the setup!')
 			
+	@_timed('wait_for_trigger')
 	def wait_for_trigger(self):
 		"""Blocks execution until there is a trigger in the oscilloscope."""
 		with self._oscilloscope_Lock:
@@ -159,6 +341,7 @@ class TheSetup:
 			else:
 				raise RuntimeError('No oscilloscope found in the setup!')
 	
+	@_timed('get_waveform')
 	def get_waveform(self, channel: int):
 		"""Gets the waveform from the oscilloscope for the respective channel."""
 		with self._oscilloscope_Lock:
@@ -171,6 +354,47 @@ class TheSetup:
 			else:
 				raise RuntimeError('No oscilloscope found in the setup!')
 	
+	@_timed('acquire_segments')
+	def acquire_segments(self, channels: list, n_segments: int):
+		"""Arms the oscilloscope in sequence mode for `n_segments` triggers,
+		waits until all of them have been acquired and downloads them in
+		a single transfer per channel. This is much faster than calling
+		`wait_for_trigger` and `get_waveform` for each trigger.
+		
+		Parameters
+		----------
+		channels: list
+			A list with the channels to download, e.g. `[1,2]`.
+		n_segments: int
+			Number of triggers to acquire.
+		
+		Returns
+		-------
+		waveforms: dict
+			A dictionary of the form `{n_channel: {'Time (s)': array, 'Amplitude (V)': array}}`
+			where each array has shape `(n_segments, n_samples)`.
+		"""
+		if not isinstance(n_segments, int) or n_segments < 1:
+			raise ValueError(f'`n_segments` must be a positive integer, received {repr(n_segments)}.')
+		with self._oscilloscope_Lock:
+			if hasattr(self, '_LeCroy'):
+				self._LeCroy.write(f'SEQUENCE ON,{n_segments}')
+				try:
+					self._LeCroy.wait_for_single_trigger() # In sequence mode this returns when all the segments were acquired.
+					waveforms = {}
+					for channel in channels:
+						raw_data = self._LeCroy.get_waveform(channel=channel) # In sequence mode all the segments come one after the other.
+						waveforms[channel] = {variable: np.reshape(np.asarray(raw_data[variable], dtype=float), (n_segments,-1)) for variable in ['Time (s)','Amplitude (V)']}
+						waveforms[channel]['Time (s)'] -= waveforms[channel]['Time (s)'][:,[0]] - waveforms[channel]['Time (s)'][0,0] # Refer the time of each segment to its own trigger, as for a single trigger.
+				finally:
+					self._LeCroy.write('SEQUENCE OFF')
+				return waveforms
+			elif hasattr(self, '_drs4_evaluation_board'):
+				raise NotImplementedError(f'Sequence mode is not implemented for the DRS4 Evaluation Board.')
+			else:
+				raise RuntimeError('No oscilloscope found in the setup!')
+	
+	@_timed('set_oscilloscope_vdiv')
 	def set_oscilloscope_vdiv(self, channel: int, vdiv: float):
 		"""Sets the osciloscope's Volts per division."""
 		with self._oscilloscope_Lock:
@@ -184,24 +408,133 @@ class TheSetup:
 	# Temperature and humidity sensor ----------------------------------
 	
 	@property
+	@_timed('temperature')
 	def temperature(self):
 		"""Returns a reading of the temperature as a float number in Celsius."""
-		try:
-			return self._temperature_controller.temperature
-		except AttributeError: # If there is no temperature sensor defined...
-			return float('NaN')
+		with self._temperature_humidity_sensor_Lock:
+			try:
+				self._claim_temperature_controller_ownership()
+				return self._temperature_controller.temperature
+			except AttributeError: # If there is no temperature sensor defined...
+				return float('NaN')
 	
 	@property
+	@_timed('humidity')
 	def humidity(self):
 		"""Returns a reading of the humidity as a float number in %RH."""
-		try:
-			return self._temperature_controller.humidity
-		except AttributeError: # If there is no humidity sensor defined...
-			return float('NaN')
+		with self._temperature_humidity_sensor_Lock:
+			try:
+				self._claim_temperature_controller_ownership()
+				return self._temperature_controller.humidity
+			except AttributeError: # If there is no humidity sensor defined...
+				return float('NaN')
 	
-if __name__ == '__main__':
-	import time
+	def _claim_temperature_controller_ownership(self):
+		"""The Pyro proxy can only be used by the thread that owns it, but
+		it is used from different threads (e.g. the slow readback sampler)."""
+		if hasattr(self._temperature_controller, '_pyroClaimOwnership'):
+			self._temperature_controller._pyroClaimOwnership() # https://github.com/irmen/Pyro5/blob/e7fa12954611e6504cbb443fdd1aeee65b35bb6b/examples/threadproxysharing/client.py
+	
+	# Slow readback sampler --------------------------------------------
+	
+	def start_slow_readback_sampler(self, period: float=1, quantities: list=None, history_length: int=3600):
+		"""Starts a background thread that measures quantities that are
+		slow to read (bias voltage, bias current, temperature and humidity)
+		every `period` seconds and stores them in a timestamped cache.
+		Then `slow_readbacks` returns the latest (or interpolated) values
+		instantly, so they can be used in the acquisition loops without
+		blocking. If the sampler is already running, nothing is done unless
+		new quantities are requested, in which case it is restarted.
+		
+		Parameters
+		----------
+		period: float, default 1
+			Time between two consecutive readings of each quantity, in seconds.
+		quantities: list, optional
+			List with the name of the properties to sample, any of
+			`SLOW_READBACK_QUANTITIES`. If `None` all of them are sampled.
+		history_length: int, default 3600
+			Number of readings of each quantity kept in memory.
+		"""
+		quantities = list(SLOW_READBACK_QUANTITIES) if quantities is None else list(quantities)
+		for quantity in quantities:
+			if quantity not in SLOW_READBACK_QUANTITIES:
+				raise ValueError(f'Cannot sample {repr(quantity)}, must be one of {set(SLOW_READBACK_QUANTITIES)}.')
+		if self.slow_readback_sampler_is_running:
+			if set(quantities) <= set(self._slow_readback_history):
+				return
+			quantities = list(dict.fromkeys(list(self._slow_readback_history) + quantities)) # Restart it sampling everything.
+			self.stop_slow_readback_sampler()
+		self._slow_readback_Lock = threading.Lock()
+		self._slow_readback_history = {quantity: collections.deque(maxlen=history_length) for quantity in quantities}
+		self._stop_slow_readback_sampler = threading.Event()
+		
+		def sample_once():
+			for quantity in quantities:
+				try:
+					value = getattr(self, quantity)
+				except Exception as e:
+					print(f'Cannot read {repr(quantity)} in the slow readback sampler, reason: {repr(e)}')
+					continue
+				with self._slow_readback_Lock:
+					self._slow_readback_history[quantity].append((time.time(), value))
+		
+		def thread_function():
+			while not self._stop_slow_readback_sampler.wait(period):
+				sample_once()
+		
+		sample_once() # So there are values from the very beginning.
+		self._slow_readback_sampler_thread = threading.Thread(target=thread_function, daemon=True)
+		self._slow_readback_sampler_thread.start()
 	
+	def stop_slow_readback_sampler(self):
+		"""Stops the background thread started by `start_slow_readback_sampler`."""
+		if not self.slow_readback_sampler_is_running:
+			return
+		self._stop_slow_readback_sampler.set()
+		self._slow_readback_sampler_thread.join()
+	
+	@property
+	def slow_readback_sampler_is_running(self):
+		return hasattr(self, '_slow_readback_sampler_thread') and self._slow_readback_sampler_thread.is_alive()
+	
+	def slow_readback(self, quantity: str, when: float=None):
+		"""Returns the value of `quantity` from the cache of the slow readback
+		sampler, without talking to the instruments.
+		
+		Parameters
+		----------
+		quantity: str
+			Name of the quantity, e.g. `'bias_voltage'`.
+		when: float, optional
+			A timestamp as returned by `time.time()`. If given, the value
+			is linearly interpolated between the readings before and after.
+			If `None` the latest reading is returned.
+		"""
+		if not hasattr(self, '_slow_readback_history') or quantity not in self._slow_readback_history:
+			raise RuntimeError(f'{repr(quantity)} is not being sampled, use `start_slow_readback_sampler` first.')
+		with self._slow_readback_Lock:
+			history = self._slow_readback_history[quantity]
+			if len(history) == 0:
+				return float('NaN')
+			if when is None:
+				return history[-1][1]
+			after = None
+			for before in reversed(history): # `when` is usually very recent, so only the newest readings are visited.
+				if before[0] <= when:
+					break
+				after = before
+		if after is None or before[0] > when: # After the newest or before the oldest reading.
+			return float(before[1])
+		return float(np.interp(when, [before[0], after[0]], [before[1], after[1]]))
+	
+	def slow_readbacks(self, when: float=None):
+		"""Returns a dictionary of the form `{'Bias voltage (V)': value, ...}`
+		with all the quantities that are being sampled by the slow readback
+		sampler. See `slow_readback` for the meaning of `when`."""
+		return {SLOW_READBACK_QUANTITIES[quantity]: self.slow_readback(quantity, when) for quantity in self._slow_readback_history}
+	
+if __name__ == '__main__':
 	the_setup = TheSetup()
 	
 	print(f'Temperature = {the_setup.temperature:.2f} °C, humidity = {the_setup.humidity:.2f} %RH')
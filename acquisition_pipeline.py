@@ -0,0 +1,252 @@
+import threading
+import queue
+import time
+from contextlib import contextmanager
+
+class StageCounter:
+	"""Counts how many items a stage of the pipeline has processed and
+	how much time it spent doing it, so the throughput of each stage
+	can be compared."""
+	def __init__(self, name: str):
+		self.name = name
+		self._lock = threading.Lock()
+		self._n_items = 0
+		self._busy_seconds = 0
+		self._blocked_seconds = 0
+		self._started_when = time.monotonic()
+
+	@contextmanager
+	def measure(self, n_items: int=1):
+		"""Use as `with counter.measure(): do_stuff()` to add the time spent in `do_stuff` to this stage."""
+		start = time.monotonic()
+		try:
+			yield
+		finally:
+			with self._lock:
+				self._busy_seconds += time.monotonic() - start
+				self._n_items += n_items
+
+	def add_blocked_time(self, seconds: float):
+		"""Adds time in which this stage was blocked waiting for the next stage."""
+		with self._lock:
+			self._blocked_seconds += seconds
+
+	@property
+	def n_items(self):
+		return self._n_items
+
+	def summary(self):
+		"""Returns a dictionary with the statistics of this stage."""
+		with self._lock:
+			elapsed_seconds = time.monotonic() - self._started_when
+			return {
+				'Stage': self.name,
+				'Number of items': self._n_items,
+				'Busy time (s)': self._busy_seconds,
+				'Blocked time (s)': self._blocked_seconds,
+				'Items per second while busy': self._n_items/self._busy_seconds if self._busy_seconds > 0 else float('NaN'),
+				'Items per second overall': self._n_items/elapsed_seconds if elapsed_seconds > 0 else float('NaN'),
+			}
+
+def split_in_pulses(raw_data: dict, n_pulses: int=2):
+	"""Given a waveform from the oscilloscope, e.g. `{'Time (s)': [...], 'Amplitude (V)': [...]}`,
+	splits it in `n_pulses` waveforms of equal length. Returns a dictionary
+	of the form `{1: {'Time (s)': [...], 'Amplitude (V)': [...]}, 2: {...}, ...}`."""
+	raw_data_each_pulse = {}
+	for n_pulse in range(1, n_pulses+1):
+		raw_data_each_pulse[n_pulse] = {}
+		for variable in ['Time (s)','Amplitude (V)']:
+			n_samples_per_pulse = int(len(raw_data[variable])/n_pulses)
+			raw_data_each_pulse[n_pulse][variable] = raw_data[variable][(n_pulse-1)*n_samples_per_pulse:n_pulse*n_samples_per_pulse if n_pulse < n_pulses else len(raw_data[variable])]
+	return raw_data_each_pulse
+
+_END_OF_STREAM = object()
+
+class AcquisitionPipeline:
+	"""Producer/consumer pipeline to decouple the instruments from the
+	processing and storage of the data. The thread that talks to the
+	instruments (the "acquisition" stage) only puts raw events in a bounded
+	queue using `put_event`, and returns immediately to the instruments.
+	A "processing" thread splits each waveform in pulses and attaches the
+	metadata, and a "writing" thread stores them in a `WaveformsStoreWriter`.
+	The queues are bounded so if the disk is slower than the instruments
+	the acquisition stage is blocked instead of using all the memory.
+	If the store has `checkpoint_columns`, each event is checkpointed
+	after all its waveforms were appended, and `n_waveform` continues
+	from the last one in the store, so resumed measurements just work.
+
+	Usage:
+	```
+	with AcquisitionPipeline(waveforms_store) as pipeline:
+		for ...:
+			with pipeline.counters['acquisition'].measure():
+				raw_waveforms = {n_channel: the_setup.get_waveform(n_channel) for n_channel in channels}
+			pipeline.put_event(metadata = {'n_position': ..., ...}, raw_waveforms = raw_waveforms)
+	print(pipeline.statistics())
+	```
+	"""
+	def __init__(self, waveforms_store, n_pulses: int=2, max_events_in_queue: int=1000, waveforms_averager=None):
+		"""
+		Parameters
+		----------
+		waveforms_store: WaveformsStoreWriter
+			Where the waveforms will be written.
+		n_pulses: int, default 2
+			Number of pulses in which each waveform is split.
+		max_events_in_queue: int, default 1000
+			Maximum number of events waiting to be processed. When reached,
+			`put_event` blocks until there is space again.
+		waveforms_averager: utils.WaveformsAverager, optional
+			If given, each waveform is added to it in the processing thread
+			after being split in pulses, so the average waveforms are
+			computed while measuring without reading the samples again.
+		"""
+		self._waveforms_store = waveforms_store
+		self.n_pulses = n_pulses
+		self.waveforms_averager = waveforms_averager
+		self._events_queue = queue.Queue(maxsize=max_events_in_queue)
+		self._waveforms_queue = queue.Queue(maxsize=max_events_in_queue)
+		self.counters = {name: StageCounter(name) for name in ['acquisition','processing','writing']}
+		self._n_waveform = waveforms_store.next_n_waveform
+		self._n_events_put = 0
+		self._n_events_processed = 0
+		self._processed_condition = threading.Condition()
+		self._exception = None
+		self._threads = [
+			threading.Thread(target=self._processing_thread_function, name='processing', daemon=True),
+			threading.Thread(target=self._writing_thread_function, name='writing', daemon=True),
+		]
+		self._started = False
+		self._closed = False
+
+	def start(self):
+		if self._started:
+			return
+		for thread in self._threads:
+			thread.start()
+		self._started = True
+
+	def put_event(self, metadata: dict, raw_waveforms: dict):
+		"""Put a new event (i.e. one trigger) into the pipeline.
+
+		Parameters
+		----------
+		metadata: dict
+			Metadata common to all the waveforms in this event, e.g. `{'n_position': 0, 'n_trigger': 0, 'x (m)': ..., ...}`.
+		raw_waveforms: dict
+			A dictionary of the form `{n_channel: raw_data}` where `raw_data`
+			is what `TheSetup.get_waveform` returns.
+		"""
+		self._raise_if_a_worker_failed()
+		if self._closed:
+			raise RuntimeError(f'This instance of {repr(AcquisitionPipeline)} was already closed! You cannot use it anymore.')
+		self.start()
+		self._put(self._events_queue, (metadata, raw_waveforms), self.counters['acquisition'])
+		self._n_events_put += 1
+
+	def close(self):
+		"""Waits until all the events have been processed and written, then stops the worker threads."""
+		if self._closed:
+			return
+		self._closed = True
+		if self._started:
+			self._put(self._events_queue, _END_OF_STREAM, self.counters['acquisition'])
+			for thread in self._threads:
+				thread.join()
+		self._raise_if_a_worker_failed()
+
+	def wait_until_processed(self):
+		"""Blocks until all the events put so far went through the processing
+		stage, so e.g. `waveforms_averager` already has all of them. They may
+		still be waiting to be written."""
+		with self._processed_condition:
+			while self._n_events_processed < self._n_events_put:
+				self._raise_if_a_worker_failed()
+				self._processed_condition.wait(timeout=1)
+		self._raise_if_a_worker_failed()
+
+	def statistics(self):
+		"""Returns a list of dictionaries with the statistics of each stage."""
+		return [counter.summary() for counter in self.counters.values()]
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else: # Don't hide the original exception, but still try to save everything that was already acquired.
+			try:
+				self.close()
+			except Exception as e:
+				print(f'Cannot close the acquisition pipeline, reason: {repr(e)}')
+
+	def _put(self, destination_queue, item, counter):
+		"""Put `item` in the queue, counting the time it was blocked because the queue was full."""
+		start = time.monotonic()
+		while True:
+			try:
+				destination_queue.put(item, timeout=1)
+				break
+			except queue.Full:
+				if self._exception is not None: # The consumer is dead, this will never be unblocked.
+					self._raise_if_a_worker_failed()
+		counter.add_blocked_time(time.monotonic() - start)
+
+	def _raise_if_a_worker_failed(self):
+		if self._exception is not None:
+			raise RuntimeError(f'A worker thread of the acquisition pipeline failed, reason: {repr(self._exception)}') from self._exception
+
+	def _processing_thread_function(self):
+		try:
+			while True:
+				event = self._events_queue.get()
+				if event is _END_OF_STREAM:
+					break
+				metadata, raw_waveforms = event
+				with self.counters['processing'].measure():
+					waveforms = []
+					for n_channel, raw_data in raw_waveforms.items():
+						raw_data_each_pulse = split_in_pulses(raw_data, self.n_pulses)
+						for n_pulse in raw_data_each_pulse:
+							waveforms.append(
+								(
+									{**metadata, 'n_channel': n_channel, 'n_pulse': n_pulse},
+									raw_data_each_pulse[n_pulse]['Time (s)'],
+									raw_data_each_pulse[n_pulse]['Amplitude (V)'],
+								)
+							)
+					if self.waveforms_averager is not None:
+						for waveform_metadata, time_samples, amplitude_samples in waveforms:
+							self.waveforms_averager.add(waveform_metadata, time_samples, amplitude_samples)
+				with self._processed_condition:
+					self._n_events_processed += 1
+					self._processed_condition.notify_all()
+				self._put(self._waveforms_queue, (metadata, waveforms), self.counters['processing'])
+		except Exception as e:
+			self._exception = e
+		finally:
+			self._waveforms_queue.put(_END_OF_STREAM)
+
+	def _writing_thread_function(self):
+		try:
+			while True:
+				item = self._waveforms_queue.get()
+				if item is _END_OF_STREAM:
+					break
+				event_metadata, waveforms = item
+				with self.counters['writing'].measure(n_items=len(waveforms)):
+					for metadata, time_samples, amplitude_samples in waveforms:
+						self._waveforms_store.append(
+							metadata = {'n_waveform': self._n_waveform, **metadata},
+							time = time_samples,
+							amplitude = amplitude_samples,
+						)
+						self._n_waveform += 1
+					if self._waveforms_store.checkpoint_columns is not None:
+						self._waveforms_store.checkpoint(event_metadata)
+		except Exception as e:
+			self._exception = e
+			while self._waveforms_queue.get() is not _END_OF_STREAM: # Unblock the processing thread.
+				pass
@@ -0,0 +1,319 @@
+import numpy as np
+import warnings
+
+def _last_true_index(condition):
+	"""Given a 2D boolean array returns, for each row, the index of the last
+	`True` element or -1 if there is none."""
+	n_columns = condition.shape[1]
+	index = n_columns - 1 - np.argmax(condition[:,::-1], axis=1)
+	return np.where(condition.any(axis=1), index, -1)
+
+def _first_true_index(condition):
+	"""Given a 2D boolean array returns, for each row, the index of the first
+	`True` element or -1 if there is none."""
+	index = np.argmax(condition, axis=1)
+	return np.where(condition.any(axis=1), index, -1)
+
+class BatchOfPeakSignals:
+	"""Vectorized version of `signals.PeakSignal.PeakSignal` for many
+	waveforms at once. Instead of creating one `PeakSignal` for each waveform
+	and computing each feature in a Python loop, all the features are
+	computed for the whole batch with numpy operations over 2D arrays of
+	shape `(n_waveforms, n_samples)`.
+
+	The definitions follow `PeakSignal`:
+	- The peak start is the last sample before the peak that is not above
+	  (i.e. `<=`) the median of the samples before the peak plus their
+	  standard deviation.
+	- Baseline and noise are the mean and standard deviation of
+	  `samples[:peak_start_index-1]`.
+	- Amplitude is the maximum of the signal minus the baseline.
+	- The time at some percentage of the rising (falling) edge is found
+	  walking from the peak backwards (forward) until the signal goes below
+	  that percentage of the amplitude, and linearly interpolating between
+	  the two samples at each side of the threshold.
+	- Time over noise is the time between the rising and falling edges
+	  crossing the noise level. If the noise is larger than the amplitude
+	  it is `NaN`.
+	- The collected charge is the integral of the signal minus the baseline,
+	  with linear interpolation between samples, between the rising and falling
+	  edges crossing the noise level.
+	Features that cannot be computed for some waveform are `NaN`.
+
+	Waveforms shorter than `n_samples` must be padded with `NaN` at the end.
+
+	The results are compared, feature by feature, with those of `PeakSignal`
+	for a fixed set of waveforms in `tests/test_batch_feature_extraction.py`.
+	The reference features are produced by `tests/make_peak_signal_reference.py`,
+	run it again if `PeakSignal` changes.
+	"""
+	def __init__(self, time, samples):
+		"""
+		Parameters
+		----------
+		time: array like
+			2D array of shape `(n_waveforms, n_samples)` with the time of each sample.
+		samples: array like
+			2D array of shape `(n_waveforms, n_samples)` with the amplitude of each sample.
+		"""
+		self.time = np.array(time, dtype=float, ndmin=2)
+		self.samples = np.array(samples, dtype=float, ndmin=2)
+		if self.time.shape != self.samples.shape or self.time.ndim != 2:
+			raise ValueError(f'`time` and `samples` must be 2D arrays with the same shape, received arrays with shapes {self.time.shape} and {self.samples.shape}.')
+		self._indices = np.arange(self.samples.shape[1])[np.newaxis,:]
+		self._rows = np.arange(self.samples.shape[0])
+
+	def __len__(self):
+		return self.samples.shape[0]
+
+	@property
+	def peak_index(self):
+		if not hasattr(self, '_peak_index'):
+			self._peak_index = np.argmax(np.nan_to_num(self.samples, nan=-np.inf), axis=1)
+		return self._peak_index
+
+	@property
+	def peak_start_index(self):
+		"""Index of the sample where the peak starts for each waveform, or -1 if it cannot be found."""
+		if not hasattr(self, '_peak_start_index'):
+			before_peak = self._indices < self.peak_index[:,np.newaxis]
+			samples_before_peak = np.where(before_peak, self.samples, float('NaN'))
+			with warnings.catch_warnings(): # Waveforms with the peak in the first sample produce "all NaN slice" warnings, and NaN which is what we want.
+				warnings.simplefilter('ignore', category=RuntimeWarning)
+				median_before_peak = np.nanmedian(samples_before_peak, axis=1)
+				std_before_peak = np.nanstd(samples_before_peak, axis=1)
+			self._peak_start_index = _last_true_index(before_peak & (self.samples <= (median_before_peak+std_before_peak)[:,np.newaxis]))
+		return self._peak_start_index
+
+	@property
+	def n_samples(self):
+		"""Number of samples of each waveform, without the `NaN` padding at the end."""
+		if not hasattr(self, '_n_samples'):
+			self._n_samples = _last_true_index(~np.isnan(self.samples)) + 1
+		return self._n_samples
+
+	def _is_before_peak_start(self):
+		"""Mask of the samples used for the baseline and the noise, i.e.
+		`samples[:peak_start_index-1]` as in `PeakSignal`. As a Python slice,
+		if the peak starts in the first sample these are all the samples
+		but the last one."""
+		stop = np.where(self.peak_start_index >= 1, self.peak_start_index-1, self.n_samples-1)
+		stop = np.where(self.peak_start_index == -1, 0, stop)
+		return self._indices < stop[:,np.newaxis]
+
+	@property
+	def baseline(self):
+		if not hasattr(self, '_baseline'):
+			is_before_peak_start = self._is_before_peak_start()
+			with np.errstate(divide='ignore', invalid='ignore'):
+				self._baseline = np.where(is_before_peak_start, self.samples, 0).sum(axis=1)/is_before_peak_start.sum(axis=1)
+		return self._baseline
+
+	@property
+	def noise(self):
+		"""Standard deviation (`np.std`, i.e. with `ddof=0`) of the samples before the peak start."""
+		if not hasattr(self, '_noise'):
+			is_before_peak_start = self._is_before_peak_start()
+			with np.errstate(divide='ignore', invalid='ignore'):
+				self._noise = (np.where(is_before_peak_start, (self.samples-self.baseline[:,np.newaxis])**2, 0).sum(axis=1)/is_before_peak_start.sum(axis=1))**.5
+		return self._noise
+
+	@property
+	def amplitude(self):
+		if not hasattr(self, '_amplitude'):
+			self._amplitude = self.samples[self._rows,self.peak_index] - self.baseline
+		return self._amplitude
+
+	def _level(self, threshold):
+		"""Returns the value of the samples at `threshold` % of the amplitude, for each waveform. `threshold` can be a number or an array with one number per waveform.
+		Thresholds out of `[0,100]` give `NaN`, as `PeakSignal` cannot find them either."""
+		threshold = np.asarray(threshold, dtype=float)
+		with np.errstate(invalid='ignore'):
+			is_valid = (threshold >= 0) & (threshold <= 100)
+		return np.where(is_valid, self.baseline + self.amplitude*threshold/100, float('NaN'))
+
+	def _interpolate_time(self, index_below, index_above, level):
+		"""Linear interpolation of the time at which the signal is at `level` between the samples `index_below` and `index_above`."""
+		valid = (index_below >= 0) & (index_above >= 0) & (index_above < self.samples.shape[1])
+		index_below = np.where(valid, index_below, 0)
+		index_above = np.where(valid, index_above, 0)
+		t_below = self.time[self._rows,index_below]
+		t_above = self.time[self._rows,index_above]
+		y_below = self.samples[self._rows,index_below]
+		y_above = self.samples[self._rows,index_above]
+		with np.errstate(divide='ignore', invalid='ignore'):
+			t = t_below + (level-y_below)*(t_above-t_below)/(y_above-y_below)
+		return np.where(valid, t, float('NaN'))
+
+	def _rising_edge_index_below(self, level):
+		"""For each waveform, index of the last sample before the peak that is below `level`."""
+		return _last_true_index((self._indices < self.peak_index[:,np.newaxis]) & (self.samples < level[:,np.newaxis]))
+
+	def _falling_edge_index_below(self, level):
+		"""For each waveform, index of the first sample after the peak that is below `level`."""
+		return _first_true_index((self._indices > self.peak_index[:,np.newaxis]) & (self.samples < level[:,np.newaxis]))
+
+	def find_time_at_rising_edge(self, threshold):
+		"""Returns an array with the time at which each signal crosses `threshold` (in %) within the rising edge."""
+		level = self._level(threshold)
+		index_below = self._rising_edge_index_below(level)
+		return self._interpolate_time(index_below, np.where(index_below>=0, index_below+1, -1), level)
+
+	def find_time_at_falling_edge(self, threshold):
+		"""Returns an array with the time at which each signal crosses `threshold` (in %) within the falling edge."""
+		level = self._level(threshold)
+		index_below = self._falling_edge_index_below(level)
+		return self._interpolate_time(np.where(index_below>=0, index_below-1, -1), index_below, level)
+
+	def find_time_over_threshold(self, threshold):
+		"""Returns an array with the time each signal spends over `threshold` (in %)."""
+		return self.find_time_at_falling_edge(threshold) - self.find_time_at_rising_edge(threshold)
+
+	@property
+	def rise_time(self):
+		if not hasattr(self, '_rise_time'):
+			self._rise_time = self.find_time_at_rising_edge(90) - self.find_time_at_rising_edge(10)
+		return self._rise_time
+
+	@property
+	def _noise_threshold(self):
+		"""The noise level in percentage of the amplitude, for each waveform."""
+		with np.errstate(divide='ignore', invalid='ignore'):
+			return self.noise/self.amplitude*100
+
+	@property
+	def time_over_noise(self):
+		if not hasattr(self, '_time_over_noise'):
+			self._time_over_noise = self.find_time_over_threshold(self._noise_threshold)
+		return self._time_over_noise
+
+	@property
+	def peak_integral(self):
+		if not hasattr(self, '_peak_integral'):
+			level = self._level(self._noise_threshold)
+			rising_index_below = self._rising_edge_index_below(level)
+			falling_index_below = self._falling_edge_index_below(level)
+			t_start = self.find_time_at_rising_edge(self._noise_threshold)
+			t_stop = self.find_time_at_falling_edge(self._noise_threshold)
+			valid = (rising_index_below >= 0) & (falling_index_below >= 0) & ~np.isnan(t_start) & ~np.isnan(t_stop)
+			first_inside = np.where(valid, rising_index_below+1, 0) # First sample over the level.
+			last_inside = np.where(valid, falling_index_below-1, 0) # Last sample over the level.
+			y = self.samples - self.baseline[:,np.newaxis]
+			# Integral between the first and last samples over the level, using the trapezoidal rule ---
+			cumulative_integral = np.concatenate(
+				[np.zeros((len(self),1)), np.nancumsum((y[:,1:]+y[:,:-1])/2*np.diff(self.time, axis=1), axis=1)],
+				axis = 1,
+			)
+			integral = cumulative_integral[self._rows,last_inside] - cumulative_integral[self._rows,first_inside]
+			# Add the pieces between the crossing of the level and the first and last samples over it ---
+			level_minus_baseline = level - self.baseline
+			integral += (level_minus_baseline + y[self._rows,first_inside])/2*(self.time[self._rows,first_inside]-t_start)
+			integral += (level_minus_baseline + y[self._rows,last_inside])/2*(t_stop-self.time[self._rows,last_inside])
+			self._peak_integral = np.where(valid, integral, float('NaN'))
+		return self._peak_integral
+
+FEATURES_ATTRIBUTES = {
+	'Amplitude (V)': 'amplitude',
+	'Noise (V)': 'noise',
+	'Rise time (s)': 'rise_time',
+	'Collected charge (V s)': 'peak_integral',
+	'Time over noise (s)': 'time_over_noise',
+}
+
+def extract_features(time, samples, times_at: list, features: list=None):
+	"""Computes all the features of many waveforms at once.
+
+	Parameters
+	----------
+	time: array like
+		2D array of shape `(n_waveforms, n_samples)`.
+	samples: array like
+		2D array of shape `(n_waveforms, n_samples)`.
+	times_at: list
+		List of percentages for which to find the time at the rising edge, e.g. `[10,20,...,90]`.
+	features: list, optional
+		If given, only these features are computed, e.g. `['Amplitude (V)', 't_50 (s)']`.
+
+	Returns
+	-------
+	features: dict
+		A dictionary of the form `{'Amplitude (V)': array, ...}` where
+		each array has one element per waveform. The keys are the same
+		columns produced by `parse_waveforms_from_scan_1D`.
+	"""
+	signals = BatchOfPeakSignals(time=time, samples=samples)
+	all_features = list(FEATURES_ATTRIBUTES) + [f't_{pp} (s)' for pp in times_at]
+	extracted = {}
+	for feature in (all_features if features is None else features):
+		if feature in FEATURES_ATTRIBUTES:
+			extracted[feature] = getattr(signals, FEATURES_ATTRIBUTES[feature])
+		elif feature in all_features:
+			extracted[feature] = signals.find_time_at_rising_edge(times_at[all_features.index(feature)-len(FEATURES_ATTRIBUTES)])
+		else:
+			raise ValueError(f'Unknown feature {repr(feature)}, available features are {all_features}.')
+	return extracted
+
+if __name__ == '__main__':
+	# Benchmark and comparison against `PeakSignal`.
+	import argparse
+	import time as time_module
+	import pandas
+	from simulated_setup import SimulatedLeCroyWaveRunner
+
+	parser = argparse.ArgumentParser(description='Compares the batch feature extraction against `PeakSignal`, both in results and speed, using simulated waveforms.')
+	parser.add_argument('--n_waveforms',
+		help = 'Number of waveforms to use.',
+		dest = 'n_waveforms',
+		type = int,
+		default = 3333,
+	)
+	args = parser.parse_args()
+
+	TIMES_AT = [10,20,30,40,50,60,70,80,90]
+
+	oscilloscope = SimulatedLeCroyWaveRunner(seed=0)
+	samples = oscilloscope.signal(channel=1, n_waveforms=args.n_waveforms)[:,:int(oscilloscope.n_samples/2)] # Keep only the first pulse.
+	time = np.tile(oscilloscope.time[:int(oscilloscope.n_samples/2)], (args.n_waveforms,1))
+
+	start = time_module.monotonic()
+	batch_features = extract_features(time, samples, TIMES_AT)
+	batch_seconds = time_module.monotonic() - start
+	print(f'Batch feature extraction: {args.n_waveforms/batch_seconds:.0f} waveforms/s')
+
+	try:
+		from signals.PeakSignal import PeakSignal # https://github.com/SengerM/signals
+	except ImportError:
+		raise ImportError('Cannot import `PeakSignal` from https://github.com/SengerM/signals, so the batch feature extraction cannot be compared with it.')
+
+	start = time_module.monotonic()
+	peak_signal_features = []
+	for t, s in zip(time, samples):
+		signal = PeakSignal(time=t, samples=s)
+		features = {
+			'Amplitude (V)': signal.amplitude,
+			'Noise (V)': signal.noise,
+			'Rise time (s)': signal.rise_time,
+			'Collected charge (V s)': signal.peak_integral,
+			'Time over noise (s)': signal.time_over_noise,
+		}
+		for pp in TIMES_AT:
+			try:
+				features[f't_{pp} (s)'] = signal.find_time_at_rising_edge(pp)
+			except Exception:
+				features[f't_{pp} (s)'] = float('NaN')
+		peak_signal_features.append(features)
+	peak_signal_seconds = time_module.monotonic() - start
+	print(f'PeakSignal one by one: {args.n_waveforms/peak_signal_seconds:.0f} waveforms/s')
+	print(f'Speed up: {peak_signal_seconds/batch_seconds:.1f}')
+
+	peak_signal_features = pandas.DataFrame.from_records(peak_signal_features)
+	batch_features = pandas.DataFrame(batch_features)
+	comparison = pandas.DataFrame(
+		{
+			'Max abs difference': (batch_features-peak_signal_features).abs().max(),
+			'Median abs difference': (batch_features-peak_signal_features).abs().median(),
+			'Typical value': peak_signal_features.abs().median(),
+		}
+	)
+	comparison['Relative difference'] = comparison['Median abs difference']/comparison['Typical value']
+	print(comparison)
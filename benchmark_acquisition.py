@@ -0,0 +1,356 @@
+"""Benchmarks of the acquisition loops of `scan_1D` and `scan_laser_intensity`
+running against `SimulatedTheSetup`, with the latencies of the instruments
+in `simulated_setup.DEFAULT_LATENCIES`. The results are saved in a JSON file
+so they can be compared with a previous run, e.g.
+```
+python3 benchmark_acquisition.py --output before.json
+# ... change something ...
+python3 benchmark_acquisition.py --output after.json --compare before.json
+```
+"""
+
+import numpy as np
+import pandas
+from pathlib import Path
+import datetime
+import time
+import json
+import sys
+import os
+import platform
+import subprocess
+import resource
+import tempfile
+import shutil
+import multiprocessing
+import threading
+from contextlib import redirect_stdout, ExitStack # https://stackoverflow.com/a/34798330/8849755
+from concurrent.futures import ProcessPoolExecutor
+
+BENCHMARKS = {
+	# name: keyword arguments for `run_benchmark`.
+	'scan_1D': dict(script='scan_1D', n_positions=11, n_triggers=33),
+	'scan_1D in sequence mode': dict(script='scan_1D', n_positions=11, n_triggers=33, use_sequence_mode=True),
+	'scan_laser_intensity': dict(script='scan_laser_intensity', n_positions=5, n_triggers=33),
+	'scan_laser_intensity with analysis workers': dict(script='scan_laser_intensity', n_positions=5, n_triggers=33, analysis_workers=2),
+}
+
+def peak_RSS(who=resource.RUSAGE_SELF):
+	"""Returns the peak resident set size, in bytes, of this process
+	(`who=resource.RUSAGE_SELF`) or of the largest of its child processes
+	that already finished (`who=resource.RUSAGE_CHILDREN`)."""
+	peak = resource.getrusage(who).ru_maxrss
+	return peak if sys.platform == 'darwin' else peak*1024 # Linux reports it in kilobytes.
+
+def process_tree_RSS(pid: int=None):
+	"""Returns the sum of the resident set size, in bytes, of the process
+	`pid` (default this one) and all its descendants, e.g. the analysis
+	workers. Reads `/proc`, so it returns `None` where it does not exist."""
+	pid = os.getpid() if pid is None else pid
+	if not Path('/proc').is_dir():
+		return None
+	children = {}
+	rss = {}
+	for status_path in Path('/proc').glob('[0-9]*/status'):
+		try:
+			status = dict(line.split(':', 1) for line in status_path.read_text().splitlines() if ':' in line)
+		except OSError: # The process finished while reading.
+			continue
+		process_pid = int(status_path.parent.name)
+		children.setdefault(int(status['PPid']), []).append(process_pid)
+		rss[process_pid] = int(status['VmRSS'].split()[0])*1024 if 'VmRSS' in status else 0 # In kilobytes.
+	total = 0
+	pending = [pid]
+	while len(pending) > 0:
+		process_pid = pending.pop()
+		total += rss.get(process_pid, 0)
+		pending += children.get(process_pid, [])
+	return total
+
+class ProcessTreePeakRSS:
+	"""Samples `process_tree_RSS` in a background thread and keeps the
+	peak, use as `with ProcessTreePeakRSS() as sampler: ...` and then
+	`sampler.peak`, which is `None` if it cannot be measured."""
+	def __init__(self, period: float=.1):
+		self.period = period
+		self.peak = None
+		self._stop = threading.Event()
+
+	def _sample(self):
+		rss = process_tree_RSS()
+		if rss is not None:
+			self.peak = rss if self.peak is None else max(self.peak, rss)
+
+	def _thread_function(self):
+		while not self._stop.wait(self.period):
+			self._sample()
+
+	def __enter__(self):
+		self._sample()
+		self._thread = threading.Thread(target=self._thread_function, daemon=True)
+		self._thread.start()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._stop.set()
+		self._thread.join()
+		self._sample()
+
+def directory_size(path: Path):
+	"""Returns the total size, in bytes, of the files inside `path`."""
+	return sum(p.stat().st_size for p in Path(path).rglob('*') if p.is_file())
+
+def read_statistics_files(measurement_base_path: Path):
+	"""Reads all the `*_statistics.csv` files that the scripts leave in the
+	measurement directory, e.g. `acquisition_pipeline_statistics.csv`, and
+	returns a dictionary of the form `{file_stem: [row_dict, ...]}`."""
+	statistics = {}
+	for path in sorted(Path(measurement_base_path).rglob('*_statistics.csv')):
+		statistics[path.stem] = pandas.read_csv(path).to_dict(orient='records')
+	return statistics
+
+def run_benchmark(script: str, data_directory: Path, n_positions: int, n_triggers: int, use_sequence_mode: bool=False, analysis_workers: int=0, latencies: dict=None, seed: int=0, verbose: bool=False):
+	"""Runs one measurement with `SimulatedTheSetup` and measures it. This
+	function is intended to be run in its own process, so the peak RSS
+	corresponds to this measurement only.
+
+	Parameters
+	----------
+	script: str
+		Either `'scan_1D'` or `'scan_laser_intensity'`.
+	data_directory: Path
+		Where to store the measurement.
+	n_positions: int
+		Number of positions for `scan_1D`, or number of laser DAC values for
+		`scan_laser_intensity`.
+	n_triggers: int
+		Number of triggers at each position or DAC value.
+	use_sequence_mode: bool, default False
+		Passed to `script_core`.
+	analysis_workers: int, default 0
+		Passed to `script_core` of `scan_laser_intensity`.
+	latencies: dict, optional
+		Passed to `SimulatedTheSetup`.
+	seed: int, default 0
+		Passed to `SimulatedTheSetup`.
+	verbose: bool, default False
+		If `False` the output of the script is discarded.
+
+	Returns
+	-------
+	results: dict
+		A dictionary with the measured quantities.
+	"""
+	import tct_scripts_config
+	from simulated_setup import SimulatedTheSetup
+
+	tct_scripts_config.DATA_STORAGE_DIRECTORY_PATH = Path(data_directory) # So nothing is written with the real measurements.
+	measurement_name = f'benchmark_{script}_{datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")}'
+	phases_seconds = {}
+
+	start = time.monotonic()
+	the_setup = SimulatedTheSetup(latencies=latencies, seed=seed, profile=True) # The profile of the setup is saved by the scripts, and then read as one more stage.
+	phases_seconds['Connect instruments'] = time.monotonic() - start
+
+	with open(os.devnull, 'w') as devnull, redirect_stdout(devnull) if not verbose else ExitStack(), ProcessTreePeakRSS() as process_tree_peak_RSS:
+		if script == 'scan_1D':
+			from scan_1D import script_core, post_process
+			center = the_setup.device.center
+			positions = [center + np.array((x,0,0)) for x in np.linspace(-50e-6, 50e-6, n_positions)]
+			start = time.monotonic()
+			measurement_base_path = script_core(
+				measurement_name = measurement_name,
+				the_setup = the_setup,
+				bias_voltage = 200,
+				laser_DAC = 0,
+				positions = positions,
+				n_triggers = n_triggers,
+				acquire_channels = [1,2],
+				use_sequence_mode = use_sequence_mode,
+			)
+			phases_seconds['Acquisition'] = time.monotonic() - start
+			bytes_written_by_acquisition = directory_size(measurement_base_path)
+			start = time.monotonic()
+			post_process(measurement_base_path, silent=True)
+			phases_seconds['Post processing'] = time.monotonic() - start
+		elif script == 'scan_laser_intensity':
+			from scan_laser_intensity import script_core
+			start = time.monotonic()
+			measurement_base_path = script_core(
+				measurement_name = measurement_name,
+				the_setup = the_setup,
+				bias_voltage = 200,
+				laser_DAC_values = [int(DAC) for DAC in np.linspace(0, 1000, n_positions)],
+				n_triggers = n_triggers,
+				acquire_channels = [1,2],
+				use_sequence_mode = use_sequence_mode,
+				analysis_workers = analysis_workers,
+			)
+			phases_seconds['Acquisition'] = time.monotonic() - start # Includes the analysis and the plots, which are done by `script_core`.
+			bytes_written_by_acquisition = directory_size(measurement_base_path)
+		else:
+			raise ValueError(f'`script` must be either "scan_1D" or "scan_laser_intensity", received {repr(script)}.')
+
+	n_events = n_positions*n_triggers
+	return {
+		'Number of events': n_events,
+		'Events per second': n_events/phases_seconds['Acquisition'],
+		'Bytes written by acquisition': bytes_written_by_acquisition,
+		'Bytes written per second': bytes_written_by_acquisition/phases_seconds['Acquisition'],
+		'Bytes written in total': directory_size(measurement_base_path),
+		'Peak RSS (bytes)': max(process_tree_peak_RSS.peak, peak_RSS()) if process_tree_peak_RSS.peak is not None else peak_RSS() + peak_RSS(resource.RUSAGE_CHILDREN), # Including the analysis workers. If the process tree cannot be sampled, this is an upper bound.
+		'Peak RSS of this process (bytes)': peak_RSS(),
+		'Peak RSS of the largest child process (bytes)': peak_RSS(resource.RUSAGE_CHILDREN),
+		'Phases (s)': phases_seconds,
+		'Stages': read_statistics_files(measurement_base_path),
+	}
+
+def git_commit():
+	"""Returns the hash of the current commit of this repository, or `None`."""
+	try:
+		return subprocess.run(['git','rev-parse','HEAD'], cwd=Path(__file__).parent, capture_output=True, text=True, check=True).stdout.strip()
+	except Exception:
+		return None
+
+def compare(results: dict, reference_results: dict, tolerance: float):
+	"""Compares the events per second of each benchmark in `results`
+	with `reference_results`. Returns a data frame with the comparison
+	and whether each benchmark is slower than the reference by more
+	than `tolerance`, e.g. `.2` means 20 % slower."""
+	rows = []
+	for name, result in results['Benchmarks'].items():
+		if name not in reference_results['Benchmarks']:
+			continue
+		reference = reference_results['Benchmarks'][name]
+		ratio = result['Events per second']/reference['Events per second']
+		rows.append({
+			'Benchmark': name,
+			'Events per second': result['Events per second'],
+			'Reference events per second': reference['Events per second'],
+			'Ratio': ratio,
+			'Peak RSS ratio': result['Peak RSS (bytes)']/reference['Peak RSS (bytes)'],
+			'Regression': ratio < 1 - tolerance,
+		})
+	return pandas.DataFrame(rows)
+
+def script_core(output_path: Path, benchmarks: list=None, data_directory: Path=None, latencies: dict=None, verbose: bool=False):
+	"""Runs the benchmarks and saves the results in `output_path` as JSON.
+
+	Parameters
+	----------
+	output_path: Path
+		Where to save the results.
+	benchmarks: list of str, optional
+		Names of the benchmarks to run, see `BENCHMARKS`. Default is all of them.
+	data_directory: Path, optional
+		Where to store the measurements. If not given a temporary
+		directory is used and deleted at the end.
+	latencies: dict, optional
+		Passed to `SimulatedTheSetup`, default is `simulated_setup.DEFAULT_LATENCIES`.
+	verbose: bool, default False
+		Show the output of the scripts being benchmarked.
+
+	Returns
+	-------
+	results: dict
+		The same that is saved in `output_path`.
+	"""
+	benchmarks = list(BENCHMARKS) if benchmarks is None else benchmarks
+	for name in benchmarks:
+		if name not in BENCHMARKS:
+			raise ValueError(f'Unknown benchmark {repr(name)}, available benchmarks are {sorted(BENCHMARKS)}.')
+
+	results = {
+		'When': datetime.datetime.now().isoformat(),
+		'Git commit': git_commit(),
+		'Python': platform.python_version(),
+		'Platform': platform.platform(),
+		'Latencies': latencies,
+		'Benchmarks': {},
+	}
+	temporary_directory = None
+	if data_directory is None:
+		temporary_directory = tempfile.mkdtemp(prefix='tct_scripts_benchmark_')
+		data_directory = Path(temporary_directory)
+	try:
+		for name in benchmarks:
+			print(f'Running benchmark "{name}"...')
+			with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor: # A fresh process for each benchmark, so the peak RSS is only that of the benchmark.
+				results['Benchmarks'][name] = executor.submit(
+					run_benchmark,
+					data_directory = data_directory,
+					latencies = latencies,
+					verbose = verbose,
+					**BENCHMARKS[name],
+				).result()
+			print(f'{name}: {results["Benchmarks"][name]["Events per second"]:.1f} events/s, {results["Benchmarks"][name]["Bytes written per second"]/1e6:.2f} MB/s, peak RSS {results["Benchmarks"][name]["Peak RSS (bytes)"]/1e6:.0f} MB')
+	finally:
+		if temporary_directory is not None:
+			shutil.rmtree(temporary_directory, ignore_errors=True)
+
+	Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+	with open(output_path, 'w') as ofile:
+		json.dump(results, ofile, indent='\t', default=str)
+	return results
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Benchmark the acquisition loops using the simulated instruments.')
+	parser.add_argument('--output',
+		metavar = 'path',
+		help = 'Path to the JSON file where to save the results.',
+		dest = 'output',
+		default = 'benchmark_results.json',
+		type = str,
+	)
+	parser.add_argument('--benchmark',
+		help = f'Name of a benchmark to run, can be given many times. Default is all of them: {list(BENCHMARKS)}.',
+		dest = 'benchmarks',
+		action = 'append',
+		type = str,
+	)
+	parser.add_argument('--compare',
+		metavar = 'path',
+		help = 'Path to a JSON file from a previous run, to compare with.',
+		dest = 'compare',
+		type = str,
+	)
+	parser.add_argument('--tolerance',
+		help = 'Fraction by which the events per second can drop with respect to the previous run before it is considered a regression. Default is 0.2.',
+		dest = 'tolerance',
+		default = .2,
+		type = float,
+	)
+	parser.add_argument('--no_latencies',
+		help = 'Use this option to run the simulated instruments without latencies, so only the time spent in the code is measured.',
+		dest = 'no_latencies',
+		action = 'store_true',
+	)
+	parser.add_argument('--verbose',
+		help = 'Show the output of the scripts being benchmarked.',
+		dest = 'verbose',
+		action = 'store_true',
+	)
+	args = parser.parse_args()
+
+	latencies = None
+	if args.no_latencies:
+		from simulated_setup import DEFAULT_LATENCIES
+		latencies = {key: 0 for key in DEFAULT_LATENCIES}
+
+	results = script_core(
+		output_path = Path(args.output),
+		benchmarks = args.benchmarks,
+		latencies = latencies,
+		verbose = args.verbose,
+	)
+	print(f'Results saved in {args.output}')
+
+	if args.compare is not None:
+		with open(args.compare, 'r') as ifile:
+			reference_results = json.load(ifile)
+		comparison_df = compare(results, reference_results, tolerance=args.tolerance)
+		print(f'Comparison with {args.compare}:\n{comparison_df.to_string(index=False)}')
+		if len(comparison_df) > 0 and comparison_df['Regression'].any():
+			sys.exit(1)
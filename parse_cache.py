@@ -0,0 +1,119 @@
+import numpy as np
+import pandas
+from pathlib import Path
+import sqlite3
+import hashlib
+import json
+from waveforms_store import read_query_into_arrays
+
+FEATURES_TABLE_NAME = 'features'
+PROGRESS_TABLE_NAME = 'parsed_ranges'
+
+def feature_configuration_hash(feature: str, configuration: dict):
+	"""Returns a short hash that identifies `feature` computed with
+	`configuration`, e.g. `{'method': 'PeakSignal', 'version': 1}`. If
+	anything in the configuration changes the hash changes, so values
+	computed with a different configuration are never mixed."""
+	return hashlib.sha1(json.dumps({'feature': feature, **configuration}, sort_keys=True).encode()).hexdigest()[:10]
+
+def cache_column_name(feature: str, configuration: dict):
+	return f'{feature} [{feature_configuration_hash(feature, configuration)}]'
+
+class ParseCache:
+	"""Stores the features parsed from each waveform, keyed by `n_waveform`
+	and by a hash of the configuration used to compute each feature (see
+	`feature_configuration_hash`), so when the parsing is run again only
+	the missing waveforms or the new features are computed.
+
+	The cache is an sqlite file with two tables:
+	- `features`: One row per `n_waveform` and one column per feature and
+	  configuration, e.g. `Amplitude (V) [3fa2b1c9d0]`.
+	- `parsed_ranges`: One row per batch that was parsed, with the column
+	  and the range `n_waveform_from <= n_waveform < n_waveform_to`. This
+	  is needed because sqlite stores NaN as NULL, so an empty value does
+	  not mean "not yet parsed".
+	The features of a batch and its row in `parsed_ranges` are written in
+	the same transaction, so after an interruption the cache is consistent
+	and the parsing can continue from the last batch written.
+	"""
+	def __init__(self, path: Path):
+		"""
+		Parameters
+		----------
+		path: Path
+			Path to the sqlite file, it is created if it does not exist.
+		"""
+		self._path = Path(path)
+		self._sqlite3_connection = sqlite3.connect(self._path)
+		self._sqlite3_connection.execute(f'CREATE TABLE IF NOT EXISTS {FEATURES_TABLE_NAME} (n_waveform INTEGER PRIMARY KEY)')
+		self._sqlite3_connection.execute(f'CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE_NAME} (feature_column TEXT, n_waveform_from INTEGER, n_waveform_to INTEGER)')
+		self._sqlite3_connection.commit()
+
+	@property
+	def path(self):
+		return self._path
+
+	def _columns(self):
+		cursor = self._sqlite3_connection.cursor()
+		cursor.execute(f'PRAGMA table_info({FEATURES_TABLE_NAME})')
+		return [row[1] for row in cursor.fetchall()]
+
+	def is_parsed(self, column: str, n_waveform_from: int, n_waveform_to: int):
+		"""Returns `True` if `column` was already parsed for all the
+		waveforms with `n_waveform_from <= n_waveform < n_waveform_to`."""
+		cursor = self._sqlite3_connection.cursor()
+		cursor.execute(f'SELECT count(*) from {PROGRESS_TABLE_NAME} where (feature_column=? and n_waveform_from<=? and n_waveform_to>=?)', (column, int(n_waveform_from), int(n_waveform_to)))
+		return cursor.fetchone()[0] > 0
+
+	def missing_columns(self, columns: list, n_waveform_from: int, n_waveform_to: int):
+		"""Returns the elements of `columns` that are not yet parsed in the given range."""
+		return [column for column in columns if not self.is_parsed(column, n_waveform_from, n_waveform_to)]
+
+	def write(self, n_waveform, features: dict, n_waveform_from: int, n_waveform_to: int):
+		"""Stores the features of a batch of waveforms.
+
+		Parameters
+		----------
+		n_waveform: array like
+			The `n_waveform` of each waveform in the batch.
+		features: dict
+			A dictionary of the form `{column: array}` with the values of
+			each column, one per waveform, in the same order as `n_waveform`.
+		n_waveform_from, n_waveform_to: int
+			The range of the batch, `n_waveform_from <= n_waveform < n_waveform_to`.
+			Waveforms in this range that are not in `n_waveform` are considered
+			to not exist.
+		"""
+		columns = list(features)
+		existing_columns = self._columns()
+		with self._sqlite3_connection: # A transaction, everything or nothing is written.
+			for column in columns:
+				if column not in existing_columns:
+					self._sqlite3_connection.execute(f'ALTER TABLE {FEATURES_TABLE_NAME} ADD COLUMN "{column}" REAL')
+			if len(columns) > 0:
+				quoted_columns = [f'"{column}"' for column in columns]
+				values = [[None if np.isnan(value) else float(value) for value in features[column]] for column in columns] # NaN is stored as NULL by sqlite anyway.
+				self._sqlite3_connection.executemany(
+					f'INSERT INTO {FEATURES_TABLE_NAME} (n_waveform, {", ".join(quoted_columns)}) VALUES ({", ".join(["?"]*(len(columns)+1))}) ON CONFLICT(n_waveform) DO UPDATE SET {", ".join(f"{column}=excluded.{column}" for column in quoted_columns)}',
+					zip([int(n) for n in n_waveform], *values),
+				)
+			self._sqlite3_connection.executemany(
+				f'INSERT INTO {PROGRESS_TABLE_NAME} (feature_column, n_waveform_from, n_waveform_to) VALUES (?,?,?)',
+				[(column, int(n_waveform_from), int(n_waveform_to)) for column in columns],
+			)
+
+	def read(self, columns: list, n_waveform_from: int, n_waveform_to: int):
+		"""Returns a data frame with `n_waveform` and `columns` for the
+		waveforms with `n_waveform_from <= n_waveform < n_waveform_to`,
+		sorted by `n_waveform`."""
+		quoted_columns = ''.join(f', "{column}"' for column in columns)
+		return pandas.DataFrame(read_query_into_arrays(self._sqlite3_connection, f'SELECT n_waveform{quoted_columns} from {FEATURES_TABLE_NAME} where (n_waveform>={int(n_waveform_from)} and n_waveform<{int(n_waveform_to)}) ORDER BY n_waveform'))
+
+	def close(self):
+		self._sqlite3_connection.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
@@ -7,8 +7,24 @@ from signals.PeakSignal import PeakSignal, draw_in_plotly
 import sqlite3
 from contextlib import ExitStack # https://stackoverflow.com/a/34798330/8849755
 import warnings
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from utils import map_with_bounded_memory
+from waveforms_store import WaveformsStoreReader, convert_sqlite_waveforms_to_store, archive_waveforms_store, directory_size
+from batch_feature_extraction import extract_features
+from parse_cache import ParseCache, cache_column_name
 
 TIMES_AT = [10,20,30,40,50,60,70,80,90]
+FEATURES = ['Amplitude (V)','Noise (V)','Rise time (s)','Collected charge (V s)','Time over noise (s)'] + [f't_{pp} (s)' for pp in TIMES_AT]
+FEATURES_CONFIGURATION_VERSION = 2 # Increase this number whenever the way in which the features are computed changes, so the values in the parse cache are not used anymore.
+
+def features_configuration(use_batch_feature_extraction: bool):
+	"""Returns a dictionary with everything that determines the value of
+	the features, used to key the parse cache (see `parse_cache.py`)."""
+	return {
+		'method': 'batch_feature_extraction' if use_batch_feature_extraction else 'PeakSignal',
+		'version': FEATURES_CONFIGURATION_VERSION,
+	}
 
 def draw_times_at(fig, signal):
 	MARKERS = { # https://plotly.com/python/marker-style/#custom-marker-symbols
@@ -54,16 +70,21 @@ def calculate_1D_scan_distance_from_list_of_positions(positions):
 def generate_column_with_distances(df):
 	if df.index.name != 'n_position':
 		raise ValueError(f'`df` must have as index `n_position`.')
-	x = df.groupby(df.index).mean()[f'x (m)']
-	y = df.groupby(df.index).mean()[f'y (m)']
-	z = df.groupby(df.index).mean()[f'z (m)']
+	positions = df.groupby(df.index)[['x (m)','y (m)','z (m)']].mean()
+	if len(positions) == 0:
+		return pandas.DataFrame({'Distance (m)': []}, index=pandas.Index([], name='n_position'))
+	# The positions are not necessarily measured in order along the scan, e.g. in an adaptive scan new positions are added in between, so sort them along the direction from the first position to the farthest one ---
+	xyz = positions.to_numpy()
+	displacements = xyz - xyz[0]
+	direction = displacements[np.argmax((displacements**2).sum(axis=1))]
+	order = np.argsort(displacements@direction, kind='stable')
 	distances_df = pandas.DataFrame(
 		{
-			'n_position': [i for i in range(len(set(df.index)))], 
-			'Distance (m)': calculate_1D_scan_distance_from_list_of_positions(list(zip(x,y,z)))
+			'n_position': positions.index[order], 
+			'Distance (m)': calculate_1D_scan_distance_from_list_of_positions(xyz[order])
 		}
 	)
-	return distances_df.set_index('n_position')
+	return distances_df.set_index('n_position').sort_index()
 
 def human_readable(num, suffix="B"):
 	# https://stackoverflow.com/a/1094933/8849755
@@ -73,17 +94,99 @@ def human_readable(num, suffix="B"):
 		num /= 1024.0
 	return f"{num:.1f} Yi{suffix}"
 
-def script_core(directory: Path, delete_waveform_file_if_it_is_bigger_than_bytes: float=0, silent: bool = True, telegram_reporter_data_dict: dict = None):
+def parse_waveform(time, samples, features: list=None):
+	"""Returns a dictionary with the features of a single waveform, using `PeakSignal`.
+	If `features` is given, only those features are computed, otherwise all of `FEATURES`."""
+	signal = PeakSignal(
+		time = time,
+		samples = samples,
+	)
+	parsed_data_dict = {}
+	for feature in (FEATURES if features is None else features):
+		if feature == 'Amplitude (V)':
+			parsed_data_dict[feature] = signal.amplitude
+		elif feature == 'Noise (V)':
+			parsed_data_dict[feature] = signal.noise
+		elif feature == 'Rise time (s)':
+			parsed_data_dict[feature] = signal.rise_time
+		elif feature == 'Collected charge (V s)':
+			parsed_data_dict[feature] = signal.peak_integral
+		elif feature == 'Time over noise (s)':
+			parsed_data_dict[feature] = signal.time_over_noise
+		elif feature in FEATURES:
+			pp = TIMES_AT[FEATURES.index(feature)-FEATURES.index('t_10 (s)')]
+			try:
+				_time = signal.find_time_at_rising_edge(pp)
+			except KeyboardInterrupt:
+				raise KeyboardInterrupt
+			except Exception as e:
+				_time = float('NaN')
+			parsed_data_dict[feature] = _time
+		else:
+			raise ValueError(f'Unknown feature {repr(feature)}, available features are {FEATURES}.')
+	return parsed_data_dict
+
+def parse_batch_of_waveforms(time, amplitude, number_of_samples, use_batch_feature_extraction: bool=False, features: list=None):
+	"""Parses many waveforms.
+	
+	Parameters
+	----------
+	time, amplitude: array
+		2D arrays of shape `(n_waveforms, n_samples)`, as produced by `WaveformsStoreReader.read_samples`.
+	number_of_samples: array
+		The number of samples of each waveform, the rest is padding.
+	use_batch_feature_extraction: bool, default False
+		If `True` all the waveforms are processed at once using `batch_feature_extraction.extract_features`,
+		otherwise each waveform is processed with `PeakSignal`.
+	features: list, optional
+		The features to compute, by default all of `FEATURES`.
+	
+	Returns
+	-------
+	features: dict
+		A dictionary of the form `{'Amplitude (V)': array, ...}` with one
+		element per waveform in each array.
+	"""
+	features = FEATURES if features is None else features
+	if use_batch_feature_extraction:
+		return extract_features(time, amplitude, TIMES_AT, features)
+	parsed = [parse_waveform(time[idx,:n_samples], amplitude[idx,:n_samples], features) for idx,n_samples in enumerate(number_of_samples)]
+	return {feature: np.array([p[feature] for p in parsed]) for feature in features}
+
+def parse_range_of_waveforms(waveforms_store_path: Path, n_waveform_from: int, n_waveform_to: int, use_batch_feature_extraction: bool=False, features: list=None):
+	"""Reads from the waveforms store the waveforms with `n_waveform_from <= n_waveform < n_waveform_to`
+	and parses them, computing only `features` (by default all of `FEATURES`).
+	If `features` is an empty list only the metadata is read. This function
+	is self contained so it can be run in a worker process.
+	
+	Returns
+	-------
+	metadata_df: pandas.DataFrame
+		The metadata of the waveforms, as returned by `WaveformsStoreReader.read_metadata`.
+	features: dict
+		The features of each waveform, as returned by `parse_batch_of_waveforms`.
+	"""
+	waveforms_store = WaveformsStoreReader(waveforms_store_path)
+	metadata_df = waveforms_store.read_metadata(n_waveform_from, n_waveform_to)
+	if len(metadata_df) == 0 or features == []:
+		waveforms_store.close()
+		return metadata_df, {}
+	time, amplitude = waveforms_store.read_samples(metadata_df)
+	waveforms_store.close()
+	return metadata_df, parse_batch_of_waveforms(time, amplitude, metadata_df['Number of samples'].to_numpy(), use_batch_feature_extraction, features)
+
+def script_core(directory: Path, delete_waveform_file_if_it_is_bigger_than_bytes: float=0, silent: bool = True, telegram_reporter_data_dict: dict = None, use_batch_feature_extraction: bool = False, jobs: int = 1, archive_waveforms: bool = True):
 	"""
 	Parameters
 	----------
 	directory: Path
 		Path to directory of measurement to which apply this script.
 	delete_waveform_file_if_it_is_bigger_than_bytes: float, default 0
-		If the file that contains the measured waveforms is larger than
-		this number, in bytes, it will be deleted. Otherwise, nothing
-		is done. Default value is `0` so it will delete the file no matter
-		its size.
+		Only used if `archive_waveforms` is `False`. If the waveforms store
+		(see `waveforms_store.py`) that contains the measured waveforms
+		is larger than this number, in bytes, it will be deleted. Otherwise,
+		nothing is done. Default value is `0` so it will delete it no
+		matter its size.
 	silent: bool, default True
 		If `False` messages are print showing the progress.
 	telegram_reporter_data_dict
@@ -92,11 +195,31 @@ def script_core(directory: Path, delete_waveform_file_if_it_is_bigger_than_bytes
 		{'token': str, 'chat_id': str}
 		```
 		If `None` then it is not used.
+	use_batch_feature_extraction: bool, default False
+		If `True` the features of all the waveforms in each batch are
+		computed at once with numpy, see `batch_feature_extraction.py`,
+		which is much faster than using `PeakSignal` for each waveform and
+		gives the same features, see `tests/test_batch_feature_extraction.py`.
+		The features computed with each method are cached separately.
+	jobs: int, default 1
+		Number of worker processes used to parse the batches of waveforms
+		in parallel. The result is the same no matter the number of workers.
+	archive_waveforms: bool, default True
+		If `True`, after parsing, the waveforms store is compressed with
+		`waveforms_store.archive_waveforms_store` instead of being deleted,
+		so the waveforms are kept and can be parsed again. If `False` the
+		store is deleted according to `delete_waveform_file_if_it_is_bigger_than_bytes`.
+	
+	The features of each waveform are stored in a parse cache (see `parse_cache.py`)
+	next to the waveforms, so running this again (e.g. after an interruption,
+	or after adding new values to `TIMES_AT`) only parses what is missing.
 	"""
 	if not isinstance(silent, bool):
 		raise ValueError(f'`silent` must be of type {repr(type(True))}, received object of type {repr(type(silent))}.')
 	if not isinstance(delete_waveform_file_if_it_is_bigger_than_bytes, (int, float)):
 		raise TypeError(f'`delete_waveform_file_if_it_is_bigger_than_bytes` must be a float number, received object of type {type(delete_waveform_file_if_it_is_bigger_than_bytes)}.')
+	if not isinstance(jobs, int) or jobs < 1:
+		raise ValueError(f'`jobs` must be a positive integer, received {repr(jobs)}.')
 	
 	Quique = Bureaucrat( # Quique is the friendly alias to the name Enrique (at least in Argentina).
 		directory,
@@ -107,104 +230,107 @@ def script_core(directory: Path, delete_waveform_file_if_it_is_bigger_than_bytes
 		raise RuntimeError(f'I cannot find a successful of the script `scan_1D.py` for the measurement {Quique.measurement_name} in order to process the waveforms.')
 	
 	data_frame_columns = ['n_waveform']
-	data_frame_columns += ['Amplitude (V)','Noise (V)','Rise time (s)','Collected charge (V s)','Time over noise (s)']
-	for pp in TIMES_AT:
-		data_frame_columns += [f't_{pp} (s)']
+	data_frame_columns += FEATURES
 	COPY_THESE_COLUMNS = ['n_position', 'n_trigger', 'n_channel', 'n_pulse', 'x (m)', 'y (m)', 'z (m)', 'When', 'Bias voltage (V)','Bias current (A)', 'Laser DAC', 'Temperature (°C)', 'Humidity (%RH)']
 	data_frame_columns += COPY_THESE_COLUMNS
-	data_df = pandas.DataFrame(columns = data_frame_columns)
 	
 	TEMPORARY_DATABASE_WHILE_PROCESSING_PATH = Quique.processed_data_dir_path/Path('data.sqlite')
+	if TEMPORARY_DATABASE_WHILE_PROCESSING_PATH.is_file(): # Left by a previous run that was interrupted, the parse cache has everything that was already parsed.
+		TEMPORARY_DATABASE_WHILE_PROCESSING_PATH.unlink()
 	sqlite3_connection_temporary_database = sqlite3.connect(TEMPORARY_DATABASE_WHILE_PROCESSING_PATH)
-	WAVEFORMS_DATABASE_PATH = Quique.processed_by_script_dir_path('scan_1D.py')/Path('waveforms.sqlite')
-	sqlite3_connection_waveforms = sqlite3.connect(WAVEFORMS_DATABASE_PATH)
+	WAVEFORMS_STORE_PATH = Quique.processed_by_script_dir_path('scan_1D.py')/Path('waveforms')
+	OLD_WAVEFORMS_DATABASE_PATH = Quique.processed_by_script_dir_path('scan_1D.py')/Path('waveforms.sqlite')
+	PARSE_CACHE_PATH = Quique.processed_by_script_dir_path('scan_1D.py')/Path('parse_cache.sqlite')
+	CACHE_COLUMNS = {feature: cache_column_name(feature, features_configuration(use_batch_feature_extraction)) for feature in FEATURES}
 	
 	if telegram_reporter_data_dict is not None:
 		from progressreporting.TelegramProgressReporter import TelegramReporter # https://github.com/SengerM/progressreporting
 		telegram_reporter = TelegramReporter(telegram_token=telegram_reporter_data_dict['token'], telegram_chat_id=telegram_reporter_data_dict['chat_id'])
 	
 	with Quique.verify_no_errors_context():
-		# Because the file may be too large (several GB) we process the waveforms in batches.
+		if not WAVEFORMS_STORE_PATH.is_dir() and OLD_WAVEFORMS_DATABASE_PATH.is_file(): # This is a measurement from before the waveforms store existed.
+			if not silent:
+				print(f'Converting {OLD_WAVEFORMS_DATABASE_PATH.parts[-1]} into the new waveforms store format...')
+			convert_sqlite_waveforms_to_store(OLD_WAVEFORMS_DATABASE_PATH, WAVEFORMS_STORE_PATH, silent=silent)
+		waveforms_store = WaveformsStoreReader(WAVEFORMS_STORE_PATH)
+		
 		if not silent:
 			print(f'Reading the total number of waveforms to process...')
-		sqlite3_cursor_waveforms = sqlite3_connection_waveforms.cursor()
-		sqlite3_cursor_waveforms.execute('SELECT max(n_waveform) from waveforms')
-		number_of_waveforms_to_process = sqlite3_cursor_waveforms.fetchone()[0]+1
+		number_of_waveforms_to_process = waveforms_store.number_of_waveforms
 		
+		# Because the file may be too large (several GB) we process the waveforms in batches.
 		NUMBER_OF_WAVEFORMS_IN_EACH_BATCH = 3333 # This depends on the amount of memory you want to use...
-		number_of_batches = number_of_waveforms_to_process//NUMBER_OF_WAVEFORMS_IN_EACH_BATCH + 1 if number_of_waveforms_to_process%NUMBER_OF_WAVEFORMS_IN_EACH_BATCH != 0 else 0
 		
 		if not silent:
-			print(f'A total of {number_of_waveforms_to_process} waveforms will be processed in {number_of_batches} batches.')
+			print(f'A total of {number_of_waveforms_to_process} waveforms will be processed in batches of {NUMBER_OF_WAVEFORMS_IN_EACH_BATCH}.')
 		
-		with telegram_reporter.report_for_loop(number_of_waveforms_to_process, f'Waveforms parsing for measurement {Quique.measurement_name}') if telegram_reporter_data_dict is not None else ExitStack() as telegram_reporter:
-			highest_n_waveform_already_processed = -1
-			for n_batch in range(number_of_batches):
+		with telegram_reporter.report_for_loop(number_of_waveforms_to_process, f'Waveforms parsing for measurement {Quique.measurement_name}') if telegram_reporter_data_dict is not None else ExitStack() as telegram_reporter, ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else ExitStack() as executor, ParseCache(PARSE_CACHE_PATH) as parse_cache:
+			batches_limits = waveforms_store.batches_limits(NUMBER_OF_WAVEFORMS_IN_EACH_BATCH)
+			missing_features_each_batch = [[feature for feature in FEATURES if not parse_cache.is_parsed(CACHE_COLUMNS[feature], n_waveform_from, n_waveform_to)] for n_waveform_from, n_waveform_to in batches_limits]
+			if not silent:
+				n_batches_already_parsed = sum(len(missing_features)==0 for missing_features in missing_features_each_batch)
+				if n_batches_already_parsed > 0:
+					print(f'{n_batches_already_parsed} out of {len(batches_limits)} batches are already in the parse cache, they will not be parsed again.')
+			arguments = (
+				[WAVEFORMS_STORE_PATH]*len(batches_limits), 
+				[n_waveform_from for n_waveform_from,_ in batches_limits], 
+				[n_waveform_to for _,n_waveform_to in batches_limits], 
+				[use_batch_feature_extraction]*len(batches_limits),
+				missing_features_each_batch,
+			)
+			# Batches are parsed in parallel by the workers, but the results are given in order so the output does not depend on the number of workers.
+			parsed_batches = map_with_bounded_memory(executor, parse_range_of_waveforms, *arguments, max_in_flight=2*jobs) if jobs > 1 else map(parse_range_of_waveforms, *arguments)
+			for (n_waveform_from, n_waveform_to), (metadata_df, features) in zip(batches_limits, parsed_batches):
+				if len(metadata_df) == 0:
+					continue
 				if not silent:
-					print(f'Reading waveforms for n_batch {n_batch}...')
-				waveforms_df = pandas.read_sql_query(f'SELECT * from waveforms where (n_waveform>{highest_n_waveform_already_processed} and n_waveform<={highest_n_waveform_already_processed+NUMBER_OF_WAVEFORMS_IN_EACH_BATCH})', sqlite3_connection_waveforms)
-				for n_waveform in set(waveforms_df['n_waveform']): # We have to process each waveform one by one, there is no alternative. This will take time...
-					if not silent:
-						print(f'Processing n_waveform {n_waveform} out of {number_of_waveforms_to_process-1}...')
-					this_waveform_rows = waveforms_df['n_waveform'] == n_waveform
+					print(f'Parsed n_waveform {metadata_df["n_waveform"].min()}-{metadata_df["n_waveform"].max()} out of {number_of_waveforms_to_process-1}...')
+				# Store the new features in the cache, then take all of them from there ---
+				parse_cache.write(
+					n_waveform = metadata_df['n_waveform'].to_numpy(),
+					features = {CACHE_COLUMNS[feature]: values for feature, values in features.items()},
+					n_waveform_from = n_waveform_from,
+					n_waveform_to = n_waveform_to,
+				)
+				cached_df = parse_cache.read([CACHE_COLUMNS[feature] for feature in FEATURES], n_waveform_from, n_waveform_to)
+				cached_df = cached_df.rename(columns={cache_column: feature for feature, cache_column in CACHE_COLUMNS.items()})
+				# Build the data frame of the whole batch at once ---
+				data_df = metadata_df[['n_waveform']+COPY_THESE_COLUMNS].merge(cached_df, on='n_waveform', how='left')
+				data_df = data_df[data_frame_columns]
+				data_df.to_sql('parsed_data', sqlite3_connection_temporary_database, index=False, if_exists='append')
+				
+				for idx in np.where(np.random.rand(len(data_df)) < 40/number_of_waveforms_to_process)[0]: # Produce a control plot for some random waveforms...
+					parsed_data_dict = data_df.iloc[idx].to_dict()
+					n_waveform = int(parsed_data_dict['n_waveform'])
+					waveform = waveforms_store.get_waveform(n_waveform)
 					signal = PeakSignal(
-						time = waveforms_df.loc[this_waveform_rows,'Time (s)'],
-						samples = waveforms_df.loc[this_waveform_rows,'Amplitude (V)'],
+						time = waveform['Time (s)'],
+						samples = waveform['Amplitude (V)'],
 					)
-					
-					parsed_data_dict = {
-						'n_waveform': n_waveform,
-						'Amplitude (V)': signal.amplitude,
-						'Noise (V)': signal.noise,
-						'Rise time (s)': signal.rise_time,
-						'Collected charge (V s)': signal.peak_integral,
-						'Time over noise (s)': signal.time_over_noise,
-					}
-					for pp in TIMES_AT:
-						try:
-							_time = signal.find_time_at_rising_edge(pp)
-						except KeyboardInterrupt:
-							raise KeyboardInterrupt
-						except Exception as e:
-							_time = float('NaN')
-						parsed_data_dict[f't_{pp} (s)'] = _time
-					parsed_data_dict = {
-						**parsed_data_dict, 
-						**waveforms_df.loc[this_waveform_rows, COPY_THESE_COLUMNS].iloc[0].to_dict()
-					}
-					
-					data_df = data_df.append(pandas.Series(parsed_data_dict), ignore_index = True)
-					
-					if np.random.rand() < 40/number_of_waveforms_to_process: # Produce a control plot for the current waveform...
-						fig = draw_in_plotly(signal)
-						fig.update_layout(
-							title = f'Control plot n_waveform {n_waveform}, n_position {parsed_data_dict["n_position"]}, n_trigger {parsed_data_dict["n_trigger"]}, n_pulse {parsed_data_dict["n_pulse"]}, n_channel {parsed_data_dict["n_channel"]}<br><sup>Measurement: {Quique.measurement_name}</sup>',
-							xaxis_title = "Time (s)",
-							yaxis_title = "Amplitude (V)",
-						)
-						draw_times_at(fig=fig, signal=signal)
-						CONTROL_PLOTS_FOR_SIGNAL_PROCESSING_DIR_PATH = Quique.processed_data_dir_path/Path('plots with a random selection of the waveforms')
-						CONTROL_PLOTS_FOR_SIGNAL_PROCESSING_DIR_PATH.mkdir(exist_ok=True)
-						fig.write_html(
-							str(CONTROL_PLOTS_FOR_SIGNAL_PROCESSING_DIR_PATH/Path(f'n_waveform {n_waveform}.html')),
-							include_plotlyjs = 'cdn',
-						)
-					
-					highest_n_waveform_already_processed = waveforms_df['n_waveform'].max()
-					
-					if len(data_df.index) > 10e3 or n_waveform == number_of_waveforms_to_process-1:
-						if not silent:
-							print('Saving parsed data...')
-						data_df.to_sql('parsed_data', sqlite3_connection_temporary_database, index=False, if_exists='append')
-						data_df = pandas.DataFrame()
-					
-					if telegram_reporter_data_dict is not None:
-						telegram_reporter.update(1)
+					fig = draw_in_plotly(signal)
+					fig.update_layout(
+						title = f'Control plot n_waveform {n_waveform}, n_position {parsed_data_dict["n_position"]}, n_trigger {parsed_data_dict["n_trigger"]}, n_pulse {parsed_data_dict["n_pulse"]}, n_channel {parsed_data_dict["n_channel"]}<br><sup>Measurement: {Quique.measurement_name}</sup>',
+						xaxis_title = "Time (s)",
+						yaxis_title = "Amplitude (V)",
+					)
+					draw_times_at(fig=fig, signal=signal)
+					CONTROL_PLOTS_FOR_SIGNAL_PROCESSING_DIR_PATH = Quique.processed_data_dir_path/Path('plots with a random selection of the waveforms')
+					CONTROL_PLOTS_FOR_SIGNAL_PROCESSING_DIR_PATH.mkdir(exist_ok=True)
+					fig.write_html(
+						str(CONTROL_PLOTS_FOR_SIGNAL_PROCESSING_DIR_PATH/Path(f'n_waveform {n_waveform}.html')),
+						include_plotlyjs = 'cdn',
+					)
+				
+				if telegram_reporter_data_dict is not None:
+					telegram_reporter.update(len(data_df))
 		
 		# Add the column `Distance (m)` to the data so it does not has to be calculated later on...
 		if not silent:
 			print('Calculating `Distance (m)` column and adding it to the parsed data...')
-		data_df = pandas.read_sql_query('SELECT * from `parsed_data`', sqlite3_connection_temporary_database)
+		if sqlite3_connection_temporary_database.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='parsed_data'").fetchone() is not None:
+			data_df = pandas.read_sql_query('SELECT * from `parsed_data`', sqlite3_connection_temporary_database)
+		else: # There were no waveforms to parse, so nothing was ever written.
+			data_df = pandas.DataFrame(columns=data_frame_columns)
 		data_df = data_df.set_index('n_position')
 		data_df['Distance (m)'] = generate_column_with_distances(data_df)['Distance (m)']
 		data_df = data_df.reset_index()
@@ -214,12 +340,21 @@ def script_core(directory: Path, delete_waveform_file_if_it_is_bigger_than_bytes
 		if not silent:
 			print('Finished processing!')
 		
-		if WAVEFORMS_DATABASE_PATH.stat().st_size >= delete_waveform_file_if_it_is_bigger_than_bytes:
+		waveforms_store.close()
+		if archive_waveforms:
+			if not waveforms_store.is_archived:
+				size_before = directory_size(WAVEFORMS_STORE_PATH)
+				if not silent:
+					print(f'Archiving the waveforms store which has a size of {human_readable(size_before)}...')
+				archive_waveforms_store(WAVEFORMS_STORE_PATH, silent=silent)
+				if not silent:
+					print(f'Waveforms store archived, its size is now {human_readable(directory_size(WAVEFORMS_STORE_PATH))} (it was {human_readable(size_before)}).')
+		elif directory_size(WAVEFORMS_STORE_PATH) >= delete_waveform_file_if_it_is_bigger_than_bytes:
 			if not silent:
-				print(f'Deleting the waveforms database file which has a size of {human_readable(WAVEFORMS_DATABASE_PATH.stat().st_size)}')
-			with open(WAVEFORMS_DATABASE_PATH.parent/Path('README.md'), 'a') as ofile:
-				print(f'In this directory there was a file `{WAVEFORMS_DATABASE_PATH.parts[-1]}` with all the waveforms. It was deleted after parsing all the waveforms (see results in "{Quique.processed_data_dir_path}") because its size was too big ({human_readable(WAVEFORMS_DATABASE_PATH.stat().st_size)}).', file=ofile)
-			WAVEFORMS_DATABASE_PATH.unlink()
+				print(f'Deleting the waveforms store which has a size of {human_readable(directory_size(WAVEFORMS_STORE_PATH))}')
+			with open(WAVEFORMS_STORE_PATH.parent/Path('README.md'), 'a') as ofile:
+				print(f'In this directory there was a directory `{WAVEFORMS_STORE_PATH.parts[-1]}` with all the waveforms. It was deleted after parsing all the waveforms (see results in "{Quique.processed_data_dir_path}") because its size was too big ({human_readable(directory_size(WAVEFORMS_STORE_PATH))}).', file=ofile)
+			shutil.rmtree(WAVEFORMS_STORE_PATH)
 		
 	return Quique.measurement_base_path
 
@@ -235,9 +370,28 @@ if __name__ == '__main__':
 		dest = 'directory',
 		type = str,
 	)
+	parser.add_argument('--batch_feature_extraction',
+		help = 'Use this option to compute the features of each batch of waveforms at once with numpy instead of using `PeakSignal` for each waveform, which is much faster and gives the same features.',
+		dest = 'use_batch_feature_extraction',
+		action = 'store_true',
+	)
+	parser.add_argument('--jobs',
+		help = 'Number of worker processes to parse the waveforms in parallel. Default is 1.',
+		dest = 'jobs',
+		type = int,
+		default = 1,
+	)
+	parser.add_argument('--delete_waveforms',
+		help = 'Use this option to delete the waveforms after parsing them, instead of keeping them in a compressed archive.',
+		dest = 'delete_waveforms',
+		action = 'store_true',
+	)
 	args = parser.parse_args()
 	script_core(
 		Path(args.directory), 
 		silent = False,
-		telegram_reporter_data_dict = {'token': my_telegram_bots.robobot.token, 'chat_id': my_telegram_bots.chat_ids['Robobot TCT setup']}
+		telegram_reporter_data_dict = {'token': my_telegram_bots.robobot.token, 'chat_id': my_telegram_bots.chat_ids['Robobot TCT setup']},
+		use_batch_feature_extraction = args.use_batch_feature_extraction,
+		jobs = args.jobs,
+		archive_waveforms = not args.delete_waveforms,
 	)
@@ -67,7 +67,7 @@ def script_core(directory: Path):
 	data_df = calculate_normalized_collected_charge(data_df)
 	
 	GROUP_BY = ['n_position','n_channel','n_pulse','Distance (m)']
-	averaged_by_position_df = mean_std(data_df, by=GROUP_BY)
+	averaged_by_position_df = mean_std(data_df, by=GROUP_BY).sort_values(by='Distance (m)') # Positions may not be measured in order, e.g. in an adaptive scan.
 	
 	if PLOT_MEAN_STD_PLOTS:
 		mean_std_plots_dir_Path = bureaucrat.processed_data_dir_path/Path('mean_std_plots')
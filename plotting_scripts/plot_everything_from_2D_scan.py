@@ -15,10 +15,13 @@ def script_core(directory):
 	except FileNotFoundError:
 		measured_data_df = pandas.read_csv(bureaucrat.processed_by_script_dir_path('scan_2D.py')/Path('measured_data.csv'))
 	
-	mean_df = measured_data_df.groupby(by=['x (m)','y (m)','n_channel','n_pulse']).mean()
+	if {'n_position_1','n_position_2'} <= set(measured_data_df.columns): # The positions read back from the stages differ slightly within each row and column of the grid, so use the same value for each of them.
+		measured_data_df['x (m)'] = measured_data_df.groupby('n_position_1')['x (m)'].transform('mean')
+		measured_data_df['y (m)'] = measured_data_df.groupby('n_position_2')['y (m)'].transform('mean')
+	mean_df = measured_data_df.groupby(by=['x (m)','y (m)','n_channel','n_pulse']).mean(numeric_only=True)
 	mean_df = mean_df.reset_index()
-	for col in sorted(measured_data_df.columns):
-		if col in {'n_position','n_position_1','n_position_2','n_channel','n_pulse','n_trigger','index'}:
+	for col in sorted(mean_df.columns):
+		if col in {'n_position','n_position_1','n_position_2','n_position_in_path','n_waveform','n_channel','n_pulse','n_trigger','index','Distance (m)'}:
 			continue
 		for n_channel in set(measured_data_df['n_channel']):
 			for n_pulse in set(measured_data_df['n_pulse']):
@@ -1,16 +1,26 @@
 from TheSetup import TheSetup
-from time import sleep
 from bureaucrat.Bureaucrat import Bureaucrat # https://github.com/SengerM/bureaucrat
-from progressreporting.TelegramProgressReporter import TelegramReporter # https://github.com/SengerM/progressreporting
-import my_telegram_bots
 from pathlib import Path
 import pandas
+import numpy as np
 import datetime
+import time
+from contextlib import ExitStack # https://stackoverflow.com/a/34798330/8849755
 import utils
 import tct_scripts_config
-from parse_waveforms_from_scan_1D import script_core as parse_waveforms
+from parse_waveforms_from_scan_1D import script_core as parse_waveforms, parse_waveform
 from plotting_scripts.plot_everything_from_1D_scan import script_core as plot_measurement
-import sqlite3
+from waveforms_store import WaveformsStoreWriter, WaveformsStoreReader
+from acquisition_pipeline import AcquisitionPipeline
+
+ADAPTIVE_SAMPLING_DEFAULTS = {
+	'minimum step (m)': 1e-6, # Intervals are not split below this, i.e. the resolution.
+	'new positions per iteration': 10,
+	'maximum number of positions': 333,
+	'time budget (s)': None, # No new iteration is started after this time. `None` means no limit.
+	'threshold': .05, # Minimum relative change of the charge between two positions to split the interval, see `utils.positions_to_refine_1D_scan`.
+	'significance': 3, # Minimum change of the charge between two positions to split the interval, in units of its standard error.
+}
 
 def post_process(measurement_base_path: Path, silent=True):
 	if not silent:
@@ -22,6 +32,34 @@ def post_process(measurement_base_path: Path, silent=True):
 	if not silent:
 		print(f'Post-processing of {measurement_base_path.parts[-1]} finished!')
 
+def collected_charge_of_average_waveform(waveform: dict):
+	"""Returns the collected charge of an average waveform, as returned by
+	`utils.WaveformsAverager.mean_waveform`, and its standard error
+	estimated from the standard deviation of each sample. The fluctuations
+	of the samples within the pulse are assumed to be fully correlated
+	(e.g. the laser intensity fluctuates from trigger to trigger), so the
+	standard error is an upper bound. It is `NaN` with a single trigger."""
+	if waveform is None or len(waveform['Time (s)']) == 0:
+		return float('NaN'), float('NaN')
+	charge = parse_waveform(waveform['Time (s)'], waveform['Amplitude mean (V)'], features=['Collected charge (V s)'])['Collected charge (V s)'] # Same definition as the charge of each waveform in `post_process`.
+	signal = waveform['Amplitude mean (V)'] - np.nanmedian(waveform['Amplitude mean (V)'])
+	in_pulse = signal > .1*np.nanmax(signal)
+	if (waveform['Number of waveforms'] < 2).all():
+		return charge, float('NaN')
+	standard_error = np.nansum((np.gradient(waveform['Time (s)'])*waveform['Amplitude std (V)']/waveform['Number of waveforms']**.5)[in_pulse])
+	return charge, standard_error
+
+def add_stored_waveforms_to_averager(waveforms_store_path: Path, waveforms_averager, n_waveforms_per_batch: int=10000):
+	"""Adds to `waveforms_averager` all the waveforms in a store, e.g.
+	those measured before resuming a measurement."""
+	reader = WaveformsStoreReader(waveforms_store_path)
+	try:
+		for metadata_df, time, amplitude in reader.iter_batches(n_waveforms_per_batch):
+			for n_row, metadata in enumerate(metadata_df.to_dict(orient='records')):
+				waveforms_averager.add(metadata, time[n_row], amplitude[n_row]) # The padding is NaN, which is ignored by the averager.
+	finally:
+		reader.close()
+
 def script_core(
 		measurement_name: str, 
 		bias_voltage: float,
@@ -30,19 +68,36 @@ def script_core(
 		the_setup: TheSetup,
 		n_triggers: int = 1,
 		acquire_channels = [1,2,3,4],
+		use_sequence_mode: bool = False, # If `True` all the triggers in each position are acquired at once using the sequence mode of the oscilloscope, see `TheSetup.acquire_segments`.
+		slow_readback_period: float = 1, # Seconds between each reading of bias voltage, bias current, temperature and humidity, which are measured in the background.
+		telegram_reporter_data_dict: dict = None, # A dictionary of the form `{'token': str, 'chat_id': str}` to report the progress, if `None` it is not reported.
+		resume: bool = False, # If `True` and a measurement with the same name exists (e.g. it was interrupted), continue it measuring only the triggers that are not yet stored. The positions and number of triggers must be the same as in the original measurement.
+		adaptive_sampling: dict = None, # If given, `positions` is a coarse grid along a straight line and new positions are added where the collected charge or the charge sharing changes fastest. The keys are those of `ADAPTIVE_SAMPLING_DEFAULTS`, the missing ones take the default value.
 	):
+	if adaptive_sampling is not None:
+		if resume:
+			raise ValueError('`resume` cannot be used together with `adaptive_sampling`, the positions of an adaptive scan depend on the measured data.')
+		for key in adaptive_sampling:
+			if key not in ADAPTIVE_SAMPLING_DEFAULTS:
+				raise ValueError(f'Unknown key {repr(key)} in `adaptive_sampling`, the valid keys are {sorted(ADAPTIVE_SAMPLING_DEFAULTS)}.')
+		adaptive_sampling = {**ADAPTIVE_SAMPLING_DEFAULTS, **adaptive_sampling}
+		if len(positions) < 2:
+			raise ValueError(f'`positions` must have at least 2 elements for an adaptive scan, received {repr(positions)}.')
+	resume = resume and (tct_scripts_config.DATA_STORAGE_DIRECTORY_PATH/Path(measurement_name)).is_dir()
 	Raúl = Bureaucrat(
 		tct_scripts_config.DATA_STORAGE_DIRECTORY_PATH/Path(measurement_name),
 		variables = locals(),
-		new_measurement = True,
+		new_measurement = not resume,
 	)
 	
-	reporter = TelegramReporter(
-		telegram_token = my_telegram_bots.robobot.token, 
-		telegram_chat_id = my_telegram_bots.chat_ids['Robobot TCT setup'],
-	)
+	if telegram_reporter_data_dict is not None:
+		from progressreporting.TelegramProgressReporter import TelegramReporter # https://github.com/SengerM/progressreporting
+		reporter = TelegramReporter(
+			telegram_token = telegram_reporter_data_dict['token'], 
+			telegram_chat_id = telegram_reporter_data_dict['chat_id'],
+		)
 	
-	with Raúl.verify_no_errors_context():
+	with Raúl.verify_no_errors_context(), ExitStack() as stack:
 		print('Configuring acquisition system...')
 		the_setup.configure_oscilloscope_for_two_pulses()
 		
@@ -54,72 +109,112 @@ def script_core(
 		the_setup.bias_voltage = bias_voltage
 		the_setup.bias_output_status = 'on'
 		
-		sqlite3_connection = sqlite3.connect(Raúl.processed_data_dir_path/Path('waveforms.sqlite'))
-		waveforms_df = pandas.DataFrame()
+		the_setup.start_slow_readback_sampler(period=slow_readback_period)
+		stack.callback(the_setup.stop_slow_readback_sampler) # Also if the measurement fails, so the instruments are not polled afterwards.
+		
+		waveforms_store = WaveformsStoreWriter(
+			Raúl.processed_data_dir_path/Path('waveforms'),
+			checkpoint_columns = ['n_position','n_trigger'], # Each trigger is an event, stored with all its waveforms or not at all.
+			resume = resume,
+			max_seconds_between_flushes = 5, # So if it crashes at most a few seconds of measurement are lost.
+		)
+		waveforms_averager = utils.WaveformsAverager(group_by=['n_position','n_channel','n_pulse'])
+		already_measured = set(waveforms_store.read_checkpoints().itertuples(index=False, name=None))
+		if len(already_measured) > 0:
+			print(f'Resuming measurement, {len(already_measured)} out of {len(positions)*n_triggers} triggers were already measured...')
+			add_stored_waveforms_to_averager(waveforms_store.path, waveforms_averager)
+		pipeline = AcquisitionPipeline(waveforms_store, n_pulses=2, waveforms_averager=waveforms_averager) # Splitting the pulses, averaging and writing to disk happens in background threads, this thread only talks to the instruments.
 		
-		with reporter.report_for_loop(len(positions)*n_triggers, f'{Raúl.measurement_name}') as reporter:
-			n_waveform = 0
-			for n_position, target_position in enumerate(positions):
-				the_setup.move_to(*target_position)
-				sleep(0.1) # Wait for any transient after moving the motors.
-				position = the_setup.position
-				for n_trigger in range(n_triggers):
-					print(f'Measuring: n_position={n_position}/{len(positions)-1}, n_trigger={n_trigger}/{n_triggers-1}...')
-					utils.wait_for_nice_trigger_without_EMI(the_setup, acquire_channels)
-					for n_channel in acquire_channels:
-						try:
-							raw_data = the_setup.get_waveform(channel = n_channel)
-						except Exception as e:
-							print(f'Cannot get data from oscilloscope, reason: {e}')
-							break
-						raw_data_each_pulse = {}
-						for n_pulse in [1,2]:
-							raw_data_each_pulse[n_pulse] = {}
-							for variable in ['Time (s)','Amplitude (V)']:
-								if n_pulse == 1:
-									raw_data_each_pulse[n_pulse][variable] = raw_data[variable][:int(len(raw_data[variable])/2)]
-								if n_pulse == 2:
-									raw_data_each_pulse[n_pulse][variable] = raw_data[variable][int(len(raw_data[variable])/2):]
-							
-							# Because measuring bias voltage and current takes a long time (don't know why), I do the following ---
-							measure_slow_things_in_this_iteration = False
-							if 'last_time_slow_things_were_measured' not in locals() or (datetime.datetime.now()-last_time_slow_things_were_measured).seconds >= 11:
-								measure_slow_things_in_this_iteration = True
-								last_time_slow_things_were_measured = datetime.datetime.now()
-							
-							waveforms_df = pandas.concat(
-								[
-									waveforms_df, # First dataframe.
-									pandas.DataFrame( # Second dataframe.
-										{
-											'n_position': n_position,
-											'n_trigger': n_trigger,
-											'n_channel': n_channel,
-											'n_pulse': n_pulse,
-											'n_waveform': n_waveform,
-											'x (m)': position[0],
-											'y (m)': position[1],
-											'z (m)': position[2],
-											'When': datetime.datetime.now(),
-											'Bias voltage (V)': the_setup.bias_voltage if measure_slow_things_in_this_iteration else float('NaN'),
-											'Bias current (A)': the_setup.bias_current if measure_slow_things_in_this_iteration else float('NaN'),
-											'Laser DAC': the_setup.laser_DAC,
-											'Temperature (°C)': the_setup.temperature if measure_slow_things_in_this_iteration else float('NaN'),
-											'Humidity (%RH)': the_setup.humidity if measure_slow_things_in_this_iteration else float('NaN'),
-											'Time (s)': raw_data_each_pulse[n_pulse]['Time (s)'],
-											'Amplitude (V)': raw_data_each_pulse[n_pulse]['Amplitude (V)'],
-										},
-									),
-								],
-								ignore_index = True,
-							)
-							n_waveform += 1
-					if len(waveforms_df.index) > 1e6 or (n_position == len(positions)-1 and n_trigger == n_triggers-1):
-						print(f'Saving data into database...')
-						waveforms_df.to_sql('waveforms', sqlite3_connection, index=False, if_exists='append')
-						waveforms_df = pandas.DataFrame()
+		def measure_position(n_position, target_position, n_positions_so_far):
+			triggers_to_measure = [n_trigger for n_trigger in range(n_triggers) if (n_position, n_trigger) not in already_measured]
+			if len(triggers_to_measure) == 0:
+				return
+			position = the_setup.move_to(*target_position) # Waits until the stages settle, and returns the position read back.
+			if use_sequence_mode:
+				print(f'Measuring: n_position={n_position}/{n_positions_so_far-1}, {len(triggers_to_measure)} triggers in sequence mode...')
+				with pipeline.counters['acquisition'].measure(n_items=0): # The items are counted for each trigger below.
+					raw_waveforms_each_trigger = dict(zip(triggers_to_measure, utils.acquire_nice_triggers_without_EMI_in_sequence_mode(the_setup, acquire_channels, len(triggers_to_measure))))
+			for n_trigger in triggers_to_measure:
+				if not use_sequence_mode:
+					print(f'Measuring: n_position={n_position}/{n_positions_so_far-1}, n_trigger={n_trigger}/{n_triggers-1}...')
+				with pipeline.counters['acquisition'].measure():
+					raw_waveforms = raw_waveforms_each_trigger[n_trigger] if use_sequence_mode else utils.wait_for_nice_trigger_without_EMI(the_setup, acquire_channels)
+					now = datetime.datetime.now()
+					metadata = {
+						'n_position': n_position,
+						'n_trigger': n_trigger,
+						'x (m)': position[0],
+						'y (m)': position[1],
+						'z (m)': position[2],
+						'When': now,
+						'Laser DAC': the_setup.laser_DAC,
+						**the_setup.slow_readbacks(when=now.timestamp()), # Bias voltage, current, temperature and humidity, measured in the background because they are slow.
+					}
+				pipeline.put_event(metadata=metadata, raw_waveforms=raw_waveforms)
+				if telegram_reporter_data_dict is not None:
 					reporter.update(1)
 		
+		n_triggers_to_measure = len(positions)*n_triggers-len(already_measured) if adaptive_sampling is None else adaptive_sampling['maximum number of positions']*n_triggers # For an adaptive scan this is an upper bound.
+		with reporter.report_for_loop(n_triggers_to_measure, f'{Raúl.measurement_name}') if telegram_reporter_data_dict is not None else ExitStack() as reporter, waveforms_store, pipeline:
+			if adaptive_sampling is None:
+				for n_position, target_position in enumerate(positions):
+					measure_position(n_position, target_position, len(positions))
+			else:
+				positions = [np.array(position, dtype=float) for position in positions]
+				direction = positions[-1] - positions[0]
+				direction /= np.linalg.norm(direction)
+				distances = [float(np.dot(position-positions[0], direction)) for position in positions]
+				collected_charge = {n_channel: [] for n_channel in acquire_channels}
+				collected_charge_std = {n_channel: [] for n_channel in acquire_channels}
+				adaptive_sampling_log = []
+				started = time.monotonic()
+				n_positions_to_measure = list(range(len(positions)))
+				n_iteration = 0
+				while True:
+					print(f'Adaptive sampling iteration {n_iteration}, measuring {len(n_positions_to_measure)} positions...')
+					for n_position in (n_positions_to_measure if n_iteration%2 == 0 else n_positions_to_measure[::-1]): # Back and forth, so the stages travel less.
+						measure_position(n_position, positions[n_position], len(positions))
+					pipeline.wait_until_processed() # So the average waveforms of these positions are complete.
+					for n_position in n_positions_to_measure:
+						for n_channel in acquire_channels:
+							waveform = waveforms_averager.mean_waveform({'n_position': n_position, 'n_channel': n_channel, 'n_pulse': 1})
+							charge, charge_std = collected_charge_of_average_waveform(waveform)
+							collected_charge[n_channel].append(charge)
+							collected_charge_std[n_channel].append(charge_std)
+						adaptive_sampling_log.append({'n_position': n_position, 'Iteration': n_iteration, 'Distance (m)': distances[n_position], **{f'Collected charge CH{n_channel} (V s)': collected_charge[n_channel][n_position] for n_channel in acquire_channels}, **{f'Collected charge std CH{n_channel} (V s)': collected_charge_std[n_channel][n_position] for n_channel in acquire_channels}})
+					
+					if adaptive_sampling['time budget (s)'] is not None and time.monotonic() - started >= adaptive_sampling['time budget (s)']:
+						print('Adaptive sampling finished, the time budget was reached.')
+						break
+					new_distances = utils.positions_to_refine_1D_scan(
+						distances = distances,
+						collected_charge = collected_charge,
+						collected_charge_std = collected_charge_std, # So the trigger to trigger fluctuations do not trigger refinement.
+						significance = adaptive_sampling['significance'],
+						minimum_step = adaptive_sampling['minimum step (m)'],
+						max_new_positions = min(adaptive_sampling['new positions per iteration'], adaptive_sampling['maximum number of positions']-len(positions)),
+						threshold = adaptive_sampling['threshold'],
+					)
+					if len(new_distances) == 0:
+						print('Adaptive sampling finished, either the resolution or the maximum number of positions was reached.')
+						break
+					n_positions_to_measure = list(range(len(positions), len(positions)+len(new_distances)))
+					positions += [positions[0] + distance*direction for distance in new_distances]
+					distances += new_distances
+					n_iteration += 1
+				pandas.DataFrame(adaptive_sampling_log).to_csv(Raúl.processed_data_dir_path/Path('adaptive_sampling.csv'), index=False)
+		
+		pipeline_statistics_df = pandas.DataFrame(pipeline.statistics())
+		print(f'Acquisition pipeline statistics:\n{pipeline_statistics_df.to_string(index=False)}')
+		pipeline_statistics_df.to_csv(Raúl.processed_data_dir_path/Path('acquisition_pipeline_statistics.csv'), index=False)
+		stages_settling_statistics_df = pandas.DataFrame([the_setup.stages_settling_statistics()])
+		print(f'Stages settling statistics:\n{stages_settling_statistics_df.to_string(index=False)}')
+		stages_settling_statistics_df.to_csv(Raúl.processed_data_dir_path/Path('stages_settling_statistics.csv'), index=False)
+		
+		waveforms_averager.dataframe().to_feather(Raúl.processed_data_dir_path/Path('average_waveforms.fd'))
+		
+		the_setup.dump_profile(Raúl.processed_data_dir_path) # Only if it was created with `profile=True`.
+		
 	return Raúl.measurement_base_path
 
 ########################################################################
@@ -133,23 +228,55 @@ DEVICE_CENTER = {
 	'z': 71.41140625e-3
 }
 SCAN_STEP = 1e-6 # meters
+ADAPTIVE_SCAN_COARSE_STEP = 10e-6 # meters, with `--adaptive` it is refined down to `SCAN_STEP`.
 SCAN_LENGTH = 270e-6 # meters
 SCAN_ANGLE_DEG = 0 # deg
 LASER_DAC = 630
 N_TRIGGERS_PER_POSITION = 333
 
 if __name__ == '__main__':
-	import numpy as np
+	import argparse
+	
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--simulate',
+		help = 'Use this option to run with simulated instruments instead of the real ones, see `simulated_setup.py`.',
+		dest = 'simulate',
+		action = 'store_true',
+	)
+	parser.add_argument('--resume',
+		help = 'Use this option to continue a measurement that was interrupted, give the same measurement name.',
+		dest = 'resume',
+		action = 'store_true',
+	)
+	parser.add_argument('--adaptive',
+		help = f'Use this option to measure a coarse grid and then add positions where the collected charge changes fastest, see `ADAPTIVE_SAMPLING_DEFAULTS`.',
+		dest = 'adaptive',
+		action = 'store_true',
+	)
+	parser.add_argument('--profile',
+		help = 'Use this option to measure the time spent in each operation of the setup, it is saved with the measurement.',
+		dest = 'profile',
+		action = 'store_true',
+	)
+	args = parser.parse_args()
 	
-	x = DEVICE_CENTER['x'] + np.arange(-SCAN_LENGTH/2,SCAN_LENGTH/2, SCAN_STEP)*np.cos(SCAN_ANGLE_DEG*np.pi/180)
-	y = DEVICE_CENTER['y'] + np.arange(-SCAN_LENGTH/2,SCAN_LENGTH/2, SCAN_STEP)*np.sin(SCAN_ANGLE_DEG*np.pi/180)
+	scan_step = SCAN_STEP if not args.adaptive else ADAPTIVE_SCAN_COARSE_STEP
+	x = DEVICE_CENTER['x'] + np.arange(-SCAN_LENGTH/2,SCAN_LENGTH/2, scan_step)*np.cos(SCAN_ANGLE_DEG*np.pi/180)
+	y = DEVICE_CENTER['y'] + np.arange(-SCAN_LENGTH/2,SCAN_LENGTH/2, scan_step)*np.sin(SCAN_ANGLE_DEG*np.pi/180)
 	z = DEVICE_CENTER['z'] + 0*x + 0*y
 	positions = []
 	for i in range(len(y)):
 		positions.append( [ x[i],y[i],z[i] ] )
 	
 	print('Connecting with the instruments...')
-	the_setup = TheSetup()
+	if args.simulate:
+		from simulated_setup import SimulatedTheSetup, SimulatedDevice
+		the_setup = SimulatedTheSetup(device=SimulatedDevice(center=(DEVICE_CENTER['x'],DEVICE_CENTER['y'],DEVICE_CENTER['z'])), profile=args.profile)
+		telegram_reporter_data_dict = None
+	else:
+		import my_telegram_bots
+		the_setup = TheSetup(profile=args.profile)
+		telegram_reporter_data_dict = {'token': my_telegram_bots.robobot.token, 'chat_id': my_telegram_bots.chat_ids['Robobot TCT setup']}
 	
 	measurement_base_path = script_core(
 		measurement_name = input('Measurement name? ').replace(' ', '_'),
@@ -159,5 +286,8 @@ if __name__ == '__main__':
 		positions = positions,
 		n_triggers = N_TRIGGERS_PER_POSITION,
 		acquire_channels = [1,2],
+		telegram_reporter_data_dict = telegram_reporter_data_dict,
+		resume = args.resume,
+		adaptive_sampling = {'minimum step (m)': SCAN_STEP} if args.adaptive else None,
 	)
 	post_process(measurement_base_path, silent=False)
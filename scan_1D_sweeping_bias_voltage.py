@@ -85,6 +85,7 @@ with reporter.report_for_loop(len(BIAS_VOLTAGES), f'{Rick.measurement_name}') as
 			positions = positions,
 			n_triggers = N_TRIGGERS_PER_POSITION,
 			acquire_channels = OSCILLOSCOPE_CHANNELS,
+			telegram_reporter_data_dict = {'token': my_telegram_bots.robobot.token, 'chat_id': my_telegram_bots.chat_ids['Robobot TCT setup']},
 		)
 		
 		# Post process in a separate process so the machine can keep on measuring in the meantime...
@@ -1,7 +1,9 @@
-from data_processing_bureaucrat.Bureaucrat import Bureaucrat, TelegramReportingInformation # https://github.com/SengerM/data_processing_bureaucrat
+from bureaucrat.Bureaucrat import Bureaucrat # https://github.com/SengerM/bureaucrat
 from pathlib import Path
 import tct_scripts_config
 from scan_1D import script_core as scan_1D
+from parse_waveforms_from_scan_1D import script_core as parse_waveforms
+import utils
 import numpy as np
 import pandas
 
@@ -13,51 +15,51 @@ def script_core(
 	the_setup,
 	n_triggers: int = 1,
 	acquire_channels = [1,2,3,4],
-	two_pulses = False,
+	scan_path: str = 'serpentine', # Order in which the positions are measured, see `utils.plan_scan_path`. The data is always stored in the order of `positions`.
+	telegram_reporter_data_dict: dict = None, # A dictionary of the form `{'token': str, 'chat_id': str}` to report the progress, if `None` it is not reported.
 ):
 	bureaucrat = Bureaucrat(
-		str(tct_scripts_config.DATA_STORAGE_DIRECTORY_PATH/Path(measurement_name)),
+		tct_scripts_config.DATA_STORAGE_DIRECTORY_PATH/Path(measurement_name),
 		variables = locals(),
 		new_measurement = True,
 	)
 	
-	flat_list_of_positions = []
-	n_position_1s = []
-	n_position_2s = []
-	n_positions = []
-	n_position = 0
-	for n1, sublist_of_positions in enumerate(positions):
-		for n2, position in enumerate(sublist_of_positions):
-			flat_list_of_positions.append(position)
-			n_position_1s.append(n1)
-			n_position_2s.append(n2)
-			n_positions.append(n_position)
-			n_position += 1
-	n_positions_df = pandas.DataFrame({'n_position_1': n_position_1s, 'n_position_2': n_position_2s, 'n_position': n_positions})
-	
 	with bureaucrat.verify_no_errors_context():
+		path = utils.plan_scan_path(positions, method=scan_path)
+		n_position_of_each_row = np.cumsum([0] + [len(row) for row in positions]) # To number the positions as in `positions`.
+		scan_path_df = pandas.DataFrame(
+			{
+				'n_position_in_path': np.arange(len(path)),
+				'n_position_1': [n1 for n1,n2 in path],
+				'n_position_2': [n2 for n1,n2 in path],
+				'n_position': [n_position_of_each_row[n1] + n2 for n1,n2 in path],
+			}
+		)
+		path_positions = [positions[n1][n2] for n1,n2 in path]
+		for n_coordinate, coordinate in enumerate(['x (m)','y (m)','z (m)']):
+			scan_path_df[coordinate] = [position[n_coordinate] for position in path_positions]
+		scan_path_df.to_csv(bureaucrat.processed_data_dir_path/Path('scan_path.csv'), index=False)
+		print(f'Stages travel with {repr(scan_path)} path: {utils.scan_path_length(path_positions)*1e3:.2f} mm (row by row it would be {utils.scan_path_length([position for row in positions for position in row])*1e3:.2f} mm).')
+		
 		path_to_scan_1D_data = scan_1D(
-			measurement_name = measurement_name, 
+			measurement_name = f'{bureaucrat.measurement_name}_scan_1D',
 			bias_voltage = bias_voltage,
 			laser_DAC = laser_DAC,
-			positions = flat_list_of_positions,
+			positions = path_positions,
 			the_setup = the_setup,
 			n_triggers = n_triggers,
 			acquire_channels = acquire_channels,
-			two_pulses = two_pulses,
-			external_Telegram_reporter = None,
+			telegram_reporter_data_dict = telegram_reporter_data_dict,
 		)
-		(path_to_scan_1D_data/Path('scan_1D')).rename(bureaucrat.processed_data_dir_path/Path('scan_1D'))
-		path_to_scan_1D_data.rmdir()
+		parse_waveforms(path_to_scan_1D_data)
+		path_to_scan_1D_data = path_to_scan_1D_data.rename(bureaucrat.processed_data_dir_path/Path('scan_1D')) # Keep the raw measurement inside this one.
 		
-		original_data_file_path = bureaucrat.processed_data_dir_path/Path('scan_1D/measured_data.fd')
-		measured_data_df = pandas.read_feather(original_data_file_path)
-		n_positions_df = n_positions_df.set_index('n_position')
-		measured_data_df = measured_data_df.set_index('n_position')
-		for col in n_positions_df.columns:
-			measured_data_df[col] = n_positions_df[col]
-		measured_data_df.reset_index().to_feather(bureaucrat.processed_data_dir_path/Path('measured_data.fd'))
-		original_data_file_path.unlink()
+		# Remap the data from the order in which it was measured to the order of `positions` ---
+		measured_data_df = pandas.read_feather(path_to_scan_1D_data/Path('parse_waveforms_from_scan_1D')/Path('data.fd')) # The directory that `Bureaucrat` creates for the script, read directly so no new `Bureaucrat` is created inside a finished measurement.
+		measured_data_df = measured_data_df.rename(columns={'n_position': 'n_position_in_path'})
+		measured_data_df = measured_data_df.merge(scan_path_df[['n_position_in_path','n_position','n_position_1','n_position_2']], on='n_position_in_path')
+		measured_data_df = measured_data_df.sort_values(by=[column for column in ['n_position','n_trigger','n_channel','n_pulse'] if column in measured_data_df.columns], kind='stable')
+		measured_data_df.reset_index(drop=True).to_feather(bureaucrat.processed_data_dir_path/Path('measured_data.fd'))
 		
 		return bureaucrat.measurement_base_path
 
@@ -65,6 +67,18 @@ def script_core(
 
 if __name__ == '__main__':
 	from TheSetup import TheSetup
+	from plotting_scripts.plot_everything_from_2D_scan import script_core as plot_everything_from_2D_scan
+	import argparse
+	import my_telegram_bots
+	
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--scan_path',
+		help = f'Order in which the positions are measured, one of {sorted(utils.SCAN_PATH_METHODS)}. Default is "serpentine".',
+		dest = 'scan_path',
+		default = 'serpentine',
+		type = str,
+	)
+	args = parser.parse_args()
 	
 	X_MIDDLE = -3.474072265625e-3
 	Y_MIDDLE = 0.172451171875e-3
@@ -76,7 +90,7 @@ if __name__ == '__main__':
 	x_positions = np.linspace(-SWEEP_LENGTH_X/2,SWEEP_LENGTH_X/2,int(SWEEP_LENGTH_X/STEP_SIZE)) + X_MIDDLE
 	y_positions = np.linspace(-SWEEP_LENGTH_Y/2,SWEEP_LENGTH_Y/2,int(SWEEP_LENGTH_Y/STEP_SIZE)) + Y_MIDDLE
 	
-	script_core(
+	measurement_base_path = script_core(
 		measurement_name = input('Measurement name? ').replace(' ', '_'),
 		the_setup = TheSetup(),
 		bias_voltage = 55,
@@ -84,6 +98,7 @@ if __name__ == '__main__':
 		positions = [[(x,y,Z_FOCUS) for y in y_positions] for x in x_positions],
 		n_triggers = 4,
 		acquire_channels = [1,2],
-		two_pulses = True,
+		scan_path = args.scan_path,
+		telegram_reporter_data_dict = {'token': my_telegram_bots.robobot.token, 'chat_id': my_telegram_bots.chat_ids['Robobot TCT setup']},
 	)
-
+	plot_everything_from_2D_scan(measurement_base_path)
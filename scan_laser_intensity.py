@@ -3,10 +3,11 @@ from time import sleep
 import grafica # https://github.com/SengerM/grafica
 from lgadtools.LGADSignal import LGADSignal # https://github.com/SengerM/lgadtools
 from data_processing_bureaucrat.Bureaucrat import Bureaucrat, TelegramReportingInformation # https://github.com/SengerM/data_processing_bureaucrat
-from progressreporting.TelegramProgressReporter import TelegramReporter # https://github.com/SengerM/progressreporting
 from pathlib import Path
 import pandas
 import datetime
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack # https://stackoverflow.com/a/34798330/8849755
 import utils
 import tct_scripts_config
 from TheSetup import TheSetup
@@ -14,6 +15,92 @@ from plotting_scripts.plot_everything_from_laser_intensity_scan import script_co
 
 TIMES_AT = [10,20,30,40,50,60,70,80,90]
 
+def analyze_waveform(time, samples, plot_title: str=None, plot_subtitle: str=None, plot_directory: Path=None):
+	"""Computes the features of a single pulse using `LGADSignal`, and
+	optionally saves a plot of it. This function is self contained so it
+	can be run in a worker process.
+	
+	Parameters
+	----------
+	time, samples: array
+		The waveform of a single pulse.
+	plot_title: str, optional
+		If given, a plot of the signal is saved in `plot_directory` with this title.
+	plot_subtitle: str, optional
+		Subtitle for the plot.
+	plot_directory: Path, optional
+		Where to save the plot.
+	
+	Returns
+	-------
+	features: dict
+		A dictionary of the form `{'Amplitude (V)': float, ...}`.
+	"""
+	signal = LGADSignal(
+		time = time,
+		samples = samples,
+	)
+	features = {
+		'Amplitude (V)': signal.amplitude,
+		'Noise (V)': signal.noise,
+		'Rise time (s)': signal.rise_time,
+		'Collected charge (V s)': signal.collected_charge,
+		'Time over noise (s)': signal.time_over_noise,
+	}
+	for pp in TIMES_AT:
+		features[f't_{pp} (s)'] = signal.time_at_rising_edge(pp)
+	if plot_title is not None:
+		fig = grafica.new(
+			title = plot_title,
+			subtitle = plot_subtitle,
+			xlabel = 'Time (s)',
+			ylabel = 'Amplitude (V)',
+			plotter_name = 'plotly',
+		)
+		signal.plot_grafica(fig)
+		for pp in TIMES_AT:
+			try:
+				fig.scatter(
+					[signal.time_at_rising_edge(pp)],
+					[signal.signal_at(signal.time_at_rising_edge(pp))],
+					marker = 'x',
+					linestyle = 'none',
+					label = f'Time at {pp} %',
+					color = (0,0,0),
+				)
+			except Exception as e:
+				print(f'Cannot plot "times at X %", reason {e}.')
+		grafica.save_unsaved(mkdir=plot_directory)
+	return features
+
+def merge_finished_analyses(pending_analyses: dict, measured_data_rows: list, wait: bool=False):
+	"""Appends to `measured_data_rows` the results of the analyses running
+	in background that have finished, and removes them from `pending_analyses`.
+	The results are appended in the order in which the analyses were
+	submitted, so the rows are in the same order in which they were measured
+	no matter which worker finishes first.
+	
+	Parameters
+	----------
+	pending_analyses: dict
+		A dictionary of the form `{(n_DAC, n_trigger, n_channel, n_pulse): (metadata, future)}`,
+		in the order in which they were submitted, where `metadata` is a
+		dictionary with the columns that are not computed by `analyze_waveform`
+		and `future` gives the result of `analyze_waveform` for that pulse.
+	measured_data_rows: list
+		The list to which to append the results, one dictionary per pulse.
+	wait: bool, default False
+		If `True` waits for all the analyses to finish, otherwise only
+		those already finished are merged.
+	"""
+	while len(pending_analyses) > 0:
+		key = next(iter(pending_analyses)) # The oldest one.
+		metadata, future = pending_analyses[key]
+		if not wait and not future.done(): # The next ones have to wait for it, to keep the order.
+			break
+		del pending_analyses[key]
+		measured_data_rows.append({**metadata, **future.result()})
+
 def script_core(
 		measurement_name: str, 
 		bias_voltage: float,
@@ -23,6 +110,11 @@ def script_core(
 		acquire_channels = [1,2,3,4],
 		two_pulses = True,
 		external_Telegram_reporter=None,
+		use_sequence_mode: bool = False, # If `True` all the triggers for each DAC value are acquired at once using the sequence mode of the oscilloscope, see `TheSetup.acquire_segments`.
+		slow_readback_period: float = 1, # Seconds between each reading of bias voltage, bias current, temperature and humidity, which are measured in the background.
+		analysis_workers: int = 0, # Number of worker processes to compute the features of each pulse and do the plots in background while the acquisition continues. If `0` everything is done in this process, one trigger after the other.
+		max_pending_analyses: int = 10000, # If the analysis workers are slower than the acquisition, the acquisition waits when this number of pulses is waiting to be analyzed.
+		telegram_reporter_data_dict: dict = None, # A dictionary of the form `{'token': str, 'chat_id': str}` to report the progress, if `None` it is not reported.
 	):
 	bureaucrat = Bureaucrat(
 		str(tct_scripts_config.DATA_STORAGE_DIRECTORY_PATH/Path(measurement_name)),
@@ -32,6 +124,8 @@ def script_core(
 	
 	if not isinstance(the_setup, TheSetup):
 		raise TypeError(f'`the_setup` must be an instance of {TheSetup}, received object of type {type(the_setup)}.')
+	if not isinstance(analysis_workers, int) or analysis_workers < 0:
+		raise ValueError(f'`analysis_workers` must be a non negative integer, received {repr(analysis_workers)}.')
 	
 	if two_pulses:
 		the_setup.configure_oscilloscope_for_two_pulses()
@@ -49,31 +143,41 @@ def script_core(
 	for pp in TIMES_AT:
 		data_frame_columns += [f't_{pp} (s)']
 	measured_data_df = pandas.DataFrame(columns = data_frame_columns)
+	measured_data_rows = [] # One dictionary per pulse, converted into a data frame only when it is saved, because growing a data frame row by row is quadratic.
 	
-	reporter = TelegramReporter(
-		telegram_token = TelegramReportingInformation().token, 
-		telegram_chat_id = TelegramReportingInformation().chat_id,
-	)
+	if telegram_reporter_data_dict is not None:
+		from progressreporting.TelegramProgressReporter import TelegramReporter # https://github.com/SengerM/progressreporting
+		reporter = TelegramReporter(
+			telegram_token = telegram_reporter_data_dict['token'], 
+			telegram_chat_id = telegram_reporter_data_dict['chat_id'],
+		)
 	average_waveforms_df = pandas.DataFrame(columns={'n_DAC','n_channel','n_pulse','Amplitude mean (V)','Amplitude std (V)','Time (s)'})
 	
 	measured_data_df_dumper = utils.DataFrameDumper(bureaucrat.processed_data_dir_path/Path('measured_data.fd'), measured_data_df)
 	waveforms_df_dumper = utils.DataFrameDumper(bureaucrat.processed_data_dir_path/Path('average_waveforms.fd'), average_waveforms_df)
 	
-	with reporter.report_for_loop(len(laser_DAC_values)*n_triggers, f'{bureaucrat.measurement_name}') as reporter:
+	pending_analyses = {}
+	the_setup.start_slow_readback_sampler(period=slow_readback_period)
+	slow_readback_sampler = ExitStack()
+	slow_readback_sampler.callback(the_setup.stop_slow_readback_sampler) # Also if the measurement fails, so the instruments are not polled afterwards.
+	with slow_readback_sampler, reporter.report_for_loop(len(laser_DAC_values)*n_triggers, f'{bureaucrat.measurement_name}') if telegram_reporter_data_dict is not None else ExitStack() as reporter, ProcessPoolExecutor(max_workers=analysis_workers) if analysis_workers > 0 else ExitStack() as analysis_pool:
 		for n_DAC, target_DAC in enumerate(laser_DAC_values):
 			the_setup.laser_DAC = int(target_DAC)
 			sleep(0.1)
 			position = the_setup.position
-			this_position_signals_df = pandas.DataFrame(columns={'n_channel','n_pulse','Samples (V)','Time (s)'})
+			this_DAC_waveforms_averager = utils.WaveformsAverager(group_by=['n_channel','n_pulse'])
+			if use_sequence_mode:
+				print(f'Measuring: n_DAC={n_DAC}/{len(laser_DAC_values)-1}, {n_triggers} triggers in sequence mode...')
+				raw_waveforms_each_trigger = utils.acquire_nice_triggers_without_EMI_in_sequence_mode(the_setup, acquire_channels, n_triggers)
 			for n_trigger in range(n_triggers):
 				plot_this_trigger = np.random.rand() < 20/(len(laser_DAC_values)*n_triggers)
-				print(f'Measuring: n_DAC={n_DAC}/{len(laser_DAC_values)-1}, n_trigger={n_trigger}/{n_triggers-1}...')
-				utils.wait_for_nice_trigger_without_EMI(the_setup, acquire_channels)
+				if use_sequence_mode:
+					raw_waveforms = raw_waveforms_each_trigger[n_trigger]
+				else:
+					print(f'Measuring: n_DAC={n_DAC}/{len(laser_DAC_values)-1}, n_trigger={n_trigger}/{n_triggers-1}...')
+					raw_waveforms = utils.wait_for_nice_trigger_without_EMI(the_setup, acquire_channels)
 				for n_channel in acquire_channels:
-					try:
-						raw_data = the_setup.get_waveform(channel = n_channel)
-					except Exception as e:
-						print(f'Cannot get data from oscilloscope, reason: {e}')
+					raw_data = raw_waveforms[n_channel]
 					raw_data_each_pulse = {}
 					if not two_pulses:
 						raw_data_each_pulse[1] = raw_data
@@ -86,16 +190,8 @@ def script_core(
 								if n_pulse == 2:
 									raw_data_each_pulse[n_pulse][variable] = raw_data[variable][int(len(raw_data[variable])/2):]
 					for n_pulse in raw_data_each_pulse.keys():
-						signal = LGADSignal(
-							time = raw_data_each_pulse[n_pulse]['Time (s)'],
-							samples = raw_data_each_pulse[n_pulse]['Amplitude (V)'],
-						)
-						# Because measuring bias voltage and current takes a long time, I do the following ---
-						measure_bias_IV_in_this_iteration = False
-						if 'last_time_bias_IV_was_measured' not in locals() or (datetime.datetime.now()-last_time_bias_IV_was_measured).seconds >= 11:
-							measure_bias_IV_in_this_iteration = True
-							last_time_bias_IV_was_measured = datetime.datetime.now()
-						measured_data_dict = {
+						now = datetime.datetime.now()
+						metadata = {
 							'n_DAC': n_DAC,
 							'n_trigger': n_trigger,
 							'n_channel': n_channel,
@@ -103,80 +199,57 @@ def script_core(
 							'x (m)': position[0],
 							'y (m)': position[1],
 							'z (m)': position[2],
-							'When': datetime.datetime.now(),
-							'Bias voltage (V)': the_setup.bias_voltage if measure_bias_IV_in_this_iteration else float('NaN'),
-							'Bias current (A)': the_setup.bias_current if measure_bias_IV_in_this_iteration else float('NaN'),
+							'When': now,
 							'Laser DAC': the_setup.laser_DAC,
-							'Temperature (°C)': the_setup.temperature,
-							'Humidity (%RH)': the_setup.humidity,
-							'Amplitude (V)': signal.amplitude,
-							'Noise (V)': signal.noise,
-							'Rise time (s)': signal.rise_time,
-							'Collected charge (V s)': signal.collected_charge,
-							'Time over noise (s)': signal.time_over_noise,
+							**the_setup.slow_readbacks(when=now.timestamp()), # Bias voltage, current, temperature and humidity, measured in the background because they are slow.
+						}
+						analysis_arguments = {
+							'time': raw_data_each_pulse[n_pulse]['Time (s)'],
+							'samples': raw_data_each_pulse[n_pulse]['Amplitude (V)'],
 						}
-						for pp in TIMES_AT:
-							measured_data_dict[f't_{pp} (s)'] = signal.time_at_rising_edge(pp)
-						measured_data_df = measured_data_df.append(measured_data_dict, ignore_index = True)
+						if plot_this_trigger:
+							analysis_arguments['plot_title'] = f'Signal at n_DAC {n_DAC} n_trigger {n_trigger} n_channel {n_channel} n_pulse {n_pulse}'
+							analysis_arguments['plot_subtitle'] = f'Measurement: {bureaucrat.measurement_name}'
+							analysis_arguments['plot_directory'] = bureaucrat.processed_data_dir_path/Path('some_random_processed_signals_plots')
+						if analysis_workers == 0:
+							measured_data_rows.append({**metadata, **analyze_waveform(**analysis_arguments)})
+						else:
+							if len(pending_analyses) >= max_pending_analyses: # Wait for the oldest one, otherwise the memory would grow without limit.
+								next(iter(pending_analyses.values()))[1].result()
+							pending_analyses[(n_DAC, n_trigger, n_channel, n_pulse)] = (metadata, analysis_pool.submit(analyze_waveform, **analysis_arguments))
+							merge_finished_analyses(pending_analyses, measured_data_rows)
 						
-						this_position_signals_df = this_position_signals_df.append(
-							pandas.DataFrame(
-								{
-									'n_channel': n_channel,
-									'n_pulse': n_pulse,
-									'Samples (V)': list(signal.samples),
-									'Time (s)': list(signal.time),
-								}
-							),
-							ignore_index = True,
+						this_DAC_waveforms_averager.add(
+							metadata = {'n_channel': n_channel, 'n_pulse': n_pulse},
+							time = raw_data_each_pulse[n_pulse]['Time (s)'],
+							amplitude = raw_data_each_pulse[n_pulse]['Amplitude (V)'],
 						)
-						# Save data and do some plots ---
+						# Save data ---
 						if 'last_time_data_was_saved' not in locals() or (datetime.datetime.now()-last_time_data_was_saved).seconds >= 60*5:
-							measured_data_df = measured_data_df_dumper.dump_to_disk(measured_data_df)
+							measured_data_df_dumper.dump_to_disk(pandas.DataFrame(measured_data_rows, columns=data_frame_columns), force=True)
+							measured_data_rows.clear()
 							average_waveforms_df = waveforms_df_dumper.dump_to_disk(average_waveforms_df)
 							last_time_data_was_saved = datetime.datetime.now()
-						if plot_this_trigger:
-							fig = grafica.new(
-								title = f'Signal at n_DAC {n_DAC} n_trigger {n_trigger} n_channel {n_channel} n_pulse {n_pulse}',
-								subtitle = f'Measurement: {bureaucrat.measurement_name}',
-								xlabel = 'Time (s)',
-								ylabel = 'Amplitude (V)',
-								plotter_name = 'plotly',
-							)
-							signal.plot_grafica(fig)
-							for pp in TIMES_AT:
-								try:
-									fig.scatter(
-										[signal.time_at_rising_edge(pp)],
-										[signal.signal_at(signal.time_at_rising_edge(pp))],
-										marker = 'x',
-										linestyle = 'none',
-										label = f'Time at {pp} %',
-										color = (0,0,0),
-									)
-								except Exception as e:
-									print(f'Cannot plot "times at X %", reason {e}.')
-							grafica.save_unsaved(mkdir=bureaucrat.processed_data_dir_path/Path('some_random_processed_signals_plots'))
-				reporter.update(1)
+				if telegram_reporter_data_dict is not None:
+					reporter.update(1)
 				try:
 					external_Telegram_reporter.update(1)
 				except:
 					pass
 			
-			this_DAC_mean_df = this_position_signals_df.groupby(['n_channel','n_pulse','Time (s)']).mean()
-			this_DAC_mean_df.rename(columns={'Samples (V)': 'Amplitude mean (V)'}, inplace=True)
-			this_DAC_mean_df['Amplitude std (V)'] = this_position_signals_df.groupby(['n_channel','n_pulse','Time (s)']).std()['Samples (V)']
+			this_DAC_mean_df = this_DAC_waveforms_averager.dataframe().drop(columns='Number of waveforms') # Averaged sample by sample, the time is the mean time of each sample.
 			this_DAC_mean_df['n_DAC'] = n_DAC
-			this_DAC_mean_df.reset_index(inplace=True)
-			this_DAC_mean_df.set_index(['n_DAC','n_channel','n_pulse'], inplace=True)
-			average_waveforms_df.set_index(['n_DAC','n_channel','n_pulse'], inplace=True)
-			average_waveforms_df = average_waveforms_df.append(this_DAC_mean_df)
-			average_waveforms_df = average_waveforms_df.reset_index()
+			average_waveforms_df = pandas.concat([average_waveforms_df, this_DAC_mean_df[average_waveforms_df.columns]], ignore_index=True)
+		merge_finished_analyses(pending_analyses, measured_data_rows, wait=True)
 	# Save remaining data ---
 	print('Finished measuring! :)')
 	print('Merging dumped dataframes...')
-	measured_data_df_dumper.end(measured_data_df)
+	measured_data_df_dumper.end(pandas.DataFrame(measured_data_rows, columns=data_frame_columns))
 	waveforms_df_dumper.end(average_waveforms_df)
+	dumpers_statistics_df = pandas.DataFrame([measured_data_df_dumper.statistics(), waveforms_df_dumper.statistics()])
+	print(f'Writing of the data in background:\n{dumpers_statistics_df.to_string(index=False)}')
+	dumpers_statistics_df.to_csv(bureaucrat.processed_data_dir_path/Path('data_writing_statistics.csv'), index=False)
+	the_setup.dump_profile(bureaucrat.processed_data_dir_path) # Only if it was created with `profile=True`.
 	print('Doing plots...')
 	plot_everything_from_laser_intensity_scan(directory = bureaucrat.measurement_base_path)
 	print('Finished plotting!')
@@ -186,12 +259,33 @@ def script_core(
 ########################################################################
 
 if __name__ == '__main__':
-	the_setup = TheSetup()
+	import argparse
+	
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--simulate',
+		help = 'Use this option to run with simulated instruments instead of the real ones, see `simulated_setup.py`.',
+		dest = 'simulate',
+		action = 'store_true',
+	)
+	parser.add_argument('--profile',
+		help = 'Use this option to measure the time spent in each operation of the setup, it is saved with the measurement.',
+		dest = 'profile',
+		action = 'store_true',
+	)
+	args = parser.parse_args()
 	
-	center_position = utils.get_center_position_from_file()
-	if center_position is not None:
-		position_to_measure = np.array(center_position) + 70e-6/2**.5*np.array((1,-1,0)) # Move to the middle of the window.
-		the_setup.move_to(*position_to_measure)
+	if args.simulate:
+		from simulated_setup import SimulatedTheSetup
+		the_setup = SimulatedTheSetup(profile=args.profile)
+		the_setup.move_to(x=the_setup.device.center[0]+100e-6) # Inside the pixel of channel 2 of the simulated device, see `SimulatedDevice`.
+		telegram_reporter_data_dict = None
+	else:
+		the_setup = TheSetup(profile=args.profile)
+		telegram_reporter_data_dict = {'token': TelegramReportingInformation().token, 'chat_id': TelegramReportingInformation().chat_id}
+		center_position = utils.get_center_position_from_file()
+		if center_position is not None:
+			position_to_measure = np.array(center_position) + 70e-6/2**.5*np.array((1,-1,0)) # Move to the middle of the window.
+			the_setup.move_to(*position_to_measure)
 	
 	script_core(
 		measurement_name = input('Measurement name? ').replace(' ', '_'),
@@ -201,4 +295,5 @@ if __name__ == '__main__':
 		n_triggers = 55,
 		acquire_channels = [2],
 		two_pulses = True,
+		telegram_reporter_data_dict = telegram_reporter_data_dict,
 	)
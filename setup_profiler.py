@@ -0,0 +1,152 @@
+import threading
+import time
+import numpy as np
+import pandas
+from pathlib import Path
+from contextlib import contextmanager
+
+HISTOGRAM_BINS_EDGES = np.logspace(-7, 3, 41) # Seconds, from 100 ns to 1000 s with 4 bins per decade.
+
+class LatencyHistogram:
+	"""Accumulates durations in a histogram with logarithmic bins (see
+	`HISTOGRAM_BINS_EDGES`) so it takes the same memory no matter how
+	many times it is used, e.g. once per trigger during a whole night."""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._counts = np.zeros(len(HISTOGRAM_BINS_EDGES)+1, dtype=int) # The first and last bins are underflow and overflow.
+		self._n = 0
+		self._total_seconds = 0
+		self._max_seconds = 0
+
+	def add(self, seconds: float):
+		with self._lock:
+			self._counts[np.searchsorted(HISTOGRAM_BINS_EDGES, seconds, side='right')] += 1
+			self._n += 1
+			self._total_seconds += seconds
+			self._max_seconds = max(self._max_seconds, seconds)
+
+	def quantile(self, q: float):
+		"""Returns an upper bound for the quantile `q` (e.g. `.99`), i.e.
+		the upper edge of the bin in which it falls."""
+		with self._lock:
+			if self._n == 0:
+				return float('NaN')
+			n_bin = int(np.searchsorted(np.cumsum(self._counts), q*self._n))
+			return float(HISTOGRAM_BINS_EDGES[n_bin]) if n_bin < len(HISTOGRAM_BINS_EDGES) else self._max_seconds
+
+	def summary(self):
+		"""Returns a dictionary with the statistics of the durations."""
+		with self._lock:
+			n, total_seconds, max_seconds = self._n, self._total_seconds, self._max_seconds
+		return {
+			'Number of calls': n,
+			'Total time (s)': total_seconds,
+			'Mean time (s)': total_seconds/n if n > 0 else float('NaN'),
+			'Median time upper bound (s)': self.quantile(.5),
+			'99 % quantile upper bound (s)': self.quantile(.99),
+			'Max time (s)': max_seconds if n > 0 else float('NaN'),
+		}
+
+	def histogram(self):
+		"""Returns a list of dictionaries, one per non empty bin, of the
+		form `{'Time from (s)': float, 'Time to (s)': float, 'Count': int}`."""
+		with self._lock:
+			counts = self._counts.copy()
+		edges = np.concatenate([[0], HISTOGRAM_BINS_EDGES, [float('inf')]])
+		return [{'Time from (s)': edges[n_bin], 'Time to (s)': edges[n_bin+1], 'Count': int(count)} for n_bin, count in enumerate(counts) if count > 0]
+
+class TimedRLock:
+	"""A `threading.RLock` that measures how long each `acquire` waited,
+	i.e. the time a thread was blocked because another thread was using
+	the instrument."""
+	def __init__(self, wait_histogram: LatencyHistogram):
+		self._lock = threading.RLock()
+		self._wait_histogram = wait_histogram
+
+	def acquire(self, blocking: bool=True, timeout: float=-1):
+		start = time.perf_counter()
+		acquired = self._lock.acquire(blocking, timeout)
+		self._wait_histogram.add(time.perf_counter() - start)
+		return acquired
+
+	def release(self):
+		self._lock.release()
+
+	def __enter__(self):
+		return self.acquire()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.release()
+
+class SetupProfiler:
+	"""Collects the time spent in each method of `TheSetup` and the time
+	waited for the lock of each instrument. It is enabled with
+	`TheSetup(profile=True)` and then available in `the_setup.profiler`.
+	The time of an operation includes the time it waited for the lock,
+	which is also reported separately under the name of the lock.
+
+	Usage:
+	```
+	the_setup = TheSetup(profile=True)
+	... # Measure.
+	print(the_setup.profiler.statistics_dataframe())
+	the_setup.profiler.dump(directory)
+	```
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._operations = {}
+		self._locks = {}
+		self._started_when = time.monotonic()
+
+	def _histogram(self, histograms: dict, name: str):
+		with self._lock:
+			if name not in histograms:
+				histograms[name] = LatencyHistogram()
+			return histograms[name]
+
+	@contextmanager
+	def measure(self, operation: str):
+		"""Use as `with profiler.measure('move_to'): do_stuff()` to add the time spent in `do_stuff` to `operation`."""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self._histogram(self._operations, operation).add(time.perf_counter() - start)
+
+	def timed_lock(self, name: str):
+		"""Returns a new `TimedRLock` whose waiting times are reported as `name`."""
+		return TimedRLock(self._histogram(self._locks, name))
+
+	def statistics(self):
+		"""Returns a list of dictionaries with the statistics of each
+		operation and lock, sorted by total time."""
+		with self._lock:
+			histograms = [('Operation', name, histogram) for name, histogram in self._operations.items()] + [('Lock wait', name, histogram) for name, histogram in self._locks.items()]
+		elapsed_seconds = time.monotonic() - self._started_when
+		statistics = []
+		for kind, name, histogram in histograms:
+			summary = histogram.summary()
+			statistics.append({
+				'Kind': kind,
+				'Name': name,
+				**summary,
+				'Fraction of elapsed time': summary['Total time (s)']/elapsed_seconds if elapsed_seconds > 0 else float('NaN'),
+			})
+		return sorted(statistics, key=lambda row: row['Total time (s)'], reverse=True)
+
+	def statistics_dataframe(self):
+		return pandas.DataFrame(self.statistics())
+
+	def histograms_dataframe(self):
+		"""Returns a data frame with the histogram of each operation and lock."""
+		with self._lock:
+			histograms = [('Operation', name, histogram) for name, histogram in self._operations.items()] + [('Lock wait', name, histogram) for name, histogram in self._locks.items()]
+		return pandas.DataFrame([{'Kind': kind, 'Name': name, **row} for kind, name, histogram in histograms for row in histogram.histogram()])
+
+	def dump(self, directory: Path):
+		"""Writes `setup_profile_statistics.csv` and `setup_profile_histograms.csv` in `directory`."""
+		directory = Path(directory)
+		directory.mkdir(parents=True, exist_ok=True)
+		self.statistics_dataframe().to_csv(directory/Path('setup_profile_statistics.csv'), index=False)
+		self.histograms_dataframe().to_csv(directory/Path('setup_profile_histograms.csv'), index=False)
@@ -0,0 +1,457 @@
+import numpy as np
+from time import sleep
+import time
+from math import erf
+from TheSetup import TheSetup
+
+DEFAULT_LATENCIES = { # Seconds that each operation takes, roughly as in the real setup.
+	'move_to': 50e-3, # Fixed time of each movement, plus the distance divided by `stages_speed`.
+	'position': 5e-3,
+	'laser': 10e-3, # Reading or setting the status or DAC of the laser.
+	'keithley': 20e-3, # Each measurement or setting of the Keithley.
+	'temperature_controller': 50e-3, # Each reading of temperature or humidity.
+	'get_waveform': 5e-3, # Each transfer of a waveform from the oscilloscope.
+}
+
+def lgad_pulse(time, t_start: float, amplitude: float, rise_time: float=500e-12, fall_time: float=1.5e-9):
+	"""Returns a simple model of an LGAD pulse as seen in the oscilloscope,
+	i.e. a positive pulse starting at `t_start` that rises in `rise_time`
+	and decays in `fall_time`."""
+	t = np.asarray(time) - t_start
+	pulse = np.where(
+		t > 0,
+		np.exp(-t.clip(0)/fall_time) - np.exp(-t.clip(0)/rise_time*2),
+		0,
+	)
+	peak = np.max(np.exp(-np.linspace(0,10*fall_time,999)/fall_time) - np.exp(-np.linspace(0,10*fall_time,999)/rise_time*2))
+	return amplitude*pulse/peak
+
+class SimulatedLeCroyWaveRunner:
+	"""Mimics the methods of `TeledyneLeCroyPy.LeCroyWaveRunner` that are
+	used by `TheSetup`, producing synthetic waveforms with two pulses, so
+	the acquisition code can be run and tested without the oscilloscope.
+	Sequence mode is supported through `write('SEQUENCE ON,<n_segments>')`."""
+	def __init__(self, n_samples: int=2000, sampling_period: float=300e-12, trigger_period: float=1e-3, noise: float=2e-3, pulses_amplitude: dict=None, seed: int=None, emi_probability: float=0, emi_amplitude: float=1e3, amplitude_fluctuation: float=0, transfer_latency: float=0):
+		"""
+		Parameters
+		----------
+		n_samples: int, default 2000
+			Number of samples of each waveform.
+		sampling_period: float, default 300e-12
+			Time between samples, in seconds.
+		trigger_period: float, default 1e-3
+			Time between triggers, in seconds. `wait_for_single_trigger` sleeps this time for each trigger.
+		noise: float, default 2e-3
+			Standard deviation of the gaussian noise added to each sample, in volts.
+		pulses_amplitude: dict or callable, optional
+			Amplitude of the two pulses in each channel, of the form `{n_channel: (amplitude_pulse_1, amplitude_pulse_2)}`.
+			Channels not present here have a default amplitude. It can also
+			be a function `pulses_amplitude(n_channel) -> (amplitude_pulse_1, amplitude_pulse_2)`
+			which is called for each trigger, e.g. to depend on the position
+			of the stages (see `SimulatedTheSetup`).
+		seed: int, optional
+			Seed for the random numbers generator.
+		emi_probability: float, default 0
+			Probability that a waveform has EMI, i.e. an oscillation of
+			amplitude `emi_amplitude` over the whole waveform.
+		emi_amplitude: float, default 1e3
+			Amplitude of the EMI, in volts. The noise of a sine is `emi_amplitude/2**.5`
+			so it has to be above `111*2**.5` to be detected by `utils.is_EMI`.
+		amplitude_fluctuation: float, default 0
+			Relative fluctuation of the amplitude of the pulses from one
+			trigger to the other, as the gain of an LGAD fluctuates.
+		transfer_latency: float, default 0
+			Time that `get_waveform` takes, in seconds.
+		"""
+		self.n_samples = n_samples
+		self.sampling_period = sampling_period
+		self.trigger_period = trigger_period
+		self.noise = noise
+		self.pulses_amplitude = pulses_amplitude if pulses_amplitude is not None else {}
+		self._random = np.random.default_rng(seed)
+		self.emi_probability = emi_probability
+		self.emi_amplitude = emi_amplitude
+		self.amplitude_fluctuation = amplitude_fluctuation
+		self.transfer_latency = transfer_latency
+		self._n_segments = 1
+		self._sequence_mode = False
+		self._vdiv = {}
+		self._acquired = {}
+		self.n_transfers = 0 # Number of times `get_waveform` was called, to compare the different acquisition modes.
+
+	@property
+	def time(self):
+		return np.arange(self.n_samples)*self.sampling_period
+
+	def signal(self, channel: int, n_waveforms: int):
+		"""Returns an array of shape `(n_waveforms, n_samples)` with synthetic waveforms for `channel`."""
+		time = self.time
+		if callable(self.pulses_amplitude):
+			pulse_1_amplitude, pulse_2_amplitude = self.pulses_amplitude(channel)
+		else:
+			pulse_1_amplitude, pulse_2_amplitude = self.pulses_amplitude.get(channel, (50e-3, 50e-3))
+		pulse_1 = lgad_pulse(time, t_start=time[-1]/3, amplitude=1)
+		pulse_2 = lgad_pulse(time, t_start=time[-1]*2/3, amplitude=1)
+		fluctuation = self._random.lognormal(0, self.amplitude_fluctuation, size=(n_waveforms,2)) if self.amplitude_fluctuation > 0 else np.ones((n_waveforms,2))
+		waveforms = pulse_1_amplitude*fluctuation[:,[0]]*pulse_1 + pulse_2_amplitude*fluctuation[:,[1]]*pulse_2 + self._random.normal(0, self.noise, size=(n_waveforms, len(time)))
+		has_EMI = self._random.random(n_waveforms) < self.emi_probability
+		if any(has_EMI):
+			waveforms[has_EMI] += self.emi_amplitude*np.sin(2*np.pi*50e6*time + self._random.uniform(0, 2*np.pi, size=(sum(has_EMI),1)))
+		return waveforms
+
+	def set_trig_source(self, source):
+		pass
+	def set_trig_level(self, source, level):
+		pass
+	def set_trig_coupling(self, source, coupling):
+		pass
+	def set_trig_slope(self, source, slope):
+		pass
+	def set_tdiv(self, tdiv):
+		pass
+	def set_trig_delay(self, delay):
+		pass
+	def set_vdiv(self, channel, vdiv):
+		self._vdiv[channel] = vdiv
+
+	def write(self, msg: str):
+		"""Only the sequence mode commands are understood."""
+		command = msg.upper().replace(' ',',').split(',')
+		if command[0] in {'SEQUENCE','SEQ'}:
+			if command[1] == 'ON':
+				self._sequence_mode = True
+				self._n_segments = int(command[2]) if len(command) > 2 else self._n_segments
+			elif command[1] == 'OFF':
+				self._sequence_mode = False
+				self._n_segments = 1
+			else:
+				raise ValueError(f'Cannot understand command {repr(msg)}.')
+		else:
+			raise NotImplementedError(f'Command {repr(msg)} is not implemented in {repr(type(self))}.')
+
+	def wait_for_single_trigger(self):
+		sleep(self.trigger_period*self._n_segments)
+		self._acquired = {} # Waveforms are generated lazily, when requested.
+
+	def get_waveform(self, channel: int):
+		sleep(self.transfer_latency)
+		self.n_transfers += 1
+		if channel not in self._acquired:
+			self._acquired[channel] = self.signal(channel, self._n_segments)
+		amplitude = self._acquired[channel]
+		if channel in self._vdiv: # Saturate as the real oscilloscope would do.
+			amplitude = np.where(np.abs(amplitude) > 4*self._vdiv[channel], float('NaN'), amplitude)
+		return {
+			'Time (s)': np.tile(self.time, self._n_segments) + np.repeat(np.arange(self._n_segments), self.n_samples)*self.n_samples*self.sampling_period,
+			'Amplitude (V)': amplitude.reshape(-1),
+		}
+
+class SimulatedStages:
+	"""Mimics `PyticularsTCT.TCT.stages`. When a movement finishes, the
+	position read back is still off by `residual_error` times the length
+	of the movement, and this error decays exponentially with `settling_time`,
+	so long movements take longer to settle than short ones. If
+	`readback_resolution` is not 0 the position read back is rounded to
+	it, as a stage with a coarse encoder would do."""
+	def __init__(self, latencies: dict, speed: float=2e-3, settling_time: float=20e-3, residual_error: float=1e-3, readback_resolution: float=0):
+		self._latencies = latencies
+		self.speed = speed
+		self.settling_time = settling_time
+		self.residual_error = residual_error
+		self.readback_resolution = readback_resolution
+		self._position = (0., 0., 0.)
+		self._error_after_moving = (0., 0., 0.)
+		self._arrived_when = time.monotonic()
+
+	def move_to(self, x=None, y=None, z=None):
+		new_position = tuple(old if new is None else float(new) for old,new in zip(self._position, (x,y,z)))
+		distance = sum((a-b)**2 for a,b in zip(new_position, self._position))**.5
+		sleep(self._latencies['move_to'] + distance/self.speed)
+		self._error_after_moving = tuple((old-new)*self.residual_error for old,new in zip(self._position, new_position))
+		self._position = new_position
+		self._arrived_when = time.monotonic()
+
+	@property
+	def position(self):
+		sleep(self._latencies['position'])
+		decay = np.exp(-(time.monotonic()-self._arrived_when)/self.settling_time) if self.settling_time > 0 else 0
+		position = tuple(float(p + error*decay) for p,error in zip(self._position, self._error_after_moving))
+		if self.readback_resolution > 0:
+			position = tuple(float(np.round(p/self.readback_resolution)*self.readback_resolution) for p in position)
+		return position
+
+class SimulatedLaser:
+	"""Mimics `PyticularsTCT.TCT.laser`."""
+	def __init__(self, latencies: dict):
+		self._latencies = latencies
+		self._status = 'off'
+		self._DAC = 0
+
+	@property
+	def status(self):
+		sleep(self._latencies['laser'])
+		return self._status
+	@status.setter
+	def status(self, status: str):
+		if status not in {'on','off'}:
+			raise ValueError(f'`status` must be "on" or "off", received {repr(status)}.')
+		sleep(self._latencies['laser'])
+		self._status = status
+
+	@property
+	def DAC(self):
+		sleep(self._latencies['laser'])
+		return self._DAC
+	@DAC.setter
+	def DAC(self, value):
+		if not 0 <= value <= 2**12-1:
+			raise ValueError(f'The DAC value must be between 0 and {2**12-1}, received {repr(value)}.')
+		sleep(self._latencies['laser'])
+		self._DAC = int(value)
+
+class SimulatedTCT:
+	"""Mimics `PyticularsTCT.TCT`."""
+	def __init__(self, latencies: dict, stages_speed: float=2e-3):
+		self.stages = SimulatedStages(latencies, speed=stages_speed)
+		self.laser = SimulatedLaser(latencies)
+
+class SimulatedKeithley:
+	"""Mimics `keithley.Keithley2470.Keithley2470SafeForLGADs` with negative
+	polarity, i.e. the voltage is set as a positive number but the measured
+	voltage and current are negative, as in the real setup."""
+	def __init__(self, latencies: dict, leakage_current: callable, noise: float=1e-3, seed: int=None):
+		"""
+		Parameters
+		----------
+		latencies: dict
+			See `DEFAULT_LATENCIES`.
+		leakage_current: callable
+			A function `leakage_current(bias_voltage) -> amperes`.
+		noise: float, default 1e-3
+			Relative noise of each measurement.
+		"""
+		self._latencies = latencies
+		self._leakage_current = leakage_current
+		self._noise = noise
+		self._random = np.random.default_rng(seed)
+		self._source_voltage = 0
+		self._output = 'off'
+		self._current_limit = 10e-6
+
+	def set_source_voltage(self, volts):
+		sleep(self._latencies['keithley'])
+		self._source_voltage = float(volts)
+
+	@property
+	def output_voltage(self):
+		"""The voltage really applied, without latency nor noise."""
+		if self._output == 'off':
+			return 0
+		voltage = self._source_voltage
+		while abs(self._leakage_current(voltage)) > self._current_limit and voltage > 0: # In compliance, the voltage drops until the current is the limit.
+			voltage -= 1
+		return max(voltage, 0)
+
+	def measure_voltage(self):
+		sleep(self._latencies['keithley'])
+		return -self.output_voltage*(1 + self._random.normal(0, self._noise))
+
+	def measure_current(self):
+		sleep(self._latencies['keithley'])
+		return -min(self._leakage_current(self.output_voltage), self._current_limit)*(1 + self._random.normal(0, self._noise))
+
+	@property
+	def current_limit(self):
+		sleep(self._latencies['keithley'])
+		return self._current_limit
+	@current_limit.setter
+	def current_limit(self, amperes):
+		sleep(self._latencies['keithley'])
+		self._current_limit = float(amperes)
+
+	@property
+	def output(self):
+		sleep(self._latencies['keithley'])
+		return self._output
+	@output.setter
+	def output(self, status: str):
+		if status not in {'on','off'}:
+			raise ValueError(f'`status` must be "on" or "off", received {repr(status)}.')
+		sleep(self._latencies['keithley'])
+		self._output = status
+
+class SimulatedTemperatureController:
+	"""Mimics the Pyro proxy to `temperature_controller.py`."""
+	def __init__(self, latencies: dict, temperature: float=-20, humidity: float=5, seed: int=None):
+		self._latencies = latencies
+		self._temperature = temperature
+		self._humidity = humidity
+		self._random = np.random.default_rng(seed)
+
+	@property
+	def temperature(self):
+		sleep(self._latencies['temperature_controller'])
+		return self._temperature + self._random.normal(0, .05)
+
+	@property
+	def humidity(self):
+		sleep(self._latencies['temperature_controller'])
+		return self._humidity + self._random.normal(0, .1)
+
+class SimulatedDevice:
+	"""Model of a TI-LGAD with two pixels side by side along x, used to
+	produce the amplitude of the pulses as a function of the position
+	of the laser, the bias voltage and the laser DAC. The laser beam is
+	gaussian, with its waist at the `z` of `center`."""
+	def __init__(self, center=(0,0,0), pixels_x_limits: dict=None, pixels_height: float=500e-6, beam_waist: float=8e-6, rayleigh_range: float=300e-6, amplitude_at_100_V: float=50e-3, breakdown_voltage: float=300, second_pulse_attenuation: float=.5):
+		"""
+		Parameters
+		----------
+		center: tuple
+			Position `(x,y,z)` of the center of the device, with `z` the focus of the laser.
+		pixels_x_limits: dict, optional
+			A dictionary of the form `{n_channel: (x_min, x_max)}`, relative to the center.
+			Default is two pixels of 250 µm read by channels 1 and 2.
+		pixels_height: float, default 500e-6
+			Size of the pixels along `y`.
+		beam_waist: float, default 8e-6
+			Radius of the laser beam at the focus.
+		rayleigh_range: float, default 300e-6
+			Rayleigh range of the laser beam.
+		amplitude_at_100_V: float, default 50e-3
+			Amplitude of the first pulse with the laser fully inside a pixel, 100 V bias and laser DAC 0.
+		breakdown_voltage: float, default 300
+			Bias voltage at which the gain and the leakage current diverge.
+		second_pulse_attenuation: float, default .5
+			Amplitude of the second pulse relative to the first one.
+		"""
+		self.center = np.array(center, dtype=float)
+		self.pixels_x_limits = pixels_x_limits if pixels_x_limits is not None else {1: (-250e-6, 0), 2: (0, 250e-6)}
+		self.pixels_height = pixels_height
+		self.beam_waist = beam_waist
+		self.rayleigh_range = rayleigh_range
+		self.amplitude_at_100_V = amplitude_at_100_V
+		self.breakdown_voltage = breakdown_voltage
+		self.second_pulse_attenuation = second_pulse_attenuation
+
+	def beam_radius(self, z):
+		return self.beam_waist*(1 + ((z-self.center[2])/self.rayleigh_range)**2)**.5
+
+	def illuminated_fraction(self, channel: int, position):
+		"""Fraction of the laser beam that falls into the pixel of `channel`."""
+		if channel not in self.pixels_x_limits:
+			return 0
+		x, y, z = np.array(position, dtype=float) - self.center
+		w = self.beam_radius(z + self.center[2])*2**.5
+		x_min, x_max = self.pixels_x_limits[channel]
+		fraction_x = (erf((x-x_min)/w) - erf((x-x_max)/w))/2
+		fraction_y = (erf((y+self.pixels_height/2)/w) - erf((y-self.pixels_height/2)/w))/2
+		return fraction_x*fraction_y
+
+	def gain(self, bias_voltage: float):
+		"""Gain relative to 100 V, it diverges at the breakdown voltage."""
+		bias_voltage = min(abs(bias_voltage), self.breakdown_voltage*.99)
+		return (1/(1-bias_voltage/self.breakdown_voltage) - 1)/(1/(1-100/self.breakdown_voltage) - 1)
+
+	def leakage_current(self, bias_voltage: float):
+		"""Leakage current, in amperes, as a function of the bias voltage."""
+		return 1e-9*abs(bias_voltage)/100*self.gain(bias_voltage)
+
+	def pulses_amplitude(self, channel: int, position, bias_voltage: float, laser_DAC: int, laser_status: str):
+		"""Returns `(amplitude_pulse_1, amplitude_pulse_2)`. In the real
+		laser higher DAC values mean lower intensity."""
+		if laser_status != 'on':
+			return (0, 0)
+		intensity = max(1 - laser_DAC/4095, 0)
+		amplitude = self.amplitude_at_100_V*self.gain(bias_voltage)*intensity*self.illuminated_fraction(channel, position)
+		return (amplitude, amplitude*self.second_pulse_attenuation)
+
+class SimulatedTheSetup(TheSetup):
+	"""Same interface as `TheSetup` but with all the instruments replaced
+	by simulated ones, so the scripts can be run, tested and benchmarked
+	without the hardware:
+	- The oscilloscope is a `SimulatedLeCroyWaveRunner` with two pulses
+	  whose amplitude depends on the position of the stages, the bias
+	  voltage and the laser, according to a `SimulatedDevice`.
+	- The stages, laser, Keithley and temperature controller keep their
+	  state and take some time for each operation, see `DEFAULT_LATENCIES`.
+	
+	Usage:
+	```
+	the_setup = SimulatedTheSetup(device=SimulatedDevice(center=(0,0,71e-3)), latencies={'move_to': 0})
+	script_core(the_setup=the_setup, ...) # Any of the scripts.
+	```
+	"""
+	def __init__(self, device: SimulatedDevice=None, latencies: dict=None, emi_probability: float=1e-3, amplitude_fluctuation: float=.1, stages_speed: float=2e-3, seed: int=None, profile: bool=False, **oscilloscope_kwargs):
+		"""
+		Parameters
+		----------
+		device: SimulatedDevice, optional
+			The device under test. By default a `SimulatedDevice` centered at the origin.
+		latencies: dict, optional
+			Time that each operation takes, in seconds. Any operation not
+			given here takes the time in `DEFAULT_LATENCIES`. Use e.g.
+			`{key: 0 for key in DEFAULT_LATENCIES}` to run as fast as possible.
+		emi_probability: float, default 1e-3
+			Probability that each waveform has EMI.
+		amplitude_fluctuation: float, default .1
+			Relative fluctuation of the amplitude from trigger to trigger.
+		stages_speed: float, default 2e-3
+			Speed of the stages, in m/s.
+		seed: int, optional
+			Seed for the random numbers generators.
+		profile: bool, default False
+			Passed to `TheSetup`.
+		oscilloscope_kwargs:
+			Passed to `SimulatedLeCroyWaveRunner`, e.g. `trigger_period`.
+		"""
+		self.device = device if device is not None else SimulatedDevice()
+		self._simulated_latencies = {**DEFAULT_LATENCIES, **(latencies if latencies is not None else {})}
+		self._simulated_oscilloscope_kwargs = {
+			'emi_probability': emi_probability,
+			'amplitude_fluctuation': amplitude_fluctuation,
+			'seed': seed,
+			'transfer_latency': self._simulated_latencies['get_waveform'],
+			**oscilloscope_kwargs,
+		}
+		self._simulated_stages_speed = stages_speed
+		self._simulated_seed = seed
+		super().__init__(safe_mode=False, profile=profile)
+
+	def _connect_instruments(self):
+		self._tct = SimulatedTCT(self._simulated_latencies, stages_speed=self._simulated_stages_speed)
+		self._tct.stages._position = tuple(self.device.center) # Start pointing to the device, as it is usually when a measurement starts.
+		self._keithley = SimulatedKeithley(self._simulated_latencies, leakage_current=self.device.leakage_current, seed=self._simulated_seed)
+		self._temperature_controller = SimulatedTemperatureController(self._simulated_latencies, seed=self._simulated_seed)
+		self._LeCroy = SimulatedLeCroyWaveRunner(pulses_amplitude=self._simulated_pulses_amplitude, **self._simulated_oscilloscope_kwargs)
+
+	def _simulated_pulses_amplitude(self, channel: int):
+		"""The current state of the simulated instruments, read without latency."""
+		return self.device.pulses_amplitude(
+			channel = channel,
+			position = self._tct.stages._position,
+			bias_voltage = self._keithley.output_voltage,
+			laser_DAC = self._tct.laser._DAC,
+			laser_status = self._tct.laser._status,
+		)
+
+if __name__ == '__main__':
+	N_TRIGGERS = 333
+	the_setup = SimulatedTheSetup(trigger_period=1e-4, latencies={'get_waveform': 0})
+	the_setup.configure_oscilloscope_for_two_pulses()
+	the_setup.laser_status = 'on'
+	the_setup.bias_voltage = 200
+	the_setup.bias_output_status = 'on'
+	the_setup.move_to(x=-100e-6, y=0, z=0) # Inside the pixel of channel 1.
+
+	start = time.monotonic()
+	for _ in range(N_TRIGGERS):
+		the_setup.wait_for_trigger()
+		for channel in [1,2]:
+			the_setup.get_waveform(channel)
+	print(f'One trigger at a time: {N_TRIGGERS/(time.monotonic()-start):.0f} triggers/s')
+
+	start = time.monotonic()
+	waveforms = the_setup.acquire_segments(channels=[1,2], n_segments=N_TRIGGERS)
+	print(f'Sequence mode: {N_TRIGGERS/(time.monotonic()-start):.0f} triggers/s')
+	print(f'Shape of the amplitude array for each channel: {waveforms[1]["Amplitude (V)"].shape}')
@@ -0,0 +1,88 @@
+"""Computes with `PeakSignal` (https://github.com/SengerM/signals) the
+features of a fixed set of waveforms and stores them in
+`tests/data/peak_signal_reference.npz`, which is used by
+`tests/test_batch_feature_extraction.py` to check that `BatchOfPeakSignals`
+gives the same features. Run it again if `PeakSignal` changes:
+```
+python tests/make_peak_signal_reference.py
+```
+"""
+import sys
+import numpy as np
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent)) # The scripts are top level modules, not a package.
+import signals
+from signals.PeakSignal import PeakSignal
+from simulated_setup import SimulatedLeCroyWaveRunner
+
+REFERENCE_FILE_PATH = Path(__file__).resolve().parent/Path('data')/Path('peak_signal_reference.npz')
+TIMES_AT = [10,50,90]
+FEATURES_ATTRIBUTES = {
+	'Amplitude (V)': 'amplitude',
+	'Noise (V)': 'noise',
+	'Rise time (s)': 'rise_time',
+	'Collected charge (V s)': 'peak_integral',
+	'Time over noise (s)': 'time_over_noise',
+}
+FEATURES = list(FEATURES_ATTRIBUTES) + [f't_{pp} (s)' for pp in TIMES_AT]
+
+def reference_waveforms():
+	"""Returns a dictionary `{case: samples}`, all with the same sampling period."""
+	oscilloscope = SimulatedLeCroyWaveRunner(seed=0)
+	simulated = oscilloscope.signal(channel=1, n_waveforms=12)[:,500:800] # Only the first pulse, with some baseline before and after.
+	waveforms = {f'Simulated {n}': samples for n, samples in enumerate(simulated)}
+	typical = simulated[0]
+	rng = np.random.default_rng(0)
+	peak_at_the_end = typical.copy()
+	peak_at_the_end[-1] = 10*typical.max()
+	peak_at_the_start = typical.copy()
+	peak_at_the_start[0] = 10*typical.max()
+	peak_in_the_second_sample = typical.copy()
+	peak_in_the_second_sample[1] = 10*typical.max()
+	negative_spike_before_the_pulse = typical.copy()
+	negative_spike_before_the_pulse[10] = -20*typical.max() # The noise is larger than the amplitude.
+	waveforms.update({
+		'Noise only': rng.normal(0, 2e-3, len(typical)),
+		'Very noisy': typical + rng.normal(0, 3*typical.max(), len(typical)),
+		'Negative spike before the pulse': negative_spike_before_the_pulse,
+		'Constant': np.zeros(len(typical)),
+		'Peak in the last sample': peak_at_the_end,
+		'Peak in the first sample': peak_at_the_start,
+		'Peak in the second sample': peak_in_the_second_sample,
+		'Short': typical[100:250],
+	})
+	return {case: samples.astype(np.float32).astype(float) for case, samples in waveforms.items()}, oscilloscope.sampling_period
+
+def peak_signal_features(time, samples):
+	"""Features of one waveform computed with `PeakSignal`, `NaN` for those it cannot compute."""
+	signal = PeakSignal(time=time, samples=samples)
+	getters = {feature: (lambda attribute=attribute: getattr(signal, attribute)) for feature, attribute in FEATURES_ATTRIBUTES.items()}
+	getters.update({f't_{pp} (s)': (lambda pp=pp: signal.find_time_at_rising_edge(pp)) for pp in TIMES_AT})
+	features = {}
+	for feature, getter in getters.items():
+		try:
+			value = getter()
+		except Exception:
+			value = None
+		features[feature] = float('NaN') if value is None else float(value)
+	return features
+
+if __name__ == '__main__':
+	waveforms, sampling_period = reference_waveforms()
+	cases = list(waveforms)
+	n_samples = max(len(samples) for samples in waveforms.values())
+	samples = np.full((len(cases),n_samples), float('NaN'))
+	for n, case in enumerate(cases):
+		samples[n,:len(waveforms[case])] = waveforms[case]
+	features = [peak_signal_features(np.arange(len(waveforms[case]))*sampling_period, waveforms[case]) for case in cases]
+	REFERENCE_FILE_PATH.parent.mkdir(exist_ok=True)
+	np.savez_compressed(
+		REFERENCE_FILE_PATH,
+		cases = np.array(cases),
+		samples = samples.astype(np.float32), # Exact, they were rounded to float32 before computing the features.
+		sampling_period = sampling_period,
+		generated_with = f'{PeakSignal.__module__}.PeakSignal, version {getattr(signals, "__version__", "unknown")}',
+		**{feature: np.array([f[feature] for f in features]) for feature in FEATURES},
+	)
+	print(f'Reference features of {len(cases)} waveforms stored in {REFERENCE_FILE_PATH}')
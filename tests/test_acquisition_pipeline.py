@@ -0,0 +1,87 @@
+import numpy as np
+import threading
+import pytest
+from acquisition_pipeline import AcquisitionPipeline
+from waveforms_store import WaveformsStoreWriter, WaveformsStoreReader
+from utils import WaveformsAverager
+
+def raw_waveform(value, n_samples=10):
+	return {'Time (s)': np.arange(n_samples)*1e-9, 'Amplitude (V)': np.full(n_samples, float(value))}
+
+def test_pipeline_writes_every_pulse_of_every_event(tmp_path):
+	with WaveformsStoreWriter(tmp_path/'waveforms', waveforms_per_block=7) as store:
+		with AcquisitionPipeline(store, n_pulses=2, max_events_in_queue=2) as pipeline:
+			for n_trigger in range(10):
+				pipeline.put_event(metadata={'n_trigger': n_trigger}, raw_waveforms={1: raw_waveform(n_trigger), 4: raw_waveform(-n_trigger)})
+		assert pipeline.counters['writing'].n_items == 40
+	reader = WaveformsStoreReader(tmp_path/'waveforms')
+	metadata_df = reader.read_metadata()
+	assert metadata_df['n_waveform'].tolist() == list(range(40))
+	assert (metadata_df.groupby(['n_channel','n_pulse']).size() == 10).all()
+	_, amplitude = reader.read_samples(metadata_df)
+	expected = np.where(metadata_df['n_channel'] == 1, 1, -1)*metadata_df['n_trigger']
+	assert (amplitude == expected.to_numpy()[:,np.newaxis]).all() and amplitude.shape == (40, 5)
+	reader.close()
+
+def test_pipeline_feeds_the_averager(tmp_path):
+	averager = WaveformsAverager(group_by=['n_channel','n_pulse'])
+	with WaveformsStoreWriter(tmp_path/'waveforms') as store:
+		with AcquisitionPipeline(store, n_pulses=2, waveforms_averager=averager) as pipeline:
+			for n_trigger in range(10):
+				pipeline.put_event(metadata={'n_trigger': n_trigger}, raw_waveforms={1: raw_waveform(n_trigger)})
+	average_waveforms_df = averager.dataframe()
+	assert len(average_waveforms_df) == 2*5 # Two pulses of five samples each.
+	assert (average_waveforms_df['Number of waveforms'] == 10).all()
+	assert np.allclose(average_waveforms_df['Amplitude mean (V)'], np.mean(range(10)))
+
+def test_pipeline_checkpoints_every_event_and_continues_the_numbering(tmp_path):
+	for first_trigger in [0, 5]: # The second time the store is resumed.
+		with WaveformsStoreWriter(tmp_path/'waveforms', waveforms_per_block=7, checkpoint_columns=['n_trigger'], resume=True) as store:
+			with AcquisitionPipeline(store, n_pulses=2) as pipeline:
+				for n_trigger in range(first_trigger, first_trigger+5):
+					pipeline.put_event(metadata={'n_trigger': n_trigger}, raw_waveforms={1: raw_waveform(n_trigger)})
+	with WaveformsStoreWriter(tmp_path/'waveforms', checkpoint_columns=['n_trigger'], resume=True) as store:
+		assert store.read_checkpoints()['n_trigger'].tolist() == list(range(10))
+	reader = WaveformsStoreReader(tmp_path/'waveforms')
+	metadata_df = reader.read_metadata()
+	assert metadata_df['n_waveform'].tolist() == list(range(20))
+	assert metadata_df['n_trigger'].tolist() == [n_trigger for n_trigger in range(10) for _ in range(2)]
+	reader.close()
+
+def test_wait_until_processed_lets_the_averager_see_every_event(tmp_path):
+	averager = WaveformsAverager(group_by=['n_channel','n_pulse'])
+	with WaveformsStoreWriter(tmp_path/'waveforms') as store:
+		with AcquisitionPipeline(store, max_events_in_queue=2, waveforms_averager=averager) as pipeline:
+			for n_trigger in range(10):
+				pipeline.put_event(metadata={'n_trigger': n_trigger}, raw_waveforms={1: raw_waveform(n_trigger)})
+			pipeline.wait_until_processed()
+			assert (averager.dataframe()['Number of waveforms'] == 10).all()
+
+class FailingStore:
+	checkpoint_columns = None
+	next_n_waveform = 0
+	def append(self, metadata, time, amplitude):
+		raise OSError('Disk full')
+
+def test_pipeline_raises_instead_of_hanging_when_a_worker_fails():
+	outcome = {}
+	def acquire():
+		try:
+			with AcquisitionPipeline(FailingStore(), max_events_in_queue=2) as pipeline:
+				for n_trigger in range(100):
+					pipeline.put_event(metadata={'n_trigger': n_trigger}, raw_waveforms={1: raw_waveform(0)})
+				pipeline.close()
+		except RuntimeError as e:
+			outcome['exception'] = e
+	thread = threading.Thread(target=acquire, daemon=True)
+	thread.start()
+	thread.join(timeout=30)
+	assert not thread.is_alive(), 'The acquisition got stuck after the writing thread failed.'
+	assert isinstance(outcome['exception'].__cause__, OSError)
+
+def test_pipeline_cannot_be_used_after_closing(tmp_path):
+	with WaveformsStoreWriter(tmp_path/'waveforms') as store:
+		pipeline = AcquisitionPipeline(store)
+		pipeline.close()
+		with pytest.raises(RuntimeError):
+			pipeline.put_event(metadata={}, raw_waveforms={1: raw_waveform(0)})
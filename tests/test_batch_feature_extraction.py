@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from pathlib import Path
+from batch_feature_extraction import extract_features, FEATURES_ATTRIBUTES
+from simulated_setup import SimulatedLeCroyWaveRunner
+
+TIMES_AT = [10,50,90]
+FEATURES = list(FEATURES_ATTRIBUTES) + [f't_{pp} (s)' for pp in TIMES_AT]
+REFERENCE_FILE_PATH = Path(__file__).resolve().parent/Path('data')/Path('peak_signal_reference.npz')
+
+def simulated_waveforms(n_waveforms=50):
+	oscilloscope = SimulatedLeCroyWaveRunner(seed=0)
+	n_samples = int(oscilloscope.n_samples/2) # Only the first pulse.
+	samples = oscilloscope.signal(channel=1, n_waveforms=n_waveforms)[:,:n_samples]
+	time = np.tile(oscilloscope.time[:n_samples], (n_waveforms,1))
+	return time, samples
+
+def edge_case_waveforms():
+	"""Waveforms for which some features cannot be computed."""
+	time, samples = simulated_waveforms(1)
+	time, samples = time[0], samples[0]
+	rng = np.random.default_rng(0)
+	noise_only = rng.normal(0, 2e-3, len(time))
+	peak_at_the_end = samples.copy()
+	peak_at_the_end[-1] = 10*np.nanmax(samples)
+	peak_at_the_start = samples.copy()
+	peak_at_the_start[0] = 10*np.nanmax(samples)
+	return {
+		'Noise only': (time, noise_only),
+		'Constant': (time, np.zeros(len(time))),
+		'Peak in the last sample': (time, peak_at_the_end),
+		'Peak in the first sample': (time, peak_at_the_start),
+	}
+
+def test_features_of_simulated_waveforms_are_finite():
+	time, samples = simulated_waveforms()
+	features = extract_features(time, samples, TIMES_AT)
+	for feature in FEATURES:
+		assert np.isfinite(features[feature]).all(), feature
+	assert (features['Amplitude (V)'] > 0).all()
+	assert (features['Collected charge (V s)'] > 0).all()
+	assert (features['t_10 (s)'] < features['t_50 (s)']).all() and (features['t_50 (s)'] < features['t_90 (s)']).all()
+
+def test_NaN_padding_does_not_change_the_features():
+	time, samples = simulated_waveforms(5)
+	padding = np.full((len(time),100), float('NaN'))
+	features = extract_features(time, samples, TIMES_AT)
+	padded_features = extract_features(np.concatenate([time,padding], axis=1), np.concatenate([samples,padding], axis=1), TIMES_AT)
+	for feature in FEATURES:
+		np.testing.assert_allclose(padded_features[feature], features[feature], rtol=1e-12, err_msg=feature)
+
+@pytest.mark.parametrize('case', ['Constant', 'Peak in the first sample'])
+def test_features_without_a_peak_are_NaN(case):
+	time, samples = edge_case_waveforms()[case]
+	features = extract_features(time[np.newaxis], samples[np.newaxis], TIMES_AT)
+	for feature in FEATURES:
+		assert np.isnan(features[feature]).all(), feature
+
+def test_peak_in_the_last_sample_has_no_falling_edge():
+	time, samples = edge_case_waveforms()['Peak in the last sample']
+	features = extract_features(time[np.newaxis], samples[np.newaxis], TIMES_AT)
+	assert np.isfinite(features['Amplitude (V)'][0])
+	assert np.isnan(features['Time over noise (s)'][0])
+	assert np.isnan(features['Collected charge (V s)'][0])
+
+def test_same_features_as_PeakSignal():
+	"""Compares with the features computed by `PeakSignal` for a fixed set
+	of waveforms, stored by `tests/make_peak_signal_reference.py`."""
+	reference = np.load(REFERENCE_FILE_PATH)
+	samples = reference['samples'].astype(float)
+	time = np.where(np.isnan(samples), float('NaN'), np.arange(samples.shape[1])*reference['sampling_period']) # Padded with NaN, as in the waveforms store.
+	features = extract_features(time, samples, TIMES_AT)
+	for feature in FEATURES:
+		for case, obtained, expected in zip(reference['cases'], features[feature], reference[feature]):
+			np.testing.assert_allclose(obtained, expected, rtol=1e-6, atol=0, equal_nan=True, err_msg=f'{feature} in {case}')
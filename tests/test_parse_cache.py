@@ -0,0 +1,26 @@
+import numpy as np
+from parse_cache import ParseCache, cache_column_name
+
+def test_parse_cache_round_trip(tmp_path):
+	column = cache_column_name('Amplitude (V)', {'method': 'PeakSignal', 'version': 1})
+	with ParseCache(tmp_path/'cache.sqlite') as cache:
+		assert not cache.is_parsed(column, 0, 10)
+		cache.write(n_waveform=[0, 1, 3], features={column: [.1, float('NaN'), .3]}, n_waveform_from=0, n_waveform_to=5)
+		assert cache.is_parsed(column, 0, 5)
+		assert cache.is_parsed(column, 1, 3)
+		assert not cache.is_parsed(column, 0, 10)
+		assert cache.missing_columns([column, 'Other'], 0, 5) == ['Other']
+	with ParseCache(tmp_path/'cache.sqlite') as cache: # What was written is still there after reopening.
+		df = cache.read([column], 0, 5)
+		assert df['n_waveform'].tolist() == [0, 1, 3]
+		assert df[column][0] == .1 and np.isnan(df[column][1]) and df[column][2] == .3
+
+def test_parse_cache_adds_new_features_to_existing_waveforms(tmp_path):
+	old_column = cache_column_name('Amplitude (V)', {'version': 1})
+	new_column = cache_column_name('Amplitude (V)', {'version': 2})
+	assert old_column != new_column
+	with ParseCache(tmp_path/'cache.sqlite') as cache:
+		cache.write(n_waveform=[0, 1], features={old_column: [1., 2.]}, n_waveform_from=0, n_waveform_to=2)
+		cache.write(n_waveform=[0, 1], features={new_column: [3., 4.]}, n_waveform_from=0, n_waveform_to=2)
+		df = cache.read([old_column, new_column], 0, 2)
+		assert df[old_column].tolist() == [1., 2.] and df[new_column].tolist() == [3., 4.]
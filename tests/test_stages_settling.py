@@ -0,0 +1,23 @@
+import warnings
+from simulated_setup import SimulatedTheSetup
+
+def test_stages_settle_on_target():
+	the_setup = SimulatedTheSetup()
+	for x in [100e-6, 200e-6, 300e-6]:
+		position = the_setup.move_to(x, 0, 0)
+		assert abs(position[0] - x) <= the_setup.stages_settling['tolerance (m)']['x']
+	statistics = the_setup.stages_settling_statistics()
+	assert statistics['Number of timeouts'] == 0 and statistics['Number of times settled away from the target'] == 0
+
+def test_coarse_readback_settles_without_timeout_and_warns_once():
+	the_setup = SimulatedTheSetup()
+	the_setup._tct.stages.readback_resolution = 3e-6 # Coarser than the tolerance.
+	with warnings.catch_warnings(record=True) as caught:
+		warnings.simplefilter('always')
+		for x in [101e-6, 201e-6, 301e-6, 401e-6]:
+			the_setup.move_to(x, 0, 0)
+	statistics = the_setup.stages_settling_statistics()
+	assert statistics['Number of timeouts'] == 0
+	assert statistics['Max time (s)'] < the_setup.stages_settling['timeout (s)']
+	assert statistics['Number of times settled away from the target'] > 0
+	assert len([w for w in caught if 'x stage' in str(w.message)]) == 1
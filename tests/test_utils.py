@@ -0,0 +1,161 @@
+import numpy as np
+import pandas
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import utils
+from simulated_setup import SimulatedTheSetup, DEFAULT_LATENCIES
+
+def test_map_with_bounded_memory_keeps_order_and_bounds_the_calls_in_flight():
+	lock = threading.Lock()
+	started = []
+	def square(x):
+		with lock:
+			started.append(x)
+		time.sleep(.001*(x%3))
+		return x**2
+	with ThreadPoolExecutor(max_workers=4) as executor:
+		results = utils.map_with_bounded_memory(executor, square, range(20), max_in_flight=3)
+		first = next(results)
+		time.sleep(.05)
+		assert len(started) <= 4 # The one consumed plus at most 3 in flight.
+		assert [first] + list(results) == [x**2 for x in range(20)]
+
+def two_pixels_charge(distances, edge=100e-6, width=2e-6):
+	distances = np.asarray(distances)
+	return {1: 1/(1+np.exp((distances-edge)/width)), 2: 1/(1+np.exp(-(distances-edge)/width))}
+
+def test_positions_to_refine_1D_scan_refines_the_edge_down_to_the_minimum_step():
+	distances = list(np.arange(0, 201e-6, 10e-6))
+	for _ in range(20):
+		new_distances = utils.positions_to_refine_1D_scan(distances, two_pixels_charge(distances), minimum_step=1e-6, max_new_positions=10)
+		if len(new_distances) == 0:
+			break
+		distances += new_distances
+	steps = np.diff(sorted(distances))
+	assert min(steps) >= 1e-6
+	assert all(90e-6 <= d <= 110e-6 for d in set(distances) - set(np.arange(0, 201e-6, 10e-6)))
+
+def test_positions_to_refine_1D_scan_ignores_changes_below_the_noise():
+	rng = np.random.default_rng(0)
+	distances = np.arange(0, 201e-6, 10e-6)
+	charge = {n_channel: q*(1 + rng.normal(0, .1, len(distances))) for n_channel, q in two_pixels_charge(distances).items()}
+	charge_std = {n_channel: .1*np.abs(q) for n_channel, q in charge.items()}
+	without_noise = utils.positions_to_refine_1D_scan(distances, charge, minimum_step=1e-6, max_new_positions=100)
+	with_noise = utils.positions_to_refine_1D_scan(distances, charge, minimum_step=1e-6, max_new_positions=100, collected_charge_std=charge_std)
+	assert any(not 90e-6 <= d <= 110e-6 for d in without_noise) # The plateaus are refined because of the fluctuations.
+	assert len(with_noise) > 0 and all(90e-6 <= d <= 110e-6 for d in with_noise)
+
+def test_waveforms_averager_matches_numpy():
+	rng = np.random.default_rng(0)
+	amplitudes = rng.normal(size=(30, 8))
+	amplitudes[3,2] = float('NaN') # E.g. a saturated sample, it must not be used.
+	averager = utils.WaveformsAverager(group_by=['n_channel'])
+	for amplitude in amplitudes:
+		averager.add({'n_channel': 1}, time=np.arange(8)*1e-9, amplitude=amplitude)
+	averager.add({'n_channel': 2}, time=np.arange(3)*1e-9, amplitude=np.ones(3))
+	average_waveforms_df = averager.dataframe()
+	channel_1 = average_waveforms_df.loc[average_waveforms_df['n_channel']==1]
+	assert np.allclose(channel_1['Amplitude mean (V)'], np.nanmean(amplitudes, axis=0))
+	assert np.allclose(channel_1['Amplitude std (V)'], np.nanstd(amplitudes, axis=0, ddof=1))
+	assert channel_1['Number of waveforms'].tolist() == [30, 30, 29] + [30]*5
+	assert np.allclose(channel_1['Time (s)'], np.arange(8)*1e-9)
+	assert np.isnan(average_waveforms_df.loc[average_waveforms_df['n_channel']==2, 'Amplitude std (V)']).all() # A single waveform has no std.
+	assert len(utils.WaveformsAverager(group_by=['n_channel']).dataframe()) == 0
+
+def test_waveforms_averager_grows_with_longer_waveforms():
+	averager = utils.WaveformsAverager(group_by=['n_channel'])
+	averager.add({'n_channel': 1}, time=np.arange(3)*1e-9, amplitude=np.ones(3))
+	averager.add({'n_channel': 1}, time=np.arange(5)*1e-9, amplitude=3*np.ones(5))
+	average_waveforms_df = averager.dataframe()
+	assert average_waveforms_df['Amplitude mean (V)'].tolist() == [2, 2, 2, 3, 3]
+	assert average_waveforms_df['Number of waveforms'].tolist() == [2, 2, 2, 1, 1]
+
+def test_mean_waveform_has_the_statistics_of_the_dataframe():
+	rng = np.random.default_rng(0)
+	averager = utils.WaveformsAverager(group_by=['n_channel'])
+	for _ in range(5):
+		averager.add({'n_channel': 1}, time=np.arange(8)*1e-9, amplitude=rng.normal(size=8))
+	mean_waveform = averager.mean_waveform({'n_channel': 1})
+	average_waveforms_df = averager.dataframe()
+	for column in ['Time (s)','Amplitude mean (V)','Amplitude std (V)','Number of waveforms']:
+		assert np.allclose(mean_waveform[column], average_waveforms_df[column]), column
+	assert averager.mean_waveform({'n_channel': 2}) is None
+
+def test_waveforms_averager_matches_the_groupby_it_replaces_in_scan_laser_intensity():
+	rng = np.random.default_rng(0)
+	time = np.arange(20)*1e-9
+	averager = utils.WaveformsAverager(group_by=['n_channel','n_pulse'])
+	signals_dfs = []
+	for n_trigger in range(15):
+		for n_channel in [1,4]:
+			for n_pulse in [1,2]:
+				amplitude = rng.normal(n_channel*n_pulse, 1, len(time))
+				averager.add({'n_channel': n_channel, 'n_pulse': n_pulse}, time=time, amplitude=amplitude)
+				signals_dfs.append(pandas.DataFrame({'n_channel': n_channel, 'n_pulse': n_pulse, 'Samples (V)': amplitude, 'Time (s)': time}))
+	signals_df = pandas.concat(signals_dfs, ignore_index=True)
+	expected = signals_df.groupby(['n_channel','n_pulse','Time (s)'])['Samples (V)'].agg(['mean','std'])
+	obtained = averager.dataframe().set_index(['n_channel','n_pulse','Time (s)']).loc[expected.index]
+	assert np.allclose(obtained['Amplitude mean (V)'], expected['mean'])
+	assert np.allclose(obtained['Amplitude std (V)'], expected['std'])
+
+def test_plan_scan_path_visits_every_position_once():
+	positions = [[(x,y,0) for x in np.linspace(0,1e-3,5)] for y in np.linspace(0,1e-3,4)]
+	positions[2] = positions[2][:3] # Rows may have different lengths.
+	all_indices = sorted((n1,n2) for n1,row in enumerate(positions) for n2 in range(len(row)))
+	lengths = {}
+	for method in utils.SCAN_PATH_METHODS:
+		path = utils.plan_scan_path(positions, method)
+		assert sorted(path) == all_indices
+		lengths[method] = utils.scan_path_length([positions[n1][n2] for n1,n2 in path])
+	assert lengths['serpentine'] < lengths['row_by_row']
+	assert lengths['nearest_neighbour'] <= lengths['row_by_row']
+	assert utils.plan_scan_path([], 'nearest_neighbour') == []
+
+def test_read_dumped_dataframe_recovers_the_complete_batches_of_a_truncated_stream(tmp_path):
+	df = pandas.DataFrame({'n_position': [0], 'Charge (C)': [0.]})
+	dumper = utils.DataFrameDumper(tmp_path/'measured_data.fd', df)
+	for n_position in range(3):
+		dumper.dump_to_disk(pandas.DataFrame({'n_position': [n_position]*2, 'Charge (C)': [n_position*1e-15]*2}), force=True)
+	dumper.flush()
+	stream = (tmp_path/'measured_data.arrows').read_bytes()
+	(tmp_path/'truncated.arrows').write_bytes(stream[:-20]) # As if the program crashed while writing the last batch.
+	assert utils.read_dumped_dataframe(tmp_path/'truncated.arrows')['n_position'].tolist() == [0, 0, 1, 1]
+	assert utils.read_dumped_dataframe(tmp_path/'measured_data.arrows')['n_position'].tolist() == [0, 0, 1, 1, 2, 2]
+	dumper.end(df[0:0])
+	assert pandas.read_feather(tmp_path/'measured_data.fd')['n_position'].tolist() == [0, 0, 1, 1, 2, 2]
+	assert not (tmp_path/'measured_data.arrows').exists()
+
+def test_is_EMI_matches_the_std_of_each_waveform():
+	rng = np.random.default_rng(0)
+	time = np.arange(1000)*.3e-9
+	amplitude = rng.normal(0, [[1],[200]], (2,len(time)))
+	assert utils.is_EMI(time, amplitude).tolist() == [False, True]
+
+def test_is_EMI_rejects_NaN_samples_where_there_should_be_no_signal():
+	time = np.arange(1000)*.3e-9
+	amplitude = np.zeros((3,len(time)))
+	amplitude[1,10] = float('NaN') # E.g. saturated, in a region without signal.
+	amplitude[2,np.argmin(np.abs(time-200e-9))] = float('NaN') # Where the signal is.
+	assert utils.is_EMI(time, amplitude).tolist() == [False, True, False]
+
+def test_is_EMI_ignores_the_padding():
+	time = np.arange(1000)*.3e-9
+	padded_time = np.concatenate([time, np.full(100, float('NaN'))])
+	padded_amplitude = np.concatenate([np.zeros(len(time)), np.full(100, float('NaN'))])
+	assert not utils.is_EMI(padded_time, padded_amplitude)
+
+def test_wait_for_nice_trigger_without_EMI_skips_the_triggers_with_EMI(capsys):
+	the_setup = SimulatedTheSetup(emi_probability=.5, seed=0, trigger_period=0, latencies={key: 0 for key in DEFAULT_LATENCIES})
+	for _ in range(10):
+		raw_waveforms = utils.wait_for_nice_trigger_without_EMI(the_setup, channels=[1,2])
+		assert not any(utils.is_EMI(raw_waveforms[ch]['Time (s)'], raw_waveforms[ch]['Amplitude (V)']) for ch in [1,2])
+	assert 'Noisy trigger!' in capsys.readouterr().out
+
+def test_acquire_nice_triggers_without_EMI_in_sequence_mode_skips_the_triggers_with_EMI(capsys):
+	the_setup = SimulatedTheSetup(emi_probability=.3, seed=0, trigger_period=0, latencies={key: 0 for key in DEFAULT_LATENCIES})
+	raw_waveforms_each_trigger = utils.acquire_nice_triggers_without_EMI_in_sequence_mode(the_setup, channels=[1,2], n_triggers=20)
+	assert len(raw_waveforms_each_trigger) == 20
+	for raw_waveforms in raw_waveforms_each_trigger:
+		assert not any(utils.is_EMI(raw_waveforms[ch]['Time (s)'], raw_waveforms[ch]['Amplitude (V)']) for ch in [1,2])
+	assert 'noisy triggers! Will skip them...' in capsys.readouterr().out
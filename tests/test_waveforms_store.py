@@ -0,0 +1,147 @@
+import numpy as np
+import sqlite3
+from waveforms_store import WaveformsBuffer, read_query_into_arrays, WaveformsStoreWriter, WaveformsStoreReader, convert_sqlite_waveforms_to_store, archive_waveforms_store, AMPLITUDE_MAX_CODE
+
+def append_waveforms(buffer, metadatas):
+	for metadata in metadatas:
+		buffer.append(metadata, time=np.arange(3, dtype=float), amplitude=np.zeros(3))
+
+def test_buffer_widens_integer_column_for_float_value():
+	buffer = WaveformsBuffer(4)
+	append_waveforms(buffer, [{'x': 1}, {'x': 1.5}])
+	assert buffer.metadata()['x'].tolist() == [1, 1.5]
+
+def test_buffer_widens_integer_column_for_NaN():
+	buffer = WaveformsBuffer(4)
+	append_waveforms(buffer, [{'x': 1}, {'x': float('NaN')}, {'x': 3}])
+	x = buffer.metadata()['x'].to_numpy()
+	assert x[0] == 1 and np.isnan(x[1]) and x[2] == 3
+
+def test_buffer_widens_numeric_column_for_strings():
+	buffer = WaveformsBuffer(4)
+	append_waveforms(buffer, [{'x': 1.}, {'x': 'a'}])
+	assert buffer.metadata()['x'].tolist() == [1., 'a']
+
+def test_read_query_into_arrays_types_across_chunks():
+	connection = sqlite3.connect(':memory:')
+	connection.execute('CREATE TABLE t (i, f, s, mixed)')
+	connection.executemany('INSERT INTO t VALUES (?,?,?,?)', [(n, None if n%3 == 0 else n/2, str(n), n) for n in range(25)] + [(25, 1., 'x', 2.5)])
+	columns = read_query_into_arrays(connection, 'SELECT * FROM t', rows_per_fetch=7)
+	assert columns['i'].dtype == np.int64 and columns['i'].tolist() == list(range(26))
+	assert columns['f'].dtype == float and np.isnan(columns['f'][0]) and columns['f'][1] == .5
+	assert columns['s'].tolist() == [str(n) for n in range(25)] + ['x']
+	assert columns['mixed'].dtype == float and columns['mixed'][-1] == 2.5
+	assert all(len(array) == 0 for array in read_query_into_arrays(connection, 'SELECT * FROM t WHERE i > 100').values())
+
+def random_waveforms(n_waveforms):
+	"""Returns `{n_waveform: (time, amplitude)}` with waveforms of different lengths."""
+	rng = np.random.default_rng(0)
+	waveforms = {}
+	for n_waveform in range(n_waveforms):
+		n_samples = 50 + n_waveform%7
+		waveforms[n_waveform] = (1e-9*np.arange(n_samples) + 1e-6*n_waveform, rng.normal(scale=.1, size=n_samples))
+	return waveforms
+
+def write_store(path, waveforms, **kwargs):
+	with WaveformsStoreWriter(path, **kwargs) as writer:
+		for n_waveform, (time, amplitude) in waveforms.items():
+			writer.append(metadata={'n_waveform': n_waveform, 'n_position': n_waveform//3, 'x (m)': 1e-6*n_waveform}, time=time, amplitude=amplitude)
+
+def assert_samples_match(reader, waveforms, **tolerances):
+	metadata_df = reader.read_metadata()
+	assert metadata_df['n_waveform'].tolist() == sorted(waveforms)
+	time, amplitude = reader.read_samples(metadata_df)
+	for i, n_waveform in enumerate(metadata_df['n_waveform']):
+		expected_time, expected_amplitude = waveforms[n_waveform]
+		n_samples = len(expected_time)
+		assert np.allclose(time[i,:n_samples], expected_time, rtol=0, atol=tolerances.get('time', 0), equal_nan=True)
+		assert np.allclose(amplitude[i,:n_samples], expected_amplitude, rtol=0, atol=tolerances.get('amplitude', 0), equal_nan=True)
+		assert np.isnan(time[i,n_samples:]).all() and np.isnan(amplitude[i,n_samples:]).all()
+
+def test_store_round_trip(tmp_path):
+	waveforms = random_waveforms(20)
+	write_store(tmp_path/'waveforms', waveforms, waveforms_per_block=6)
+	reader = WaveformsStoreReader(tmp_path/'waveforms')
+	assert reader.number_of_waveforms == 20
+	assert_samples_match(reader, waveforms)
+	metadata_df = reader.read_metadata(5, 8)
+	assert metadata_df['n_waveform'].tolist() == [5, 6, 7]
+	assert metadata_df['n_position'].tolist() == [1, 2, 2]
+	assert np.array_equal(reader.get_waveform(13)['Amplitude (V)'][:len(waveforms[13][1])], waveforms[13][1])
+	assert sum(len(metadata_df) for metadata_df, _, _ in reader.iter_batches(7)) == 20
+	reader.close()
+
+def test_store_summary(tmp_path):
+	write_store(tmp_path/'waveforms', random_waveforms(20), waveforms_per_block=6)
+	reader = WaveformsStoreReader(tmp_path/'waveforms')
+	assert reader.summary() == {'Number of waveforms': 20, 'Number of blocks': 4, 'n_waveform min': 0, 'n_waveform max': 19}
+	assert reader.batches_limits(7) == [(0, 7), (7, 14), (14, 21)]
+	reader.close()
+
+def test_convert_sqlite_waveforms_to_store(tmp_path):
+	connection = sqlite3.connect(tmp_path/'waveforms.sqlite')
+	connection.execute('CREATE TABLE waveforms (n_waveform INTEGER, n_position INTEGER, "Time (s)" REAL, "Amplitude (V)" REAL)')
+	connection.executemany('INSERT INTO waveforms VALUES (?,?,?,?)', [(n_waveform, n_waveform//2, n_sample*1e-9, n_waveform+n_sample/10) for n_waveform in range(5) for n_sample in range(4+n_waveform)])
+	connection.commit()
+	connection.close()
+	convert_sqlite_waveforms_to_store(tmp_path/'waveforms.sqlite', tmp_path/'waveforms', n_waveforms_per_batch=2)
+	reader = WaveformsStoreReader(tmp_path/'waveforms')
+	assert_samples_match(reader, {n: (np.arange(4+n)*1e-9, n+np.arange(4+n)/10) for n in range(5)})
+	assert reader.read_metadata()['n_position'].tolist() == [0, 0, 1, 1, 2]
+	reader.close()
+
+def test_archived_store_keeps_the_precision(tmp_path):
+	waveforms = random_waveforms(10)
+	waveforms[10] = (np.array([0, 1, 3, 7.])*1e-9, np.array([.1, float('NaN'), -.2, .3])) # Not equally spaced in time, and with NaN.
+	waveforms[11] = (np.arange(5.)*1e-9, np.full(5, .7)) # Constant.
+	write_store(tmp_path/'waveforms', waveforms, waveforms_per_block=4)
+	archive_waveforms_store(tmp_path/'waveforms')
+	reader = WaveformsStoreReader(tmp_path/'waveforms')
+	assert reader.is_archived
+	amplitude_range = max(np.nanmax(amplitude)-np.nanmin(amplitude) for _, amplitude in waveforms.values())
+	assert_samples_match(reader, waveforms, time=1e-6*1e-9, amplitude=amplitude_range/2/AMPLITUDE_MAX_CODE)
+	reader.close()
+
+def test_store_resumes_after_a_partial_flush(tmp_path):
+	path = tmp_path/'waveforms'
+	writer = WaveformsStoreWriter(path, waveforms_per_block=2, checkpoint_columns=['n_event'])
+	n_waveform = 0
+	for n_event, n_waveforms_in_event in [(0, 2), (1, 2), (2, 1)]:
+		for _ in range(n_waveforms_in_event):
+			writer.append(metadata={'n_waveform': n_waveform, 'n_event': n_event}, time=np.arange(3.), amplitude=np.full(3, float(n_event)))
+			n_waveform += 1
+		if n_event < 2:
+			writer.checkpoint({'n_event': n_event})
+	# Now "crash": event 0 is checkpointed, event 1 was flushed without its checkpoint, event 2 is only in memory.
+	np.save(path/'blocks'/'block_000002.npy', np.zeros((1,2,3))) # A block whose metadata was never written.
+	
+	writer = WaveformsStoreWriter(path, waveforms_per_block=2, checkpoint_columns=['n_event'], resume=True)
+	assert writer.read_checkpoints()['n_event'].tolist() == [0]
+	assert writer.next_n_waveform == 2
+	assert sorted(p.name for p in (path/'blocks').iterdir()) == ['block_000000.npy']
+	n_waveform = writer.next_n_waveform
+	for n_event in [1, 2]:
+		for _ in range(2):
+			writer.append(metadata={'n_waveform': n_waveform, 'n_event': n_event}, time=np.arange(3.), amplitude=np.full(3, float(n_event)))
+			n_waveform += 1
+		writer.checkpoint({'n_event': n_event})
+	writer.close()
+	
+	reader = WaveformsStoreReader(path)
+	metadata_df = reader.read_metadata()
+	assert metadata_df['n_waveform'].tolist() == list(range(6))
+	assert metadata_df['n_event'].tolist() == [0, 0, 1, 1, 2, 2]
+	_, amplitude = reader.read_samples(metadata_df)
+	assert (amplitude == metadata_df['n_event'].to_numpy()[:,np.newaxis]).all()
+	reader.close()
+
+def test_convert_empty_sqlite_waveforms_gives_an_empty_store(tmp_path):
+	connection = sqlite3.connect(tmp_path/'waveforms.sqlite')
+	connection.execute('CREATE TABLE waveforms (n_waveform INTEGER, "Time (s)" REAL, "Amplitude (V)" REAL)')
+	connection.close()
+	convert_sqlite_waveforms_to_store(tmp_path/'waveforms.sqlite', tmp_path/'waveforms')
+	reader = WaveformsStoreReader(tmp_path/'waveforms')
+	assert reader.number_of_waveforms == 0
+	assert list(reader.iter_batches(10)) == []
+	assert len(reader.read_metadata()) == 0
+	reader.close()
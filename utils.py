@@ -2,33 +2,82 @@ from pathlib import Path
 import datetime
 import pandas
 import atexit
-import shutil
 import numpy as np
+import pyarrow
+import pyarrow.ipc
 import tct_scripts_config
 import time
+import threading
+import queue
+import collections
+from acquisition_pipeline import StageCounter
+
+def read_dumped_dataframe(path):
+	"""Reads a data frame from an Arrow IPC stream file written by
+	`DataFrameDumper`, e.g. `measured_data.arrows` that remains if the
+	program crashed before calling `end`. If the last batch is incomplete
+	(e.g. the crash happened while writing it) it is discarded and all
+	the previous ones are returned."""
+	tables = []
+	with pyarrow.OSFile(str(path), 'rb') as source:
+		try:
+			for batch in pyarrow.ipc.open_stream(source):
+				tables.append(pyarrow.Table.from_batches([batch]))
+		except (pyarrow.ArrowInvalid, OSError) as e: # Truncated stream.
+			print(f'The stream in {path} is incomplete, reason: {repr(e)}. Only the complete batches are read.')
+	if len(tables) == 0:
+		return pandas.DataFrame()
+	return pyarrow.concat_tables(tables).to_pandas()
 
 class DataFrameDumper:
 	"""This class is for easilly store a continuously growing dataframe
 	in the disk easilly. I tried to create a subclass of DataFrame but
-	it is too cumbersome."""
-	def __init__(self, file_path_in_the_end, df, dump_if_more_rows_than: int=1e6, dump_if_more_time_than: float=60):
+	it is too cumbersome.
+	
+	Each dump is appended as a record batch to an Arrow IPC stream file
+	(`<name>.arrows`) which is valid after every dump, so if the program
+	crashes everything dumped so far can be read with `read_dumped_dataframe`.
+	`end` converts the stream into the final feather file (`<name>.fd`)
+	batch by batch, without merging data frames in memory.
+	
+	The writing happens in a background thread, so `dump_to_disk` returns
+	immediately. Up to `max_dumps_in_queue` dumps can be waiting to be
+	written, if there are more `dump_to_disk` blocks until there is space
+	again. The time it was blocked and the time spent writing are in `statistics`.
+	
+	Usage:
+	```
+	dumper = DataFrameDumper('measured_data.fd', df)
+	for ...:
+		df = df.append(...)
+		df = dumper.dump_to_disk(df)
+	dumper.end(df)
+	```
+	"""
+	def __init__(self, file_path_in_the_end, df, dump_if_more_rows_than: int=1e6, dump_if_more_time_than: float=60, max_dumps_in_queue: int=10):
 		self._ended = False
 		self._columns_of_the_df = set(df.columns)
-		self._file_path_in_the_end = Path(file_path_in_the_end)
-		self._temp_files_path = self._file_path_in_the_end.with_suffix('.temp')
-		self._temp_files_path.mkdir(parents=True)
+		self._file_path_in_the_end = Path(file_path_in_the_end).with_suffix('.fd')
+		self._stream_file_path = self._file_path_in_the_end.with_suffix('.arrows')
+		if self._stream_file_path.exists():
+			raise FileExistsError(f'{self._stream_file_path} already exists, I will not overwrite it.')
+		self._stream_files_paths = [] # Normally only one, a new one is started if the type of a column changes, e.g. from int to float.
+		self._stream_sink = None
+		self._stream_writer = None
+		self._stream_schema = None
 		self.dump_if_more_rows_than = dump_if_more_rows_than
 		self.dump_if_more_time_than = dump_if_more_time_than
 		self._last_dump_when = datetime.datetime.now()
+		self._dumps_queue = queue.Queue(maxsize=max_dumps_in_queue)
+		self._exception = None
+		self.counter = StageCounter(f'DataFrameDumper {self._file_path_in_the_end.name}') # "Busy" is the time writing, "blocked" is the time that `dump_to_disk` waited because the queue was full.
+		self._writing_thread = threading.Thread(target=self._writing_thread_function, name=f'DataFrameDumper {self._file_path_in_the_end.name}', daemon=True)
+		self._writing_thread.start() # Only after everything it uses exists.
 		def _atexit():
 			if self._ended == False: # This means that the user forgot to call "end".
-				df = pandas.DataFrame(columns = self._columns_of_the_df)
-				# Concatenate all files into a single file.
-				for fpath in sorted(self._temp_files_path.iterdir()):
-					df = df.append(pandas.read_feather(fpath))
-				df.reset_index(inplace = True, drop=True)
-				df.to_csv(self._file_path_in_the_end.with_suffix('.csv')) # For some strange reason this does not work for feather format within the atexit module, see https://stackoverflow.com/questions/69667532/pandas-feather-atexit-runtimeerror-cannot-schedule-new-futures-after-inte
-				shutil.rmtree(self._temp_files_path)
+				self._stop_writing_thread()
+				self._close_stream() # Everything is already in the disk, just close it.
+				print(f'`DataFrameDumper.end` was never called, the data is in {[str(p) for p in self._stream_files_paths]}, use `utils.read_dumped_dataframe` to read it.')
 				self._ended = True
 		atexit.register(_atexit)
 	
@@ -42,20 +91,95 @@ class DataFrameDumper:
 		if set(df.columns) != self._columns_of_the_df:
 			raise ValueError(f'The columns of the dataframe do not match!')
 		if force==True or len(df.index) > self.dump_if_more_rows_than or (datetime.datetime.now()-self._last_dump_when).seconds > self.dump_if_more_time_than:
-			df.reset_index(drop=True).to_feather(self._temp_files_path/Path(datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')))
+			self._raise_if_writing_failed()
+			if len(df.index) > 0:
+				start = time.monotonic()
+				while True:
+					try:
+						self._dumps_queue.put(df.copy(), timeout=1)
+						break
+					except queue.Full:
+						self._raise_if_writing_failed()
+				self.counter.add_blocked_time(time.monotonic() - start)
+			self._last_dump_when = datetime.datetime.now()
 			return df[0:0]
 		else:
 			return df
 	
+	def flush(self):
+		"""Waits until all the dumps were written to the disk."""
+		self._dumps_queue.join()
+		self._raise_if_writing_failed()
+	
+	def statistics(self):
+		"""Returns a dictionary with the number of dumps written, the time
+		spent writing and the time that `dump_to_disk` was blocked."""
+		return self.counter.summary()
+	
+	def _writing_thread_function(self):
+		while True:
+			df = self._dumps_queue.get()
+			try:
+				if df is None: # Stop.
+					break
+				if self._exception is None: # After an error nothing else is written, but the queue is still emptied so nobody waits forever.
+					with self.counter.measure():
+						self._write(df)
+			except Exception as e:
+				self._exception = e
+			finally:
+				self._dumps_queue.task_done()
+	
+	def _stop_writing_thread(self):
+		if self._writing_thread.is_alive():
+			self._dumps_queue.put(None)
+			self._writing_thread.join()
+	
+	def _raise_if_writing_failed(self):
+		if self._exception is not None:
+			raise RuntimeError(f'Cannot write the data frame into {self._stream_file_path}, reason: {repr(self._exception)}') from self._exception
+	
+	def _write(self, df):
+		"""Appends `df` to the stream file as a new record batch."""
+		table = pyarrow.Table.from_pandas(df.reset_index(drop=True), preserve_index=False)
+		if self._stream_writer is not None:
+			try:
+				table = table.select(self._stream_schema.names).cast(self._stream_schema)
+			except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError, pyarrow.ArrowTypeError, ValueError, KeyError): # The type of some column changed, it cannot be appended to this stream.
+				self._close_stream()
+		if self._stream_writer is None:
+			stream_file_path = self._stream_file_path if len(self._stream_files_paths) == 0 else self._stream_file_path.with_suffix(f'.{len(self._stream_files_paths)}.arrows')
+			self._stream_sink = pyarrow.OSFile(str(stream_file_path), 'wb')
+			self._stream_writer = pyarrow.ipc.new_stream(self._stream_sink, table.schema)
+			self._stream_schema = table.schema
+			self._stream_files_paths.append(stream_file_path)
+		self._stream_writer.write_table(table)
+		self._stream_sink.flush() # So the file is readable right now.
+	
+	def _close_stream(self):
+		if self._stream_writer is not None:
+			self._stream_writer.close()
+			self._stream_sink.close()
+			self._stream_writer = None
+			self._stream_sink = None
+	
 	def end(self, df):
 		self.dump_to_disk(df, force=True) # In case there is any data remaining...
-		df = pandas.DataFrame(columns = self._columns_of_the_df)
-		# Concatenate all files into a single file.
-		for fpath in sorted(self._temp_files_path.iterdir()):
-			df = df.append(pandas.read_feather(fpath))
-		df.reset_index(inplace = True, drop=True)
-		df.to_feather(self._file_path_in_the_end.with_suffix('.fd'))
-		shutil.rmtree(self._temp_files_path)
+		self.flush()
+		self._stop_writing_thread()
+		self._close_stream()
+		if len(self._stream_files_paths) == 0: # Nothing was ever dumped.
+			df[0:0].reset_index(drop=True).to_feather(self._file_path_in_the_end)
+		elif len(self._stream_files_paths) == 1: # Copy the batches one by one into the feather file, the data never has to be all in memory.
+			with pyarrow.OSFile(str(self._stream_files_paths[0]), 'rb') as source:
+				reader = pyarrow.ipc.open_stream(source)
+				with pyarrow.ipc.new_file(str(self._file_path_in_the_end), reader.schema) as writer:
+					for batch in reader:
+						writer.write_batch(batch)
+		else: # The types of the columns changed at some point, let pandas find the common types.
+			pandas.concat([read_dumped_dataframe(p) for p in self._stream_files_paths], ignore_index=True).to_feather(self._file_path_in_the_end)
+		for p in self._stream_files_paths:
+			p.unlink()
 		self._ended = True
 	
 	def _check_ended(self):
@@ -66,6 +190,176 @@ class DataFrameDumper:
 	def file_path(self):
 		return self._file_path_in_the_end
 
+class WaveformsAverager:
+	"""Computes the average waveform and its standard deviation, sample by
+	sample, for groups of waveforms (e.g. for each `(n_position, n_channel, n_pulse)`)
+	while they are being acquired, using Welford's online algorithm. Each
+	waveform is used once and then forgotten, so the memory depends only
+	on the number of groups and samples, not on the number of triggers.
+	
+	Usage:
+	```
+	averager = WaveformsAverager(group_by=['n_position','n_channel','n_pulse'])
+	for ...:
+		averager.add(metadata={'n_position': 0, 'n_channel': 1, 'n_pulse': 1, ...}, time=time, amplitude=amplitude)
+	average_waveforms_df = averager.dataframe()
+	```
+	"""
+	def __init__(self, group_by: list):
+		"""
+		Parameters
+		----------
+		group_by: list
+			Names of the keys in `metadata` that define each group, e.g. `['n_position','n_channel','n_pulse']`.
+		"""
+		self.group_by = list(group_by)
+		self._groups = {} # `{key: {'n': array, 'time': array, 'mean': array, 'M2': array}}`, one element per sample.
+		self._lock = threading.Lock() # Waveforms may be added from a background thread, e.g. in `AcquisitionPipeline`.
+	
+	def add(self, metadata: dict, time, amplitude):
+		"""Adds a waveform to the group given by `metadata`. Samples that are NaN (e.g. saturated) are not used."""
+		key = tuple(metadata[k] for k in self.group_by)
+		time = np.asarray(time, dtype=float)
+		amplitude = np.asarray(amplitude, dtype=float)
+		with self._lock:
+			if key not in self._groups:
+				self._groups[key] = {variable: np.zeros(0) for variable in ['n','time','mean','M2']}
+			group = self._groups[key]
+			if len(amplitude) > len(group['n']): # A longer waveform than before, grow the arrays.
+				for variable in group:
+					group[variable] = np.pad(group[variable], (0,len(amplitude)-len(group[variable])))
+			n_samples = len(amplitude)
+			is_valid = ~np.isnan(amplitude)
+			n = group['n'][:n_samples]
+			n += is_valid
+			with np.errstate(invalid='ignore', divide='ignore'):
+				delta = np.where(is_valid, amplitude - group['mean'][:n_samples], 0)
+				group['mean'][:n_samples] += np.where(is_valid, delta/n, 0)
+				group['M2'][:n_samples] += np.where(is_valid, delta*(amplitude - group['mean'][:n_samples]), 0)
+				group['time'][:n_samples] += np.where(is_valid, (time - group['time'][:n_samples])/n, 0)
+	
+	def dataframe(self):
+		"""Returns a data frame with one row per group and sample, with
+		the columns in `group_by` and `Time (s)`, `Amplitude mean (V)`,
+		`Amplitude std (V)` and `Number of waveforms`."""
+		dfs = []
+		with self._lock:
+			for key, group in self._groups.items():
+				with np.errstate(invalid='ignore', divide='ignore'):
+					std = np.where(group['n'] > 1, (group['M2']/(group['n']-1))**.5, float('NaN'))
+				df = pandas.DataFrame(
+					{
+						'Time (s)': np.where(group['n'] > 0, group['time'], float('NaN')),
+						'Amplitude mean (V)': np.where(group['n'] > 0, group['mean'], float('NaN')),
+						'Amplitude std (V)': std,
+						'Number of waveforms': group['n'].astype(int),
+					}
+				)
+				for column, value in zip(self.group_by, key):
+					df[column] = value
+				dfs.append(df)
+		if len(dfs) == 0:
+			return pandas.DataFrame(columns=self.group_by+['Time (s)','Amplitude mean (V)','Amplitude std (V)','Number of waveforms'])
+		return pandas.concat(dfs, ignore_index=True)[self.group_by+['Time (s)','Amplitude mean (V)','Amplitude std (V)','Number of waveforms']]
+	
+	def mean_waveform(self, metadata: dict):
+		"""Returns the average waveform of the group given by `metadata` as
+		a dictionary with the arrays `Time (s)`, `Amplitude mean (V)`,
+		`Amplitude std (V)` and `Number of waveforms`, as in `dataframe`,
+		or `None` if no waveform was added to that group."""
+		key = tuple(metadata[k] for k in self.group_by)
+		with self._lock:
+			if key not in self._groups:
+				return None
+			group = self._groups[key]
+			is_valid = group['n'] > 0
+			with np.errstate(invalid='ignore', divide='ignore'):
+				std = np.where(group['n'] > 1, (group['M2']/(group['n']-1))**.5, float('NaN'))
+			return {
+				'Time (s)': group['time'][is_valid].copy(),
+				'Amplitude mean (V)': group['mean'][is_valid].copy(),
+				'Amplitude std (V)': std[is_valid],
+				'Number of waveforms': group['n'][is_valid].astype(int),
+			}
+
+def positions_to_refine_1D_scan(distances, collected_charge: dict, minimum_step: float, max_new_positions: int, threshold: float=.05, collected_charge_std: dict=None, significance: float=3):
+	"""Given the positions already measured in a 1D scan and the collected
+	charge in each of them, finds where to add new positions. Each interval
+	between two consecutive positions gets a score which is the largest of:
+	- The change of the collected charge of each channel, relative to the
+	  maximum collected charge of that channel in the whole scan.
+	- The change of the fraction of the total charge collected by each
+	  channel (i.e. the charge sharing between pixels), only where the
+	  total charge is not negligible.
+	If `collected_charge_std` is given, changes that are not larger than
+	`significance` times their uncertainty do not count, so positions are
+	not added where the charge only fluctuates from trigger to trigger.
+	The intervals with the highest scores are split in two.
+	
+	Parameters
+	----------
+	distances: array like
+		Position of each point along the scan, in meters, in any order.
+	collected_charge: dict
+		A dictionary of the form `{n_channel: array}` with the collected
+		charge in each position, in the same order as `distances`.
+	minimum_step: float
+		Intervals that would become shorter than this are not split.
+	max_new_positions: int
+		Maximum number of new positions to return.
+	threshold: float, default 0.05
+		Intervals with a score below this are not split, i.e. the charge
+		changes less than 5 % between the two positions.
+	collected_charge_std: dict, optional
+		The standard error of each value in `collected_charge`, with the
+		same form. `NaN` means unknown, and is taken as 0.
+	significance: float, default 3
+		Number of standard errors a change must exceed to be considered.
+	
+	Returns
+	-------
+	new_distances: list of float
+		The distances of the new positions, sorted.
+	"""
+	distances = np.asarray(distances, dtype=float)
+	if len(distances) < 2 or max_new_positions < 1:
+		return []
+	order = np.argsort(distances)
+	distances = distances[order]
+	charges = np.array([np.asarray(collected_charge[n_channel], dtype=float)[order] for n_channel in sorted(collected_charge)])
+	charges = np.where(np.isnan(charges), 0, charges)
+	if collected_charge_std is None:
+		charges_std = np.zeros(charges.shape)
+	else:
+		charges_std = np.array([np.asarray(collected_charge_std[n_channel], dtype=float)[order] for n_channel in sorted(collected_charge)])
+		charges_std = np.where(np.isnan(charges_std), 0, charges_std)
+	
+	def significant_change(values, values_std):
+		"""Absolute change between consecutive positions, 0 where it is not above the noise."""
+		change = np.abs(np.diff(values, axis=1))
+		return np.where(change > significance*(values_std[:,1:]**2 + values_std[:,:-1]**2)**.5, change, 0)
+	
+	with np.errstate(invalid='ignore', divide='ignore'):
+		maximum_charge = np.nanmax(np.abs(charges), axis=1, keepdims=True)
+		normalized_charges = charges/maximum_charge
+		normalized_charges_std = charges_std/maximum_charge
+		total_charge = charges.sum(axis=0)
+		total_charge_std = (charges_std**2).sum(axis=0)**.5
+		sharing = charges/total_charge
+		sharing_std = (charges_std**2 + (sharing*total_charge_std)**2)**.5/np.abs(total_charge)
+	normalized_charges = np.where(np.isfinite(normalized_charges), normalized_charges, 0)
+	normalized_charges_std = np.where(np.isfinite(normalized_charges_std), normalized_charges_std, 0)
+	score = significant_change(normalized_charges, normalized_charges_std).max(axis=0)
+	if len(charges) > 1: # Charge sharing between pixels.
+		has_charge = total_charge > .1*np.nanmax(np.abs(total_charge)) # Outside the device the fraction is just noise.
+		sharing = np.where(has_charge, sharing, 0)
+		sharing_std = np.where(has_charge & np.isfinite(sharing_std), sharing_std, 0)
+		sharing_score = significant_change(sharing, sharing_std).max(axis=0)
+		score = np.maximum(score, np.where(has_charge[:-1]&has_charge[1:], sharing_score, 0))
+	can_be_split = (np.diff(distances)/2 >= minimum_step) & (score > threshold)
+	candidates = [n for n in np.argsort(-score, kind='stable') if can_be_split[n]][:max_new_positions]
+	return sorted(float((distances[n]+distances[n+1])/2) for n in candidates)
+
 def adjust_oscilloscope_vdiv_for_linear_scan_between_two_pixels(the_setup, oscilloscope_channels, position_of_each_pixel):
 	"""Adjust oscilloscope VDIV assuming a TI-LGAD.
 	
@@ -120,6 +414,35 @@ def adjust_oscilloscope_vdiv_for_linear_scan_between_two_pixels(the_setup, oscil
 				print(f'{n_signals_without_NaN+1} out of {NUMBER_OF_SIGNALS_UNTIL_WE_CONSIDER_WE_ARE_IN_THE_RIGHT_SCALE} signals without NaN, scale seems to be fine!')
 				n_signals_without_NaN += 1
 
+def get_center_position_from_file(path: Path=None):
+	"""Reads the position `(x,y,z)` of the center of the current detector,
+	written in the file `path` as three numbers separated by commas or
+	spaces. If `path` is not given, `tct_scripts_config.CURRENT_DETECTOR_CENTER_FILE_PATH`
+	is used. Returns `None` if the file does not exist, e.g. when not
+	running in the lab computer."""
+	path = Path(path) if path is not None else tct_scripts_config.CURRENT_DETECTOR_CENTER_FILE_PATH
+	if not path.is_file():
+		return None
+	with open(path, 'r') as ifile:
+		center = [float(value) for value in ifile.read().replace(',',' ').split()]
+	if len(center) != 3:
+		raise ValueError(f'Cannot read the center position from {repr(str(path))}, expecting 3 numbers but found {repr(center)}.')
+	return tuple(center)
+
+def map_with_bounded_memory(executor, function, *iterables, max_in_flight: int):
+	"""Like `executor.map` but only `max_in_flight` calls are submitted
+	at any time, so if the consumer of the results is slower than the
+	workers the finished results do not pile up in memory. The results
+	are yielded in the order of the arguments."""
+	arguments = zip(*iterables)
+	in_flight = collections.deque()
+	for args in arguments:
+		in_flight.append(executor.submit(function, *args))
+		if len(in_flight) >= max_in_flight:
+			yield in_flight.popleft().result()
+	while len(in_flight) > 0:
+		yield in_flight.popleft().result()
+
 def interlace(lst):
 	# https://en.wikipedia.org/wiki/Interlacing_(bitmaps)
 	lst = sorted(lst)[::-1]
@@ -132,35 +455,158 @@ def interlace(lst):
 			ranges += (start, middle), (middle + 1, stop)
 	return result
 
+SCAN_PATH_METHODS = {'row_by_row','serpentine','nearest_neighbour'}
+
+def plan_scan_path(positions: list, method: str='serpentine'):
+	"""Given a grid of positions, decides in which order to measure them
+	so the stages travel less.
+
+	Parameters
+	----------
+	positions: list
+		A list of lists of positions, each of them of the form `(x,y,z)`,
+		such that `positions[n_position_1][n_position_2]` is a position.
+		The rows may have different lengths.
+	method: str, default 'serpentine'
+		One of `SCAN_PATH_METHODS`:
+		- `'row_by_row'`: Each row from the beginning to the end, so at the
+		end of each row the stages go back to the beginning of the next one.
+		- `'serpentine'`: Every other row is measured backwards, so each
+		row starts next to where the previous one finished.
+		- `'nearest_neighbour'`: Starting at the first position, always go
+		to the closest position not yet measured. Useful for irregular
+		grids, for regular grids it is usually the same as `'serpentine'`.
+
+	Returns
+	-------
+	path: list
+		A list of tuples `(n_position_1, n_position_2)` in the order in
+		which the positions should be measured.
+	"""
+	if method not in SCAN_PATH_METHODS:
+		raise ValueError(f'`method` must be one of {SCAN_PATH_METHODS}, received {repr(method)}.')
+	if method == 'row_by_row':
+		return [(n1,n2) for n1,row in enumerate(positions) for n2 in range(len(row))]
+	if method == 'serpentine':
+		return [(n1,n2) for n1,row in enumerate(positions) for n2 in (range(len(row)) if n1%2 == 0 else reversed(range(len(row))))]
+	indices = [(n1,n2) for n1,row in enumerate(positions) for n2 in range(len(row))]
+	if len(indices) == 0:
+		return []
+	points = np.array([positions[n1][n2] for n1,n2 in indices], dtype=float)
+	not_visited = np.ones(len(points), dtype=bool)
+	path = []
+	current = 0
+	while True:
+		path.append(indices[current])
+		not_visited[current] = False
+		if not not_visited.any():
+			break
+		distances = np.where(not_visited, ((points - points[current])**2).sum(axis=1), float('inf'))
+		current = int(np.argmin(distances))
+	return path
+
+def scan_path_length(positions: list):
+	"""Returns the total distance travelled by the stages when visiting
+	`positions`, a list of `(x,y,z)`, in order."""
+	if len(positions) < 2:
+		return 0.
+	return float(((np.diff(np.array(positions, dtype=float), axis=0)**2).sum(axis=1)**.5).sum())
+
 def wait_for_nice_trigger_without_EMI(the_setup, channels: list):
-	is_noisy = True
-	while is_noisy:
+	"""Waits for a trigger in which none of the channels has EMI (i.e. 
+	too much noise in the regions where there should be no signal) and
+	returns the waveforms of such trigger, so they don't have to be
+	downloaded again from the oscilloscope.
+	
+	Parameters
+	----------
+	the_setup: TheSetup
+		An instance of TheSetup.
+	channels: list
+		A list with the channels to check, e.g. `[1,2]`.
+	
+	Returns
+	-------
+	raw_waveforms: dict
+		A dictionary of the form `{n_channel: raw_data}` where `raw_data`
+		is what `the_setup.get_waveform` returns for each channel.
+	"""
+	while True:
 		try:
 			the_setup.wait_for_trigger()
 		except Exception as e:
 			print(f'Error while waiting for trigger, reason: {repr(e)}...')
-			sleep(1)
+			time.sleep(1)
 			continue
-		noise_per_channel = []
+		raw_waveforms = {}
 		for ch in channels:
 			try:
-				_raw = the_setup.get_waveform(channel=ch)
+				raw_waveforms[ch] = the_setup.get_waveform(channel=ch)
 			except Exception as e:
 				print(f'Cannot get data from oscilloscope, reason: {e}')
 				break
-			_amplitude = np.array(_raw['Amplitude (V)'])
-			_time = np.array(_raw['Time (s)'])
-			# ~ # For debug ---
-			# ~ import grafica
-			# ~ fig = grafica.new()
-			# ~ fig.scatter(y=_amplitude, x=_time)
-			# ~ fig.save(str(tct_scripts_config.DATA_STORAGE_DIRECTORY_PATH/Path('plot.html')))
-			# ~ input('Figure has been saved...')
-			# ~ # -------------
-			samples_where_we_shoud_have_no_signal = _amplitude[(_time<190e-9)|((_time>240e-9)&(_time<290e-9))] # Totally empiric numbers, the "debug lines" just before are to find this.
-			this_channel_noise = np.std(samples_where_we_shoud_have_no_signal)
-			noise_per_channel.append(this_channel_noise)
-		if all(noise < 111 for noise in noise_per_channel):
-			is_noisy = False
-		else:
-			print('Noisy trigger! Will skip it...')
+		if len(raw_waveforms) != len(channels): # Could not get all the waveforms, try with the next trigger.
+			continue
+		# ~ # For debug ---
+		# ~ import grafica
+		# ~ fig = grafica.new()
+		# ~ fig.scatter(y=raw_waveforms[channels[0]]['Amplitude (V)'], x=raw_waveforms[channels[0]]['Time (s)'])
+		# ~ fig.save(str(tct_scripts_config.DATA_STORAGE_DIRECTORY_PATH/Path('plot.html')))
+		# ~ input('Figure has been saved...')
+		# ~ # -------------
+		try: # All the channels have the same number of samples, so we can calculate the noise of all of them at once.
+			_amplitude = np.array([raw_waveforms[ch]['Amplitude (V)'] for ch in channels], dtype=float)
+			_time = np.array([raw_waveforms[ch]['Time (s)'] for ch in channels], dtype=float)
+		except ValueError: # If for some reason they don't have the same number of samples, pad with NaN.
+			n_samples = max(len(raw_waveforms[ch]['Amplitude (V)']) for ch in channels)
+			_amplitude = np.array([np.pad(np.asarray(raw_waveforms[ch]['Amplitude (V)'], dtype=float), (0,n_samples-len(raw_waveforms[ch]['Amplitude (V)'])), constant_values=float('NaN')) for ch in channels])
+			_time = np.array([np.pad(np.asarray(raw_waveforms[ch]['Time (s)'], dtype=float), (0,n_samples-len(raw_waveforms[ch]['Time (s)'])), constant_values=float('NaN')) for ch in channels])
+		if not any(is_EMI(_time, _amplitude)):
+			return raw_waveforms
+		print('Noisy trigger! Will skip it...')
+
+def is_EMI(time, amplitude):
+	"""Given arrays of waveforms with shape `(..., n_samples)` returns a
+	boolean array with shape `(...)` telling which waveforms have EMI,
+	i.e. too much noise in the regions where there should be no signal.
+	A `NaN` sample in those regions (e.g. saturated) counts as EMI. Waveforms
+	can be padded with `NaN` in both `time` and `amplitude`, the padding
+	is ignored."""
+	time = np.asarray(time)
+	amplitude = np.asarray(amplitude)
+	where_we_should_have_no_signal = (time<190e-9)|((time>240e-9)&(time<290e-9)) # Totally empiric numbers, the "debug lines" in `wait_for_nice_trigger_without_EMI` are to find this. The padding has `NaN` time, so it is never here.
+	n_samples = where_we_should_have_no_signal.sum(axis=-1)
+	with np.errstate(divide='ignore', invalid='ignore'): # `np.std` of the samples in the regions, `NaN` if any of them is `NaN`.
+		mean = np.where(where_we_should_have_no_signal, amplitude, 0).sum(axis=-1)/n_samples
+		noise = (np.where(where_we_should_have_no_signal, (amplitude-mean[...,np.newaxis])**2, 0).sum(axis=-1)/n_samples)**.5
+	return ~(noise < 111)
+
+def acquire_nice_triggers_without_EMI_in_sequence_mode(the_setup, channels: list, n_triggers: int):
+	"""Same as `wait_for_nice_trigger_without_EMI` but acquires `n_triggers`
+	triggers using the sequence mode of the oscilloscope, see `TheSetup.acquire_segments`.
+	Triggers with EMI are discarded and more triggers are acquired until
+	there are `n_triggers` nice ones.
+	
+	Returns
+	-------
+	raw_waveforms_each_trigger: list
+		A list of length `n_triggers` in which each element is a dictionary
+		of the form `{n_channel: raw_data}`, i.e. the same that `wait_for_nice_trigger_without_EMI`
+		returns for each trigger.
+	"""
+	raw_waveforms_each_trigger = []
+	while len(raw_waveforms_each_trigger) < n_triggers:
+		try:
+			waveforms = the_setup.acquire_segments(channels=channels, n_segments=n_triggers-len(raw_waveforms_each_trigger))
+		except Exception as e:
+			print(f'Error while acquiring in sequence mode, reason: {repr(e)}...')
+			time.sleep(1)
+			continue
+		segment_has_EMI = np.any([is_EMI(waveforms[ch]['Time (s)'], waveforms[ch]['Amplitude (V)']) for ch in channels], axis=0)
+		if any(segment_has_EMI):
+			print(f'{sum(segment_has_EMI)} noisy triggers! Will skip them...')
+		for n_segment in np.where(~segment_has_EMI)[0]:
+			raw_waveforms_each_trigger.append(
+				{ch: {variable: waveforms[ch][variable][n_segment] for variable in ['Time (s)','Amplitude (V)']} for ch in channels}
+			)
+	return raw_waveforms_each_trigger
@@ -0,0 +1,651 @@
+import numpy as np
+import pandas
+from pathlib import Path
+import sqlite3
+from time import monotonic
+
+METADATA_FILE_NAME = 'metadata.sqlite'
+BLOCKS_DIRECTORY_NAME = 'blocks'
+SUMMARY_TABLE_NAME = 'waveforms_summary'
+CHECKPOINTS_TABLE_NAME = 'checkpoints'
+AMPLITUDE_NAN_CODE = np.iinfo(np.int16).min
+AMPLITUDE_MAX_CODE = np.iinfo(np.int16).max - 1
+
+def create_n_waveform_index(sqlite3_connection, table: str='waveforms'):
+	"""Creates (if it does not exist) an index on the column `n_waveform`
+	of `table`, so selecting waveforms by `n_waveform` and the `min`/`max`
+	of it do not require to scan the whole table."""
+	sqlite3_connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_n_waveform ON {table}(n_waveform)')
+	sqlite3_connection.commit()
+
+def _column_to_array(values):
+	"""Converts the values of one column returned by sqlite (`int`, `float`,
+	`str` or `None`) into the narrowest numpy array that holds them."""
+	types = set(map(type, values))
+	if types <= {int}:
+		return np.fromiter(values, dtype=np.int64, count=len(values))
+	if types <= {int, float, type(None)}: # Numbers with some `None`, which is how NaN is stored in sqlite.
+		return np.fromiter((float('NaN') if value is None else value for value in values), dtype=float, count=len(values))
+	return np.array(values, dtype=object) # Strings.
+
+def read_query_into_arrays(sqlite3_connection, query: str, rows_per_fetch: int=10000):
+	"""Executes `query` and streams the resulting rows with a cursor
+	into numpy arrays, one array per column. Each chunk of rows is
+	converted to typed arrays as soon as it is fetched, so at most
+	`rows_per_fetch` rows exist as Python objects at any time. This avoids
+	the overhead of `pandas.read_sql_query` for big queries. Returns a
+	dictionary `{column_name: numpy.array}`, columns in the order of the query."""
+	cursor = sqlite3_connection.cursor()
+	cursor.execute(query)
+	column_names = [description[0] for description in cursor.description]
+	chunks = {column_name: [] for column_name in column_names}
+	while True:
+		rows = cursor.fetchmany(rows_per_fetch)
+		if len(rows) == 0:
+			break
+		for column_name, values in zip(column_names, zip(*rows)): # Transpose into columns.
+			chunks[column_name].append(_column_to_array(values))
+	return {column_name: np.concatenate(chunks[column_name]) if len(chunks[column_name]) > 0 else np.array([]) for column_name in column_names}
+
+def directory_size(path: Path):
+	"""Returns the size in bytes of a file, or of all the files inside a directory."""
+	path = Path(path)
+	if path.is_file():
+		return path.stat().st_size
+	return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+
+class WaveformsBuffer:
+	"""Fixed capacity buffer to accumulate waveforms in memory, backed by
+	preallocated numpy arrays: one typed array per metadata column and
+	one array of shape `(capacity, 2, n_samples)` for the samples. Appending
+	a waveform only copies that waveform, so the cost per waveform is
+	constant and the memory is bounded by `capacity`."""
+	def __init__(self, capacity: int):
+		if not isinstance(capacity, int) or capacity < 1:
+			raise ValueError(f'`capacity` must be a positive integer, received {repr(capacity)}.')
+		self.capacity = capacity
+		self._columns = None # Created with the first waveform, as the columns and their types are not known before.
+		self._samples = None
+		self._n_samples = np.zeros(capacity, dtype=int)
+		self._length = 0
+
+	def __len__(self):
+		return self._length
+
+	@property
+	def is_full(self):
+		return self._length >= self.capacity
+
+	def append(self, metadata: dict, time, amplitude):
+		"""Append a waveform. `time` and `amplitude` must be 1D numpy arrays of the same length."""
+		if self.is_full:
+			raise RuntimeError(f'The buffer is full, call `clear` before appending more waveforms.')
+		if self._columns is None:
+			self._columns = {}
+			for column, value in metadata.items():
+				dtype = np.asarray(value).dtype
+				self._columns[column] = np.empty(self.capacity, dtype=dtype if dtype.kind in 'iufb' else object)
+		if set(metadata) != set(self._columns):
+			raise ValueError(f'All the waveforms must have the same metadata, expecting {sorted(self._columns)} but received {sorted(metadata)}.')
+		for column, value in metadata.items():
+			column_dtype = self._columns[column].dtype
+			value_dtype = np.asarray(value).dtype
+			dtype = np.result_type(column_dtype, value_dtype) if column_dtype.kind in 'iufb' and value_dtype.kind in 'iufb' else np.dtype(object)
+			if dtype != column_dtype: # Widen before assigning, e.g. `1.5` or `NaN` in a column that was created as integer would otherwise be silently truncated.
+				self._columns[column] = self._columns[column].astype(dtype)
+			self._columns[column][self._length] = value
+		if self._samples is None or len(time) > self._samples.shape[2]: # Allocate, or widen if a longer waveform arrives (this should be rare).
+			samples = np.full((self.capacity, 2, len(time)), float('NaN'))
+			if self._samples is not None:
+				samples[:,:,:self._samples.shape[2]] = self._samples
+			self._samples = samples
+		self._samples[self._length,0,:len(time)] = time
+		self._samples[self._length,1,:len(amplitude)] = amplitude
+		self._n_samples[self._length] = len(time)
+		self._length += 1
+
+	@property
+	def n_samples(self):
+		"""Array with the number of samples of each waveform in the buffer."""
+		return self._n_samples[:self._length]
+
+	@property
+	def samples(self):
+		"""Array of shape `(len(self), 2, n_samples)` with the samples of the waveforms in the buffer. This is a view, not a copy."""
+		return self._samples[:self._length,:,:max(self.n_samples)]
+
+	def metadata(self):
+		"""Returns a data frame with the metadata of the waveforms in the buffer."""
+		return pandas.DataFrame({column: values[:self._length] for column, values in self._columns.items()})
+
+	def clear(self):
+		"""Removes all the waveforms, keeping the memory allocated."""
+		if self._samples is not None:
+			self._samples[:self._length] = float('NaN')
+		self._length = 0
+
+class WaveformsStoreWriter:
+	"""Stores waveforms in the disk using one row of metadata per waveform
+	(in an sqlite file) while the samples are stored as fixed-length
+	arrays in chunked binary blocks (numpy `.npy` files). This is much
+	more compact and fast than storing one row per sample with all the
+	metadata repeated in each row.
+
+	Layout of the directory:
+	```
+	path/
+		metadata.sqlite   Table `waveforms` with one row per waveform, indexed by `n_waveform`.
+		                  Table `waveforms_summary` with a single row with the counts.
+		                  Table `checkpoints`, only if `checkpoint_columns` is given, see below.
+		blocks/
+			block_000000.npy   Array of shape (n_waveforms_in_block, 2, n_samples), [:,0,:] is time and [:,1,:] is amplitude.
+			block_000001.npy
+			...
+	```
+	Waveforms shorter than the longest one in the block are padded with
+	NaN, the real length is in the column `Number of samples`.
+	
+	To keep the waveforms after they were parsed the blocks can be
+	compressed with `archive_waveforms_store`, which replaces each
+	`block_xxxxxx.npy` by a much smaller `block_xxxxxx.npz`. Archived
+	stores are read by `WaveformsStoreReader` as any other store.
+
+	To be able to resume a measurement that was interrupted, give the
+	columns that identify each event in `checkpoint_columns`, e.g.
+	`['n_position','n_trigger']`, and call `checkpoint` after all the
+	waveforms of each event were appended. The events are written in
+	the table `checkpoints` in the same flush as their waveforms, after
+	the metadata, so after a crash every event in this table is complete.
+	Opening the store again with `resume=True` deletes the waveforms of
+	incomplete events, and `read_checkpoints` tells which events can be
+	skipped.
+
+	Usage:
+	```
+	with WaveformsStoreWriter(path) as writer:
+		for ...:
+			writer.append(metadata = {'n_waveform': n_waveform, ...}, time = time, amplitude = amplitude)
+	```
+	"""
+	def __init__(self, path: Path, waveforms_per_block: int=3333, checkpoint_columns: list=None, resume: bool=False, max_seconds_between_flushes: float=None):
+		"""
+		Parameters
+		----------
+		path: Path
+			Path to a directory in which to store the waveforms. It must
+			not exist, it will be created, unless `resume` is `True`.
+		waveforms_per_block: int, default 3333
+			Number of waveforms stored in each binary block. This is also
+			the capacity of the buffer in memory, see `WaveformsBuffer`.
+		checkpoint_columns: list of str, optional
+			Columns of the metadata that identify an event, see `checkpoint`.
+		resume: bool, default False
+			If `True` and there is already a store in `path`, new waveforms
+			are appended to it. Waveforms of events that were not checkpointed
+			are deleted.
+		max_seconds_between_flushes: float, optional
+			If given, the waveforms in memory are written to disk after this
+			time even if the block is not full, so less work is lost if the
+			measurement is interrupted. With `checkpoint_columns` this is
+			done in `checkpoint`, i.e. between events.
+		"""
+		if not isinstance(waveforms_per_block, int) or waveforms_per_block < 1:
+			raise ValueError(f'`waveforms_per_block` must be a positive integer, received {repr(waveforms_per_block)}.')
+		self._path = Path(path)
+		resuming = resume and (self._path/Path(METADATA_FILE_NAME)).is_file()
+		if not resuming:
+			self._path.mkdir(parents=True)
+			(self._path/Path(BLOCKS_DIRECTORY_NAME)).mkdir()
+		self._sqlite3_connection = sqlite3.connect(self._path/Path(METADATA_FILE_NAME), check_same_thread=False) # The writer may be used from a background thread, e.g. in `AcquisitionPipeline`, but never from two threads at the same time.
+		self.waveforms_per_block = waveforms_per_block
+		self.checkpoint_columns = list(checkpoint_columns) if checkpoint_columns is not None else None
+		self.max_seconds_between_flushes = max_seconds_between_flushes
+		self._pending_checkpoints = []
+		self._last_flush_when = monotonic()
+		self._n_block = 0
+		self._buffer = WaveformsBuffer(capacity=waveforms_per_block)
+		self._summary = {'Number of waveforms': 0, 'Number of blocks': 0, 'n_waveform min': None, 'n_waveform max': None}
+		self._closed = False
+		if self.checkpoint_columns is not None:
+			self._sqlite3_connection.execute(f'CREATE TABLE IF NOT EXISTS {CHECKPOINTS_TABLE_NAME} ({self._quoted_checkpoint_columns()})')
+			self._sqlite3_connection.commit()
+		if resuming:
+			self._prepare_for_resuming()
+
+	def _quoted_checkpoint_columns(self):
+		return ', '.join(f'"{column}"' for column in self.checkpoint_columns)
+
+	def _prepare_for_resuming(self):
+		"""Deletes the waveforms of the events that were not checkpointed
+		and the blocks without metadata, i.e. whatever was being written
+		when the measurement was interrupted, and continues the numbering
+		of the blocks."""
+		cursor = self._sqlite3_connection.cursor()
+		cursor.execute("SELECT count(*) from sqlite_master where type='table' and name='waveforms'")
+		if cursor.fetchone()[0] == 0: # Interrupted before writing anything.
+			return
+		with self._sqlite3_connection: # A transaction.
+			if self.checkpoint_columns is not None:
+				matching_columns = ' and '.join(f'{CHECKPOINTS_TABLE_NAME}."{column}" = waveforms."{column}"' for column in self.checkpoint_columns)
+				self._sqlite3_connection.execute(f'DELETE FROM waveforms WHERE NOT EXISTS (SELECT 1 FROM {CHECKPOINTS_TABLE_NAME} WHERE {matching_columns})')
+			cursor = self._sqlite3_connection.execute('SELECT count(*), count(distinct n_block), min(n_waveform), max(n_waveform), max(n_block) from waveforms')
+			n_waveforms, n_blocks, n_waveform_min, n_waveform_max, n_block_max = cursor.fetchone()
+			self._summary = {'Number of waveforms': n_waveforms, 'Number of blocks': n_blocks, 'n_waveform min': n_waveform_min, 'n_waveform max': n_waveform_max}
+			pandas.DataFrame([self._summary]).to_sql(SUMMARY_TABLE_NAME, self._sqlite3_connection, index=False, if_exists='replace')
+		self._n_block = n_block_max + 1 if n_block_max is not None else 0
+		for block_path in (self._path/Path(BLOCKS_DIRECTORY_NAME)).glob('block_*.npy'):
+			if int(block_path.stem.split('_')[-1]) >= self._n_block: # Written, but its metadata was not.
+				block_path.unlink()
+
+	@property
+	def next_n_waveform(self):
+		"""The `n_waveform` that follows the last one in the store, `0` if it is empty."""
+		return self._summary['n_waveform max'] + 1 if self._summary['n_waveform max'] is not None else 0
+
+	def read_checkpoints(self):
+		"""Returns a data frame with the `checkpoint_columns` of the events
+		that are completely stored, see `checkpoint`."""
+		if self.checkpoint_columns is None:
+			raise RuntimeError(f'This store was created without `checkpoint_columns`.')
+		return pandas.DataFrame(read_query_into_arrays(self._sqlite3_connection, f'SELECT {self._quoted_checkpoint_columns()} from {CHECKPOINTS_TABLE_NAME}'), columns=self.checkpoint_columns)
+
+	def checkpoint(self, metadata: dict):
+		"""Marks that all the waveforms of the event given by the values
+		of `checkpoint_columns` in `metadata` were appended. The event is
+		written in the table `checkpoints` together with the next flush."""
+		self._check_not_closed()
+		if self.checkpoint_columns is None:
+			raise RuntimeError(f'This store was created without `checkpoint_columns`.')
+		self._pending_checkpoints.append(tuple(metadata[column].item() if hasattr(metadata[column], 'item') else metadata[column] for column in self.checkpoint_columns))
+		if self._flush_is_due():
+			self.flush()
+
+	def _flush_is_due(self):
+		return self.max_seconds_between_flushes is not None and len(self._buffer) > 0 and monotonic() - self._last_flush_when >= self.max_seconds_between_flushes
+
+	def append(self, metadata: dict, time, amplitude):
+		"""Append a waveform to the store.
+
+		Parameters
+		----------
+		metadata: dict
+			A dictionary with the metadata of this waveform, e.g. `{'n_waveform': 0, 'n_position': 0, 'x (m)': 1e-3, ...}`.
+			All the waveforms must have the same keys.
+		time: array like
+			The time samples.
+		amplitude: array like
+			The amplitude samples, same length as `time`.
+		"""
+		self._check_not_closed()
+		time = np.asarray(time, dtype=float)
+		amplitude = np.asarray(amplitude, dtype=float)
+		if time.shape != amplitude.shape or time.ndim != 1:
+			raise ValueError(f'`time` and `amplitude` must be 1D arrays of the same length, received arrays with shapes {time.shape} and {amplitude.shape}.')
+		self._buffer.append(metadata, time, amplitude)
+		if self._buffer.is_full or (self.checkpoint_columns is None and self._flush_is_due()):
+			self.flush()
+
+	def flush(self):
+		"""Writes to disk the waveforms that are still in memory."""
+		self._check_not_closed()
+		self._last_flush_when = monotonic()
+		if len(self._buffer) == 0:
+			if len(self._pending_checkpoints) > 0: # All their waveforms were already written in the previous flush.
+				self._write_pending_checkpoints()
+				self._sqlite3_connection.commit()
+			return
+		np.save(self._path/Path(BLOCKS_DIRECTORY_NAME)/Path(f'block_{self._n_block:06d}.npy'), self._buffer.samples)
+		metadata_df = self._buffer.metadata()
+		metadata_df['n_block'] = self._n_block
+		metadata_df['n_row_in_block'] = np.arange(len(metadata_df))
+		metadata_df['Number of samples'] = self._buffer.n_samples
+		# The metadata is written after the block so if something fails in between there is never metadata pointing to nowhere.
+		metadata_df.to_sql('waveforms', self._sqlite3_connection, index=False, if_exists='append')
+		if self._n_block == 0:
+			create_n_waveform_index(self._sqlite3_connection)
+		self._update_summary(metadata_df)
+		self._write_pending_checkpoints()
+		self._sqlite3_connection.commit() # The checkpoints go last, so they never point to waveforms that are not in the store.
+		self._n_block += 1
+		self._buffer.clear()
+
+	def _write_pending_checkpoints(self):
+		if len(self._pending_checkpoints) == 0:
+			return
+		self._sqlite3_connection.executemany(
+			f'INSERT INTO {CHECKPOINTS_TABLE_NAME} ({self._quoted_checkpoint_columns()}) VALUES ({", ".join(["?"]*len(self.checkpoint_columns))})',
+			self._pending_checkpoints,
+		)
+		self._pending_checkpoints = []
+
+	def _update_summary(self, metadata_df):
+		"""Updates the summary table with the waveforms in `metadata_df`, which were just written."""
+		summary = self._summary
+		summary['Number of waveforms'] += len(metadata_df)
+		summary['Number of blocks'] += 1
+		if 'n_waveform' in metadata_df.columns:
+			n_waveforms = [int(metadata_df['n_waveform'].min()), int(metadata_df['n_waveform'].max())] + [summary[key] for key in ['n_waveform min','n_waveform max'] if summary[key] is not None]
+			summary['n_waveform min'] = min(n_waveforms)
+			summary['n_waveform max'] = max(n_waveforms)
+		pandas.DataFrame([summary]).to_sql(SUMMARY_TABLE_NAME, self._sqlite3_connection, index=False, if_exists='replace')
+
+	def close(self):
+		"""Writes any remaining data and closes the files."""
+		if self._closed:
+			return
+		self.flush()
+		self._sqlite3_connection.close()
+		self._closed = True
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def _check_not_closed(self):
+		if self._closed:
+			raise RuntimeError(f'This instance of {repr(WaveformsStoreWriter)} was already closed! You cannot use it anymore.')
+
+	@property
+	def path(self):
+		return self._path
+
+class WaveformsStoreReader:
+	"""Reads waveforms stored by `WaveformsStoreWriter`."""
+	def __init__(self, path: Path):
+		self._path = Path(path)
+		if not (self._path/Path(METADATA_FILE_NAME)).is_file():
+			raise FileNotFoundError(f'Cannot find a waveforms store in {self._path}.')
+		self._sqlite3_connection = sqlite3.connect(self._path/Path(METADATA_FILE_NAME))
+		try: # Stores written before the index existed.
+			create_n_waveform_index(self._sqlite3_connection)
+		except sqlite3.OperationalError: # E.g. read only file system, it will just be slower.
+			pass
+
+	@property
+	def path(self):
+		return self._path
+
+	def _has_table(self, table_name: str):
+		cursor = self._sqlite3_connection.cursor()
+		cursor.execute("SELECT count(*) from sqlite_master where type='table' and name=?", (table_name,))
+		return cursor.fetchone()[0] == 1
+
+	def summary(self):
+		"""Returns a dictionary with the counts of the store, read from
+		the summary table. If the store has no summary table (i.e. it was
+		written by an older version) the counts are calculated."""
+		if self._has_table(SUMMARY_TABLE_NAME):
+			summary = read_query_into_arrays(self._sqlite3_connection, f'SELECT * from {SUMMARY_TABLE_NAME}')
+			return {key: (value[0].item() if hasattr(value[0], 'item') else value[0]) for key, value in summary.items()}
+		if not self._has_table('waveforms'): # Nothing was ever written.
+			return {'Number of waveforms': 0, 'Number of blocks': 0, 'n_waveform min': None, 'n_waveform max': None}
+		cursor = self._sqlite3_connection.cursor()
+		cursor.execute('SELECT count(*), count(distinct n_block), min(n_waveform), max(n_waveform) from waveforms')
+		return dict(zip(['Number of waveforms','Number of blocks','n_waveform min','n_waveform max'], cursor.fetchone()))
+
+	@property
+	def number_of_waveforms(self):
+		"""Returns the total number of waveforms in the store."""
+		return self.summary()['Number of waveforms']
+
+	def read_metadata(self, n_waveform_from: int=None, n_waveform_to: int=None):
+		"""Returns a data frame with the metadata of the waveforms with
+		`n_waveform_from <= n_waveform < n_waveform_to`, sorted by `n_waveform`.
+		If any of the limits is `None` then no limit is applied on that side."""
+		conditions = []
+		if n_waveform_from is not None:
+			conditions.append(f'n_waveform>={int(n_waveform_from)}')
+		if n_waveform_to is not None:
+			conditions.append(f'n_waveform<{int(n_waveform_to)}')
+		where = f' where ({" and ".join(conditions)})' if len(conditions) > 0 else ''
+		if not self._has_table('waveforms'): # Nothing was ever written.
+			return pandas.DataFrame()
+		return pandas.DataFrame(read_query_into_arrays(self._sqlite3_connection, f'SELECT * from waveforms{where} ORDER BY n_waveform'))
+
+	def read_samples(self, metadata_df):
+		"""Given a data frame produced by `read_metadata` returns two 2D
+		arrays `time, amplitude` each of them with shape `(len(metadata_df), n_samples)`
+		where the i-th row corresponds to the i-th row in `metadata_df`.
+		Shorter waveforms are padded with NaN."""
+		if len(metadata_df) == 0: # E.g. an empty store, whose metadata has no columns.
+			return np.zeros((0,0)), np.zeros((0,0))
+		n_samples = int(metadata_df['Number of samples'].max())
+		time = np.full((len(metadata_df), n_samples), float('NaN'))
+		amplitude = np.full((len(metadata_df), n_samples), float('NaN'))
+		n_blocks = metadata_df['n_block'].to_numpy()
+		n_rows_in_block = metadata_df['n_row_in_block'].to_numpy()
+		for n_block in np.unique(n_blocks):
+			rows_in_this_block = n_blocks == n_block
+			samples = self._read_block_rows(n_block, n_rows_in_block[rows_in_this_block])
+			time[rows_in_this_block,:samples.shape[2]] = samples[:,0,:n_samples]
+			amplitude[rows_in_this_block,:samples.shape[2]] = samples[:,1,:n_samples]
+		return time, amplitude
+
+	def _read_block_rows(self, n_block: int, rows):
+		"""Returns an array of shape `(len(rows), 2, n_samples)` with the
+		samples of the given rows of a block, either raw or archived."""
+		block_path = self._path/Path(BLOCKS_DIRECTORY_NAME)/Path(f'block_{n_block:06d}.npy')
+		if block_path.is_file(): # If both files exist the archiving of this block was interrupted, the raw one is complete.
+			return np.load(block_path, mmap_mode='r')[rows]
+		return decode_archived_block(np.load(block_path.with_suffix('.npz')), rows)
+
+	@property
+	def is_archived(self):
+		"""`True` if all the blocks of the store were archived with `archive_waveforms_store`."""
+		return not any((self._path/Path(BLOCKS_DIRECTORY_NAME)).glob('*.npy'))
+
+	def batches_limits(self, n_waveforms_per_batch: int):
+		"""Returns a list of tuples `(n_waveform_from, n_waveform_to)` that
+		split all the waveforms in the store in batches of `n_waveforms_per_batch`,
+		so each batch can be read with `read_metadata(n_waveform_from, n_waveform_to)`."""
+		summary = self.summary()
+		n_waveform_min, n_waveform_max = summary['n_waveform min'], summary['n_waveform max']
+		if n_waveform_min is None: # The store is empty.
+			return []
+		return [(n_waveform_from, n_waveform_from+n_waveforms_per_batch) for n_waveform_from in range(n_waveform_min, n_waveform_max+1, n_waveforms_per_batch)]
+
+	def iter_batches(self, n_waveforms_per_batch: int):
+		"""Iterates over all the waveforms in batches, each batch is a
+		tuple `(metadata_df, time, amplitude)` as returned by `read_metadata`
+		and `read_samples`."""
+		for n_waveform_from, n_waveform_to in self.batches_limits(n_waveforms_per_batch):
+			metadata_df = self.read_metadata(n_waveform_from, n_waveform_to)
+			if len(metadata_df) == 0:
+				continue
+			yield (metadata_df, *self.read_samples(metadata_df))
+
+	def get_waveform(self, n_waveform: int):
+		"""Returns a single waveform as a dictionary `{'Time (s)': array, 'Amplitude (V)': array}`."""
+		metadata_df = self.read_metadata(n_waveform, n_waveform+1)
+		if len(metadata_df) == 0:
+			raise KeyError(f'There is no waveform with `n_waveform` {n_waveform} in {self._path}.')
+		time, amplitude = self.read_samples(metadata_df)
+		return {'Time (s)': time[0], 'Amplitude (V)': amplitude[0]}
+
+	def close(self):
+		self._sqlite3_connection.close()
+
+def encode_archived_block(samples, n_samples):
+	"""Encodes a block of samples, as stored by `WaveformsStoreWriter`,
+	into the arrays stored in an archived block (see `archive_waveforms_store`).
+	
+	Parameters
+	----------
+	samples: array
+		Array of shape `(n_waveforms, 2, n_samples)` where `[:,0,:]` is time and `[:,1,:]` is amplitude.
+	n_samples: array
+		Number of samples of each waveform, the rest is padding.
+	
+	Returns
+	-------
+	arrays: dict
+		A dictionary with the arrays to store, see `decode_archived_block`.
+	"""
+	samples = np.asarray(samples, dtype=float)
+	n_samples = np.asarray(n_samples, dtype=int)
+	time, amplitude = samples[:,0,:], samples[:,1,:]
+	is_sample = np.arange(samples.shape[2])[np.newaxis,:] < n_samples[:,np.newaxis]
+	
+	# Amplitude: int16 codes with one scale and offset per waveform ---
+	finite_amplitude = is_sample & np.isfinite(amplitude)
+	with np.errstate(invalid='ignore'):
+		amplitude_max = np.where(finite_amplitude, amplitude, -np.inf).max(axis=1)
+		amplitude_min = np.where(finite_amplitude, amplitude, np.inf).min(axis=1)
+	no_finite_samples = ~finite_amplitude.any(axis=1)
+	amplitude_max[no_finite_samples] = 0
+	amplitude_min[no_finite_samples] = 0
+	amplitude_offset = (amplitude_max + amplitude_min)/2
+	amplitude_scale = (amplitude_max - amplitude_min)/2/AMPLITUDE_MAX_CODE
+	amplitude_scale[amplitude_scale == 0] = 1 # Constant waveforms.
+	amplitude_codes = np.round((np.where(finite_amplitude, amplitude, 0) - amplitude_offset[:,np.newaxis])/amplitude_scale[:,np.newaxis])
+	amplitude_codes = np.where(finite_amplitude, amplitude_codes, AMPLITUDE_NAN_CODE).astype(np.int16)
+	
+	# Time: start and step when the samples are equally spaced, which is what the oscilloscope produces, otherwise the raw values ---
+	time_start = time[:,0].copy()
+	time_step = np.array([(time[i,n-1]-time[i,0])/(n-1) if n > 1 else 0 for i,n in enumerate(n_samples)])
+	linear_time = time_start[:,np.newaxis] + time_step[:,np.newaxis]*np.arange(samples.shape[2])[np.newaxis,:]
+	tolerance = np.abs(time_step)*1e-6
+	time_is_linear = (np.where(is_sample, np.abs(time-linear_time), 0) <= tolerance[:,np.newaxis]).all(axis=1)
+	nonlinear_time_rows = np.flatnonzero(~time_is_linear)
+	
+	return {
+		'n_samples': n_samples,
+		'amplitude_codes': amplitude_codes,
+		'amplitude_scale': amplitude_scale,
+		'amplitude_offset': amplitude_offset,
+		'time_start': time_start,
+		'time_step': time_step,
+		'nonlinear_time_rows': nonlinear_time_rows,
+		'nonlinear_time': time[nonlinear_time_rows],
+	}
+
+def decode_archived_block(arrays, rows=None):
+	"""Inverse of `encode_archived_block`. Returns an array of shape
+	`(len(rows), 2, n_samples)` with the samples of the given rows of the
+	block, or of all the rows if `rows` is `None`. Samples beyond the
+	length of each waveform are NaN, as in the raw blocks."""
+	n_samples = arrays['n_samples']
+	rows = np.arange(len(n_samples)) if rows is None else np.asarray(rows)
+	amplitude_codes = arrays['amplitude_codes'][rows]
+	amplitude = amplitude_codes*arrays['amplitude_scale'][rows,np.newaxis] + arrays['amplitude_offset'][rows,np.newaxis]
+	amplitude[amplitude_codes == AMPLITUDE_NAN_CODE] = float('NaN')
+	time = arrays['time_start'][rows,np.newaxis] + arrays['time_step'][rows,np.newaxis]*np.arange(amplitude.shape[1])[np.newaxis,:]
+	nonlinear_time_rows = arrays['nonlinear_time_rows']
+	if len(nonlinear_time_rows) > 0:
+		nonlinear_time = arrays['nonlinear_time']
+		for i, row in enumerate(rows):
+			position = np.searchsorted(nonlinear_time_rows, row)
+			if position < len(nonlinear_time_rows) and nonlinear_time_rows[position] == row:
+				time[i] = nonlinear_time[position]
+	is_padding = np.arange(amplitude.shape[1])[np.newaxis,:] >= n_samples[rows,np.newaxis]
+	time[is_padding] = float('NaN')
+	amplitude[is_padding] = float('NaN')
+	return np.stack([time, amplitude], axis=1)
+
+def archive_waveforms_store(path: Path, silent: bool=True):
+	"""Compresses, in place, all the blocks of a waveforms store so it
+	is small enough to be kept after the waveforms were parsed. The
+	amplitude of each waveform is stored as int16 codes with its own
+	scale and offset, i.e. with a resolution of 1/65533 of the range of
+	each waveform, which is finer than the oscilloscope's ADC. The time
+	is stored as start and step, exact up to 1e-6 of the sampling period,
+	or raw if the samples are not equally spaced. Each block is then
+	compressed with zlib (`numpy.savez_compressed`), so any waveform can
+	still be read alone by decompressing only its block. The store can
+	be read with `WaveformsStoreReader` as before.
+	
+	Parameters
+	----------
+	path: Path
+		Path to the waveforms store.
+	silent: bool, default True
+		If `False` messages are print showing the progress.
+	"""
+	blocks_path = Path(path)/Path(BLOCKS_DIRECTORY_NAME)
+	reader = WaveformsStoreReader(path)
+	metadata_df = reader.read_metadata()
+	reader.close()
+	for block_path in sorted(blocks_path.glob('block_*.npy')):
+		n_block = int(block_path.stem.split('_')[-1])
+		if not silent:
+			print(f'Archiving {block_path.name}...')
+		samples = np.load(block_path)
+		n_samples = np.zeros(len(samples), dtype=int)
+		this_block = metadata_df.loc[metadata_df['n_block']==n_block]
+		n_samples[this_block['n_row_in_block'].to_numpy()] = this_block['Number of samples'].to_numpy()
+		temporary_path = block_path.with_suffix('.tmp.npz')
+		np.savez_compressed(temporary_path, **encode_archived_block(samples, n_samples))
+		temporary_path.rename(block_path.with_suffix('.npz'))
+		block_path.unlink() # Only after the archived block is complete.
+
+def convert_sqlite_waveforms_to_store(sqlite_file_path: Path, store_path: Path, n_waveforms_per_batch: int=3333, silent: bool=True):
+	"""Converts a `waveforms.sqlite` file with the old format (one row per
+	sample, table `waveforms`) into the new waveforms store format.
+
+	Parameters
+	----------
+	sqlite_file_path: Path
+		Path to the old `waveforms.sqlite` file.
+	store_path: Path
+		Path to the new directory in which to store the waveforms, must not exist.
+	n_waveforms_per_batch: int, default 3333
+		Number of waveforms read from the sqlite file at once.
+	silent: bool, default True
+		If `False` messages are print showing the progress.
+	"""
+	sqlite3_connection = sqlite3.connect(sqlite_file_path)
+	if not silent:
+		print(f'Indexing {sqlite_file_path}, this may take a while...')
+	create_n_waveform_index(sqlite3_connection) # Otherwise each batch is a scan of the whole file.
+	cursor = sqlite3_connection.cursor()
+	cursor.execute('SELECT max(n_waveform) from waveforms')
+	n_waveform_max = cursor.fetchone()[0]
+	number_of_waveforms = n_waveform_max+1 if n_waveform_max is not None else 0 # An empty table gives an empty store.
+	with WaveformsStoreWriter(store_path, waveforms_per_block=n_waveforms_per_batch) as writer:
+		for n_waveform_from in range(0, number_of_waveforms, n_waveforms_per_batch):
+			if not silent:
+				print(f'Converting waveforms {n_waveform_from}-{min(n_waveform_from+n_waveforms_per_batch,number_of_waveforms)-1} out of {number_of_waveforms}...')
+			waveforms = read_query_into_arrays(sqlite3_connection, f'SELECT * from waveforms where (n_waveform>={n_waveform_from} and n_waveform<{n_waveform_from+n_waveforms_per_batch}) ORDER BY n_waveform, rowid') # Sorted, so the samples of each waveform are contiguous and in the order they were written.
+			if len(waveforms['n_waveform']) == 0:
+				continue
+			metadata_columns = [col for col in waveforms if col not in {'Time (s)','Amplitude (V)'}]
+			time = waveforms['Time (s)'].astype(float)
+			amplitude = waveforms['Amplitude (V)'].astype(float)
+			_, first_row_of_each_waveform = np.unique(waveforms['n_waveform'], return_index=True)
+			slices_limits = list(first_row_of_each_waveform) + [len(time)]
+			metadata_of_each_waveform = pandas.DataFrame({col: waveforms[col][first_row_of_each_waveform] for col in metadata_columns}).to_dict('records')
+			for metadata, start, stop in zip(metadata_of_each_waveform, slices_limits[:-1], slices_limits[1:]):
+				writer.append(
+					metadata = metadata,
+					time = time[start:stop],
+					amplitude = amplitude[start:stop],
+				)
+	sqlite3_connection.close()
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Converts an old `waveforms.sqlite` file (one row per sample) into the new waveforms store format.')
+	parser.add_argument('--sqlite',
+		metavar = 'path',
+		help = 'Path to the `waveforms.sqlite` file.',
+		required = True,
+		dest = 'sqlite_file_path',
+		type = str,
+	)
+	parser.add_argument('--out',
+		metavar = 'path',
+		help = 'Path to the directory where to create the new store. Default is a directory named `waveforms` next to the sqlite file.',
+		dest = 'store_path',
+		type = str,
+		default = None,
+	)
+	args = parser.parse_args()
+	sqlite_file_path = Path(args.sqlite_file_path)
+	convert_sqlite_waveforms_to_store(
+		sqlite_file_path = sqlite_file_path,
+		store_path = Path(args.store_path) if args.store_path is not None else sqlite_file_path.parent/Path('waveforms'),
+		silent = False,
+	)
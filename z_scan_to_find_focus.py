@@ -1,4 +1,5 @@
 import numpy as np
+import argparse
 from scan_1D import script_core as linear_scan, post_process
 from TheSetup import TheSetup
 import pandas
@@ -11,7 +12,23 @@ STEP_SIZE = 22e-6
 SWEEP_LENGTH = 8e-3/5
 Z_MIDDLE = 71.41470703125e-3
 
-the_setup = TheSetup()
+parser = argparse.ArgumentParser()
+parser.add_argument('--simulate',
+	help = 'Use this option to run with simulated instruments instead of the real ones, see `simulated_setup.py`.',
+	dest = 'simulate',
+	action = 'store_true',
+)
+args = parser.parse_args()
+
+if args.simulate:
+	from simulated_setup import SimulatedTheSetup, SimulatedDevice
+	the_setup = SimulatedTheSetup(device=SimulatedDevice(center=(0,0,Z_MIDDLE-100e-6))) # Focus not exactly in the middle, so it has to be found.
+	the_setup.move_to(x=100e-6) # Inside the pixel of channel 2.
+	telegram_reporter_data_dict = None
+else:
+	import my_telegram_bots
+	the_setup = TheSetup()
+	telegram_reporter_data_dict = {'token': my_telegram_bots.robobot.token, 'chat_id': my_telegram_bots.chat_ids['Robobot TCT setup']}
 
 current_position = the_setup.position
 
@@ -27,6 +44,7 @@ measurement_base_path = linear_scan(
 	positions = list(zip(x_positions,y_positions,z_positions)),
 	n_triggers = 2,
 	acquire_channels = [2,3],
+	telegram_reporter_data_dict = telegram_reporter_data_dict,
 )
 post_process(measurement_base_path, silent=False)
 